@@ -38,7 +38,11 @@ CREATE TABLE `message` (
   `send_time` datetime DEFAULT NULL ON UPDATE CURRENT_TIMESTAMP,
   `enter_time` datetime DEFAULT NULL,
   `error_message` text,
-  PRIMARY KEY (`tid`) USING BTREE
+  `worker_id` varchar(64) DEFAULT NULL,
+  `lease_until` datetime DEFAULT NULL,
+  PRIMARY KEY (`tid`) USING BTREE,
+  KEY `idx_status` (`status`),
+  KEY `idx_username_status` (`username`, `status`)
 ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_0900_ai_ci;
 
 -- ----------------------------
@@ -56,7 +60,8 @@ CREATE TABLE `spider_user` (
   `username` varchar(255) DEFAULT NULL,
   `add_time` datetime DEFAULT NULL,
   `last_check_time` datetime DEFAULT NULL ON UPDATE CURRENT_TIMESTAMP,
-  PRIMARY KEY (`uid`) USING BTREE
+  PRIMARY KEY (`uid`) USING BTREE,
+  KEY `idx_username` (`username`)
 ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_0900_ai_ci;
 
 -- ----------------------------
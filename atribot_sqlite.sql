@@ -0,0 +1,48 @@
+-- Schema of atribot.sql for the embedded SQLite driver of Riko
+-- sqlite3 atribot.db < atribot_sqlite.sql
+
+CREATE TABLE IF NOT EXISTS `message` (
+  `tid` bigint NOT NULL,
+  `uid` bigint DEFAULT NULL,
+  `name` varchar(255) DEFAULT NULL,
+  `username` varchar(255) DEFAULT NULL,
+  `text` text,
+  `time` datetime DEFAULT NULL,
+  `twi_url` varchar(255) DEFAULT NULL,
+  `tag` text,
+  `media_url` varchar(255) DEFAULT NULL,
+  `media_key` varchar(255) DEFAULT NULL,
+  `media_type` varchar(255) DEFAULT NULL,
+  `media_path` varchar(255) DEFAULT NULL,
+  `status` tinyint DEFAULT NULL,
+  `send_time` datetime DEFAULT NULL,
+  `enter_time` datetime DEFAULT NULL,
+  `error_message` text,
+  `worker_id` varchar(64) DEFAULT NULL,
+  `lease_until` datetime DEFAULT NULL,
+  PRIMARY KEY (`tid`)
+);
+CREATE INDEX IF NOT EXISTS `idx_status` ON `message` (`status`);
+CREATE INDEX IF NOT EXISTS `idx_username_status` ON `message` (`username`, `status`);
+
+CREATE TABLE IF NOT EXISTS `spider_user` (
+  `uid` bigint NOT NULL,
+  `username` varchar(255) DEFAULT NULL,
+  `add_time` datetime DEFAULT NULL,
+  `last_check_time` datetime DEFAULT NULL,
+  PRIMARY KEY (`uid`)
+);
+CREATE INDEX IF NOT EXISTS `idx_username` ON `spider_user` (`username`);
+
+CREATE TABLE IF NOT EXISTS `user` (
+  `uid` bigint NOT NULL,
+  `name` varchar(255) DEFAULT NULL,
+  `username` varchar(255) DEFAULT NULL,
+  `description` varchar(255) DEFAULT NULL,
+  `profile_image_url` varchar(255) DEFAULT NULL,
+  `profile_image_path` varchar(255) DEFAULT NULL,
+  `add_time` datetime DEFAULT NULL,
+  `update_time` datetime DEFAULT NULL,
+  `last_check_time` datetime DEFAULT NULL,
+  PRIMARY KEY (`uid`)
+);
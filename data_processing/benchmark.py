@@ -0,0 +1,556 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+"""
+@module  : benchmark.py
+@time    : 2026/10/17
+
+Micro-benchmarks of Riko overhead: query building, SQL rendering, deserializing,
+select, awaitable select split by long IN list, single and batch insert, single and batch update.
+Run against an in-memory fake driver answering at once, so that only Riko is measured,
+or a temporary SQLite database. Results can be saved as JSON and compared with a baseline.
+
+    python -m data_processing.benchmark [--backend fake|sqlite] [--output bench.json]
+    python -m data_processing.benchmark --baseline bench.json [--threshold 0.2]
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import shutil
+import sqlite3
+import statistics
+import sys
+import tempfile
+import time
+from datetime import datetime as dt
+
+import pymysql
+from pymysql.constants import FIELD_TYPE
+from pymysql.converters import escape_item
+
+from data_processing.common.Riko import (
+    INSERT,
+    Driver,
+    Riko,
+    SqlQuery,
+    SqlRender,
+)
+from data_processing.common.connect import message
+
+SCHEMA_FILE = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "atribot_sqlite.sql"
+)
+
+
+class FakeDriver(Driver):
+    """
+    Driver answering every statement at once without any DB, rows of SELECT are set by `rows`.
+    """
+
+    name = "fake"
+
+    def __init__(self):
+        self.rows = list()
+        self.description = None
+
+    def set_rows(self, rows):
+        """
+        Set rows answered to SELECT.
+        :param rows: list of dict with the same keys
+        """
+        self.rows = rows
+        if len(rows) == 0:
+            self.description = None
+            return
+        self.description = tuple(
+            (k, FIELD_TYPE.DATETIME if isinstance(v, dt) else FIELD_TYPE.VAR_STRING)
+            + (None,) * 5
+            for (k, v) in rows[0].items()
+        )
+
+    def connect(self, db_config):
+        return FakeConnection(self, db_config)
+
+    def max_allowed_packet(self, conn):
+        return 16 * 1024 * 1024
+
+
+class FakeConnection:
+    """
+    pymysql like connection of `FakeDriver`.
+    """
+
+    encoding = "utf8"
+    client_flag = 0
+    server_status = 0
+
+    def __init__(self, driver, db_config):
+        self._driver = driver
+        self._autocommit = bool(db_config.get("autocommit", False))
+        self._cursor_class = db_config.get("cursorclass", pymysql.cursors.Cursor)
+        self.open = True
+
+    def cursor(self, cursor_class=None):
+        if cursor_class is None:
+            cursor_class = self._cursor_class
+        return FakeCursor(
+            self._driver, issubclass(cursor_class, pymysql.cursors.DictCursorMixin)
+        )
+
+    def ping(self, reconnect=True):
+        pass
+
+    def get_autocommit(self):
+        return self._autocommit
+
+    def autocommit(self, value):
+        self._autocommit = bool(value)
+
+    def begin(self):
+        pass
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        pass
+
+    def close(self):
+        self.open = False
+
+
+class FakeCursor:
+    """
+    pymysql like cursor of `FakeDriver`, SELECT gets rows of the driver, others affect one row each.
+    """
+
+    def __init__(self, driver, as_dict):
+        self._driver = driver
+        self._as_dict = as_dict
+        self._rows = list()
+        self.description = None
+        self.rowcount = -1
+        self.lastrowid = None
+
+    def execute(self, sql, args=None):
+        if sql.lstrip()[:6].upper() == "SELECT":
+            # rows are built per statement as pymysql does
+            if self._as_dict:
+                self._rows = [dict(row) for row in self._driver.rows]
+            else:
+                self._rows = [tuple(row.values()) for row in self._driver.rows]
+            self.description = self._driver.description
+            self.rowcount = len(self._rows)
+        else:
+            self._rows = list()
+            self.description = None
+            self.rowcount = 1
+        return self.rowcount
+
+    def executemany(self, sql, args):
+        args = list(args)
+        for a in args:
+            self.execute(sql, a)
+        self.rowcount = len(args)
+        return self.rowcount
+
+    def mogrify(self, sql, args=None):
+        if args is None:
+            return sql
+        if isinstance(args, dict):
+            return sql % {k: escape_item(v, "utf8") for (k, v) in args.items()}
+        return sql % tuple(escape_item(v, "utf8") for v in args)
+
+    def fetchone(self):
+        rows = self.fetchmany(1)
+        return rows[0] if len(rows) > 0 else None
+
+    def fetchmany(self, size=1):
+        fetched = self._rows[:size]
+        self._rows = self._rows[size:]
+        return fetched
+
+    def fetchall(self):
+        fetched = self._rows
+        self._rows = list()
+        return fetched
+
+    def nextset(self):
+        return None
+
+    def close(self):
+        pass
+
+
+class Backend:
+    """
+    DB used by benchmarks, see `FakeBackend` and `SqliteBackend`.
+    """
+
+    name = None
+
+    def open(self):
+        """
+        Set `Riko.db_config` to this backend.
+        """
+        pass
+
+    def close(self):
+        pass
+
+    def put_rows(self, rows):
+        """
+        Make `message` rows present, they are what the fake driver answers to select.
+        :param rows: list of message dict
+        """
+        pass
+
+
+class FakeBackend(Backend):
+    name = "fake"
+
+    def __init__(self):
+        self._driver = FakeDriver()
+
+    def open(self):
+        Driver.register(self._driver)
+        Riko.db_config = {
+            "driver": "fake",
+            "database": "benchmark",
+            "autocommit": True,
+            "cursorclass": pymysql.cursors.DictCursor,
+        }
+
+    def put_rows(self, rows):
+        self._driver.set_rows(rows)
+
+
+class SqliteBackend(Backend):
+    name = "sqlite"
+
+    def __init__(self):
+        self._dir = None
+
+    def open(self):
+        self._dir = tempfile.mkdtemp(prefix="riko_bench_")
+        database = os.path.join(self._dir, "atribot.db")
+        with open(SCHEMA_FILE, "r") as file:
+            schema = file.read()
+        db = sqlite3.connect(database)
+        db.executescript(schema)
+        db.close()
+        Riko.db_config = {
+            "driver": "sqlite",
+            "database": database,
+            "autocommit": True,
+            "cursorclass": pymysql.cursors.DictCursor,
+        }
+
+    def close(self):
+        if self._dir is not None:
+            shutil.rmtree(self._dir, ignore_errors=True)
+
+    def put_rows(self, rows):
+        message.insert_many().replace().from_objects(
+            [message.new(**row) for row in rows]
+        ).go()
+
+
+BACKENDS = {"fake": FakeBackend, "sqlite": SqliteBackend}
+
+
+def make_rows(n, tid_base=0, status=0):
+    """
+    Build `message` rows like those saved by the bot.
+    :param n: row number
+    :param tid_base: first tid
+    :param status: status of all rows
+    :return: list of dict
+    """
+    now = dt(2022, 3, 25, 21, 34, 0)
+    rows = list()
+    for i in range(n):
+        tid = tid_base + i
+        rows.append(
+            {
+                "tid": tid,
+                "uid": 1000 + i % 7,
+                "name": "ATRI",
+                "username": "atri_%d" % (i % 7),
+                "text": "高性能ですから! #%d" % tid,
+                "time": now,
+                "twi_url": "https://twitter.com/atri/status/%d" % tid,
+                "tag": "ATRI",
+                "media_url": None,
+                "media_key": None,
+                "media_type": None,
+                "media_path": None,
+                "status": status,
+                "send_time": None,
+                "enter_time": now,
+                "error_message": None,
+            }
+        )
+    return rows
+
+
+def _build_select():
+    message.select().where(username="atri_0", status=0).order_by(
+        "tid DESC"
+    ).limit(20)._prepare_sql()
+
+
+def _build_update():
+    message.update_query().set(status=1, send_time="2022-03-25 21:34:00").where(
+        tid=1
+    )._prepare_sql()
+
+
+def benchmarks(backend, row_counts):
+    """
+    Define benchmarks.
+    :param backend: a Backend object, opened
+    :param row_counts: row numbers of row-scaled benchmarks
+    :return: list of (name, setup, ops), `setup` returns the function to time, which handles `ops` items per call
+    """
+    select_template = SqlQuery._Select_Template
+    render_args = {
+        SqlQuery._KW_DISTINCT: "",
+        SqlQuery._KW_FIELDS: "*",
+        SqlQuery._KW_TABLE: "message",
+        SqlQuery._KW_JOIN: "",
+        SqlQuery._KW_WHERE: "WHERE username = %(username)s AND status = %(status)s",
+        SqlQuery._KW_GROUP_BY: "",
+        SqlQuery._KW_HAVING: "",
+        SqlQuery._KW_ORDER_BY: "ORDER BY tid DESC",
+        SqlQuery._KW_LIMIT: "LIMIT 20",
+        SqlQuery._KW_OFFSET: "",
+        SqlQuery._KW_FORUPDATE: "",
+    }
+    sample = message.select().where(username="atri_0", status=0).limit(20)
+
+    defined = [
+        ("build.select", lambda: _build_select, 1),
+        ("build.select.render", lambda: sample._build_sql, 1),
+        ("build.update", lambda: _build_update, 1),
+        ("render", lambda: lambda: SqlRender.render(select_template, render_args), 1),
+    ]
+
+    for (i, n) in enumerate(row_counts):
+        # benchmarks of each row number work on their own tids and status
+        base = 1000000 * (i + 1)
+
+        def deserialize_setup(rows=make_rows(n, base)):
+            conf = Riko.db_config
+            return lambda: [message.deserialize(conf, **row) for row in rows]
+
+        def build_insert_setup(objs=[message.new(**row) for row in make_rows(n, base)]):
+            return lambda: message.insert_many().replace().from_objects(objs)._prepare_sql()
+
+        def select_setup(n=n, status=base):
+            backend.put_rows(make_rows(n, base, status))
+            return lambda: message.select().where(status=status).get()
+
+        def select_model_setup(n=n, status=base):
+            backend.put_rows(make_rows(n, base, status))
+            return lambda: message.select().where(status=status).get(parse_model=True)
+
+        def select_in_async_setup(n=n, rows=make_rows(n, base)):
+            backend.put_rows(rows)
+            tids = [row["tid"] for row in rows]
+
+            async def select_in():
+                query = message.select().where_in("tid", tids)
+                # split into several queries sharing the connection borrowed by `aget`
+                query.in_chunk_size = max(1, n // 4)
+                found = await query.aget()
+                # the fake driver answers every part with all rows
+                if len(found) < n:
+                    raise Exception("select.in.async got %d rows of %d" % (len(found), n))
+
+            return lambda: asyncio.run(select_in())
+
+        def insert_single_setup(rows=make_rows(n, base)):
+            def run():
+                for row in rows:
+                    message.new(**row).insert(
+                        on_duplicate_key_replace=INSERT.DUPLICATE_KEY_REPLACE
+                    )
+
+            return run
+
+        def insert_batch_setup(rows=make_rows(n, base)):
+            return lambda: message.insert_many().replace().from_objects(
+                [message.new(**row) for row in rows]
+            ).go()
+
+        def update_single_setup(rows=make_rows(n, base)):
+            backend.put_rows(rows)
+
+            def run():
+                for row in rows:
+                    message.patch(row["tid"], status=1)
+
+            return run
+
+        def update_many_setup(rows=make_rows(n, base)):
+            backend.put_rows(rows)
+            changes = [{"tid": row["tid"], "status": 1} for row in rows]
+            return lambda: message.update_many("tid", changes)
+
+        defined.extend(
+            [
+                ("deserialize.%d" % n, deserialize_setup, n),
+                ("build.insert_batch.%d" % n, build_insert_setup, n),
+                ("select.%d" % n, select_setup, n),
+                ("select.model.%d" % n, select_model_setup, n),
+                ("select.in.async.%d" % n, select_in_async_setup, n),
+                ("insert.single.%d" % n, insert_single_setup, n),
+                ("insert.batch.%d" % n, insert_batch_setup, n),
+                ("update.single.%d" % n, update_single_setup, n),
+                ("update.many.%d" % n, update_many_setup, n),
+            ]
+        )
+    return defined
+
+
+def measure(func, ops, repeat=5, min_time=0.1):
+    """
+    Time a function like `timeit`: call it in loops lasting at least `min_time`, `repeat` times.
+    :param func: function to time
+    :param ops: items handled by one call
+    :param repeat: times of timing loops
+    :param min_time: min seconds of one timing loop
+    :return: a dict of result, times are microseconds per item
+    """
+    loops = 1
+    while True:
+        started = time.perf_counter()
+        for _ in range(loops):
+            func()
+        elapsed = time.perf_counter() - started
+        if elapsed >= min_time:
+            break
+        loops *= 10 if elapsed < min_time / 10 else 2
+    samples = [elapsed]
+    for _ in range(repeat - 1):
+        started = time.perf_counter()
+        for _ in range(loops):
+            func()
+        samples.append(time.perf_counter() - started)
+    per_op = [s * 1e6 / loops / ops for s in samples]
+    return {
+        "ops": ops,
+        "loops": loops,
+        "best_us": round(min(per_op), 4),
+        "median_us": round(statistics.median(per_op), 4),
+    }
+
+
+def run(backend_name, row_counts, repeat=5, min_time=0.1, only=None):
+    """
+    Run benchmarks.
+    :param backend_name: "fake" or "sqlite"
+    :param row_counts: row numbers of row-scaled benchmarks
+    :param repeat: times of timing loops
+    :param min_time: min seconds of one timing loop
+    :param only: list of name prefixes to run, None to run all
+    :return: result dict, dumpable as JSON
+    """
+    backend = BACKENDS[backend_name]()
+    db_config = Riko.db_config
+    backend.open()
+    results = dict()
+    try:
+        for (name, setup, ops) in benchmarks(backend, row_counts):
+            if only and not any(name.startswith(p) for p in only):
+                continue
+            results[name] = measure(setup(), ops, repeat, min_time)
+            print(
+                "%-24s %12.3f us  (median %.3f us, %d loops)"
+                % (name, results[name]["best_us"], results[name]["median_us"], results[name]["loops"]),
+                file=sys.stderr,
+            )
+    finally:
+        Riko.close_pools()
+        backend.close()
+        Riko.db_config = db_config
+    return {
+        "meta": {
+            "backend": backend_name,
+            "rows": list(row_counts),
+            "hooks": len(Riko.hooks),
+            "python": platform.python_version(),
+            "pymysql": pymysql.__version__,
+            "time": dt.now().strftime("%Y-%m-%d %H:%M:%S"),
+        },
+        "results": results,
+    }
+
+
+def compare(result, baseline, threshold=0.2):
+    """
+    Compare best times of benchmarks with a baseline.
+    :param result: result dict of `run`
+    :param baseline: result dict saved before
+    :param threshold: ratio slower than baseline to count as regression, 0.2 for 20%
+    :return: list of (name, baseline us, current us, ratio, regressed)
+    """
+    compared = list()
+    for (name, current) in result["results"].items():
+        base = baseline["results"].get(name)
+        if base is None or base["best_us"] <= 0:
+            continue
+        ratio = current["best_us"] / base["best_us"]
+        compared.append((name, base["best_us"], current["best_us"], ratio, ratio > 1 + threshold))
+    return compared
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Micro-benchmarks of Riko")
+    parser.add_argument("--backend", choices=sorted(BACKENDS), default="fake")
+    parser.add_argument("--rows", default="1,100,1000", help="row numbers, like 1,100,1000")
+    parser.add_argument("--repeat", type=int, default=5, help="times of timing loops")
+    parser.add_argument("--min-time", type=float, default=0.1, help="min seconds of one timing loop")
+    parser.add_argument("--only", help="name prefixes to run, like build,select")
+    parser.add_argument("--no-hooks", action="store_true", help="disable Riko query hooks")
+    parser.add_argument("--output", help="save result as JSON")
+    parser.add_argument("--baseline", help="JSON result to compare with")
+    parser.add_argument("--threshold", type=float, default=0.2, help="slowdown ratio counted as regression")
+    args = parser.parse_args()
+
+    if args.no_hooks:
+        Riko.hooks = []
+    row_counts = [int(n) for n in args.rows.split(",") if n.strip()]
+    only = [p.strip() for p in args.only.split(",")] if args.only else None
+    result = run(args.backend, row_counts, args.repeat, args.min_time, only)
+
+    if args.output:
+        with open(args.output, "w") as file:
+            file.write(json.dumps(result, indent=2, sort_keys=True))
+    else:
+        print(json.dumps(result, indent=2, sort_keys=True))
+
+    if args.baseline:
+        with open(args.baseline, "r") as file:
+            baseline = json.loads(file.read())
+        if baseline["meta"].get("backend") != args.backend:
+            print("-- baseline is measured on backend %s" % baseline["meta"].get("backend"), file=sys.stderr)
+        regressed = 0
+        for (name, base_us, current_us, ratio, is_regressed) in compare(result, baseline, args.threshold):
+            if is_regressed:
+                regressed += 1
+            print(
+                "%-24s %12.3f -> %12.3f us  %+7.1f%%%s"
+                % (name, base_us, current_us, (ratio - 1) * 100, "  REGRESSED" if is_regressed else ""),
+                file=sys.stderr,
+            )
+        if regressed > 0:
+            print("-- %d benchmarks regressed over %.0f%%" % (regressed, args.threshold * 100), file=sys.stderr)
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,87 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+"""
+@module  : bulk.py
+@time    : 2026/10/17
+
+Export a model table to a streaming CSV / JSON lines file, or import one back,
+by `LOAD DATA LOCAL INFILE` on MySQL with `local_infile` or multi-row inserts otherwise.
+An interrupted run continues from its checkpoint by `--resume`.
+
+    python -m data_processing.bulk export message message.jsonl
+    python -m data_processing.bulk import message message.jsonl [--resume] [--method insert]
+"""
+import argparse
+import json
+import sys
+
+import pymysql
+
+from data_processing.common.Riko import INSERT, Bulk, Riko
+from data_processing.common.connect import message, spider_user, user
+
+MODELS = {clazz.__name__: clazz for clazz in (message, spider_user, user)}
+
+ON_DUPLICATE = {
+    "error": INSERT.DUPLICATE_KEY_EXCEPTION,
+    "replace": INSERT.DUPLICATE_KEY_REPLACE,
+    "ignore": INSERT.DUPLICATE_KEY_IGNORE,
+    "update": INSERT.DUPLICATE_KEY_UPDATE,
+}
+
+
+def report(rows, done, total):
+    if total:
+        sys.stderr.write("\r%d rows, %.1f%%" % (rows, 100.0 * done / total))
+    else:
+        sys.stderr.write("\r%d rows" % rows)
+    sys.stderr.flush()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Bulk export and import of Riko models")
+    parser.add_argument("action", choices=["export", "import"])
+    parser.add_argument("model", choices=sorted(MODELS))
+    parser.add_argument("file")
+    parser.add_argument("--config", default="data_processing/atri_bot_db.json")
+    parser.add_argument("--format", choices=Bulk.FORMATS, help="guess by file extension if not given")
+    parser.add_argument("--batch", type=int, default=1000, help="rows per fetch or per statement")
+    parser.add_argument("--resume", action="store_true", help="continue from checkpoint")
+    parser.add_argument("--method", choices=["auto", "insert", "load_data"], default="auto")
+    parser.add_argument("--on-duplicate", choices=sorted(ON_DUPLICATE), default="ignore")
+    parser.add_argument("--quiet", action="store_true", help="no progress output")
+    args = parser.parse_args()
+
+    with open(args.config, "r") as file:
+        config = json.loads(file.read())
+    # dumps read a consistent primary, imports write to it
+    config.pop("replicas", None)
+    config.pop("read_your_writes", None)
+    config["cursorclass"] = pymysql.cursors.DictCursor
+    if args.method == "load_data":
+        config["local_infile"] = True
+    Riko.db_config = config
+
+    bulk = Bulk(
+        MODELS[args.model],
+        batch_size=args.batch,
+        progress=None if args.quiet else report,
+    )
+    if args.action == "export":
+        rows = bulk.export(args.file, fmt=args.format, resume=args.resume)
+    else:
+        rows = bulk.import_file(
+            args.file,
+            fmt=args.format,
+            on_duplicate_key_replace=ON_DUPLICATE[args.on_duplicate],
+            method=args.method,
+            resume=args.resume,
+        )
+    if not args.quiet:
+        sys.stderr.write("\n")
+    print("%s %d rows of %s" % (args.action, rows, args.model))
+
+
+if __name__ == "__main__":
+    main()
@@ -3,11 +3,31 @@ Project Riko
 Riko is a simple and light ORM for MySQL.
 DB Engine default to be pymysql, since not thread safe.
 """
+import array
+import asyncio
+import collections
+import concurrent.futures
 import contextlib
+import copy
+import csv
+import functools
+import io
+import itertools
+import json
 import logging
+import os
+import re
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+import weakref
 from abc import ABCMeta, abstractmethod
 from datetime import date, datetime as dt
+from decimal import Decimal
 import pymysql
+from pymysql.constants import CLIENT, FIELD_TYPE, SERVER_STATUS
 
 
 class INSERT:
@@ -24,6 +44,239 @@ class JOIN:
     RIGHT_JOIN = 3
 
 
+class QueryEvent:
+    """
+    A statement executed by `DBI`, given to `QueryHook` callbacks.
+    `duration`, `rows` and `error` are set before `after` is called.
+    """
+
+    __slots__ = (
+        "sql",
+        "args_count",
+        "connect_time",
+        "ping_time",
+        "duration",
+        "rows",
+        "error",
+        "template",
+        "_shape",
+    )
+
+    def __init__(self, sql, args_count, connect_time=0.0, ping_time=0.0, template=None):
+        self.sql = sql
+        # statement before values are rendered into it, None if `sql` is the template itself
+        self.template = template
+        self.args_count = args_count
+        # seconds spent to get the connection (connect, pool waiting and ping), only set on its first statement
+        self.connect_time = connect_time
+        # seconds spent to ping the connection before this statement
+        self.ping_time = ping_time
+        self.duration = None
+        self.rows = None
+        self.error = None
+        self._shape = None
+
+    @property
+    def shape(self):
+        """
+        Statement with values, placeholders and repeated value lists folded, see `QueryEvent.shape_of`.
+        """
+        if self._shape is None:
+            self._shape = QueryEvent.shape_of(self.sql if self.template is None else self.template)
+        return self._shape
+
+    # Statements longer than this are folded without caching, since they carry rendered values,
+    # and shapes longer than this are cut
+    SHAPE_MAX_LEN = 2048
+
+    _SHAPE_TOKEN = re.compile(
+        r"'(?:[^'\\]|\\.|'')*'|%\([^)]*\)s|%s|\b\d+(?:\.\d+)?\b|\s+"
+    )
+    _SHAPE_LIST = re.compile(r"\(\?(?: ?, ?\?)*\)(?: ?, ?\(\?(?: ?, ?\?)*\))+")
+    _SHAPE_IN = re.compile(r"\bIN ?\(\?(?: ?, ?\?)+\)", re.IGNORECASE)
+    _SHAPE_CASE = re.compile(r"(WHEN \? THEN \? )(?:WHEN \? THEN \? )+", re.IGNORECASE)
+
+    @staticmethod
+    def shape_of(sql):
+        """
+        Fold a statement into its shape, like `SELECT * FROM t WHERE a = ? AND b IN (...)`,
+        so that statements differ only in values are counted together.
+        :param sql: statement
+        :return: shape string, at most `SHAPE_MAX_LEN` characters before " ..."
+        """
+        if len(sql) > QueryEvent.SHAPE_MAX_LEN:
+            return QueryEvent._fold(sql)
+        return QueryEvent._fold_cached(sql)
+
+    @staticmethod
+    @functools.lru_cache(maxsize=1024)
+    def _fold_cached(sql):
+        return QueryEvent._fold(sql)
+
+    @staticmethod
+    def _fold(sql):
+        shape = QueryEvent._SHAPE_TOKEN.sub(
+            lambda m: " " if m.group(0).isspace() else "?", sql
+        ).strip()
+        shape = QueryEvent._SHAPE_LIST.sub(lambda m: m.group(0).split(")")[0] + "), ...", shape)
+        shape = QueryEvent._SHAPE_IN.sub("IN (...)", shape)
+        shape = QueryEvent._SHAPE_CASE.sub(r"\1... ", shape)
+        if len(shape) > QueryEvent.SHAPE_MAX_LEN:
+            shape = shape[: QueryEvent.SHAPE_MAX_LEN] + " ..."
+        return shape
+
+
+class QueryHook:
+    """
+    Base of statement callbacks, register by `Riko.add_hook`.
+    Callbacks run in the thread executing the statement, keep them fast.
+    """
+
+    def before(self, event):
+        """
+        Called before a statement is sent.
+        :param event: a QueryEvent object
+        """
+        pass
+
+    def after(self, event):
+        """
+        Called after a statement finished or failed.
+        :param event: a QueryEvent object
+        """
+        pass
+
+
+class QueryStats(QueryHook):
+    """
+    Rolling latency histogram per statement shape.
+    Count, total time, errors and rows are kept since last `clear`,
+    latency percentiles and buckets are computed from the latest `window` samples of each shape.
+    """
+
+    # Upper bounds in milliseconds of histogram buckets
+    BUCKETS = (1, 5, 10, 50, 100, 500, 1000, 5000)
+
+    def __init__(self, window=512, max_shapes=512):
+        self._window = window
+        self._max_shapes = max_shapes
+        self._shapes = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def after(self, event):
+        shape = event.shape
+        with self._lock:
+            entry = self._shapes.get(shape)
+            if entry is None:
+                if len(self._shapes) >= self._max_shapes:
+                    self._shapes.popitem(last=False)
+                entry = self._shapes[shape] = {
+                    "count": 0,
+                    "errors": 0,
+                    "rows": 0,
+                    "total": 0.0,
+                    "max": 0.0,
+                    "connect": 0.0,
+                    "ping": 0.0,
+                    "samples": collections.deque(maxlen=self._window),
+                }
+            else:
+                self._shapes.move_to_end(shape)
+            entry["count"] += 1
+            if event.error is not None:
+                entry["errors"] += 1
+            if event.rows is not None and event.rows > 0:
+                entry["rows"] += event.rows
+            entry["total"] += event.duration
+            entry["connect"] += event.connect_time
+            entry["ping"] += event.ping_time
+            if event.duration > entry["max"]:
+                entry["max"] = event.duration
+            entry["samples"].append(event.duration)
+
+    def snapshot(self):
+        """
+        Get statistics of each statement shape, slowest in total first. Times are in milliseconds.
+        :return: a dict of shape to statistics dict
+        """
+        with self._lock:
+            entries = [
+                (shape, dict(entry, samples=sorted(entry["samples"])))
+                for (shape, entry) in self._shapes.items()
+            ]
+        entries.sort(key=lambda x: x[1]["total"], reverse=True)
+        snapshot = collections.OrderedDict()
+        for (shape, entry) in entries:
+            samples = entry.pop("samples")
+            buckets = collections.OrderedDict((b, 0) for b in QueryStats.BUCKETS)
+            buckets["inf"] = 0
+            for sample in samples:
+                ms = sample * 1000
+                for b in QueryStats.BUCKETS:
+                    if ms <= b:
+                        buckets[b] += 1
+                        break
+                else:
+                    buckets["inf"] += 1
+            snapshot[shape] = {
+                "count": entry["count"],
+                "errors": entry["errors"],
+                "rows": entry["rows"],
+                "total_ms": entry["total"] * 1000,
+                "avg_ms": entry["total"] * 1000 / entry["count"],
+                "max_ms": entry["max"] * 1000,
+                "connect_ms": entry["connect"] * 1000,
+                "ping_ms": entry["ping"] * 1000,
+                "p50_ms": QueryStats._percentile(samples, 0.5) * 1000,
+                "p95_ms": QueryStats._percentile(samples, 0.95) * 1000,
+                "p99_ms": QueryStats._percentile(samples, 0.99) * 1000,
+                "histogram": buckets,
+            }
+        return snapshot
+
+    def clear(self):
+        """
+        Drop all statistics.
+        """
+        with self._lock:
+            self._shapes.clear()
+
+    @staticmethod
+    def _percentile(samples, q):
+        if len(samples) == 0:
+            return 0.0
+        return samples[min(len(samples) - 1, int(q * len(samples)))]
+
+
+class SlowQueryLog(QueryHook):
+    """
+    Log statements slower than a threshold to logger `ORM_QUERY` in WARNING level.
+    Statement shape is logged instead of the statement, so that values are not leaked into logs.
+    """
+
+    def __init__(self, threshold=1.0, logger=None):
+        """
+        :param threshold: seconds, None to disable
+        :param logger: logger to write, None to use `ORM_QUERY`
+        """
+        self.threshold = threshold
+        self._logger = logging.getLogger("ORM_QUERY") if logger is None else logger
+
+    def after(self, event):
+        if self.threshold is None or event.duration < self.threshold:
+            return
+        self._logger.warning(
+            "slow query %.1fms (connect %.1fms, ping %.1fms), %s args, %s rows%s: %s",
+            event.duration * 1000,
+            event.connect_time * 1000,
+            event.ping_time * 1000,
+            event.args_count,
+            event.rows,
+            "" if event.error is None else ", failed by " + repr(event.error),
+            event.shape,
+        )
+
+
 class Riko:
     """
     Define default database config here
@@ -38,6 +291,40 @@ class Riko:
         "autocommit": True,
     }
 
+    """
+    Define default connection pool config here, see `DBIPool` for meaning of each term
+    """
+
+    pool_config = {
+        "max_size": 10,
+        "max_idle": None,
+        "ping_interval": 30,
+        "timeout": None,
+    }
+
+    # Set False to open a new connection for every query, as old Riko did
+    use_pool = True
+
+    # Worker number of the executor running awaitable queries, None to follow pool `max_size`
+    executor_workers = None
+
+    # Built-in statement hooks, see `Riko.stats` and `SlowQueryLog`
+    query_stats = QueryStats()
+    slow_query_log = SlowQueryLog(threshold=1.0)
+
+    # Callbacks of every statement executed by `DBI`, see `QueryHook`
+    hooks = [query_stats, slow_query_log]
+
+    # Seconds a thread keeps reading from primary after writing to it, see `set_replicas`
+    read_your_writes = 1.0
+
+    _pools = dict()
+    _pools_lock = threading.Lock()
+    _executor = None
+    _replicas = dict()
+    _replica_turn = itertools.count()
+    _local = threading.local()
+
     @staticmethod
     def set_default(db_config):
         """
@@ -54,16 +341,361 @@ class Riko:
         """
         Riko.db_config.update(db_config)
 
+    @staticmethod
+    def set_pool_config(**pool_config):
+        """
+        Update connection pool config, only affect pools created after this call.
+        :param pool_config: terms for update pool config dict
+        """
+        Riko.pool_config.update(pool_config)
+
+    @staticmethod
+    def get_pool(db_config=None):
+        """
+        Get the shared connection pool of a db config, create it if not exists.
+        :param db_config: DB connection config, None to use default `Riko.db_config`
+        :return: a DBIPool object
+        """
+        if db_config is None:
+            db_config = Riko.db_config
+        pool_key = Riko._pool_key(db_config)
+        with Riko._pools_lock:
+            pool = Riko._pools.get(pool_key)
+            if pool is None:
+                pool = DBIPool(dict(db_config), **Riko.pool_config)
+                Riko._pools[pool_key] = pool
+        return pool
+
+    @staticmethod
+    def set_replicas(replica_configs, db_config=None, read_your_writes=None):
+        """
+        Set read replicas of a primary DB, select queries without `for_update` are sent to them in turn,
+        while writes, transactions and sessions stay on the primary, see `SelectQuery.from_primary`.
+        :param replica_configs: list of replica db config, terms not given follow the primary, like `[{"host": "replica1"}]`,
+                                empty to read from primary only
+        :param db_config: config of the primary DB, None to use default `Riko.db_config`
+        :param read_your_writes: seconds a thread keeps reading from primary after writing to it, 0 to disable,
+                                 None to keep current `Riko.read_your_writes`
+        """
+        if db_config is None:
+            db_config = Riko.db_config
+        replicas = [dict(db_config, **conf) for conf in replica_configs]
+        with Riko._pools_lock:
+            if len(replicas) > 0:
+                Riko._replicas[Riko._pool_key(db_config)] = replicas
+            else:
+                Riko._replicas.pop(Riko._pool_key(db_config), None)
+        if read_your_writes is not None:
+            Riko.read_your_writes = read_your_writes
+
+    @staticmethod
+    def read_config(db_config=None):
+        """
+        Get the db config to read from, a replica in turn, or the primary itself if it has no replica,
+        a session of it is open in this thread, or this thread wrote to it in `read_your_writes` seconds.
+        :param db_config: config of the primary DB, None to use default `Riko.db_config`
+        :return: a db config
+        """
+        if db_config is None:
+            db_config = Riko.db_config
+        if not Riko._replicas:
+            return db_config
+        key = Riko._pool_key(db_config)
+        replicas = Riko._replicas.get(key)
+        if not replicas or Session.current(db_config) is not None:
+            return db_config
+        written = getattr(Riko._local, "written", None)
+        if written is not None and key in written:
+            if time.monotonic() - written[key] < Riko.read_your_writes:
+                return db_config
+            del written[key]
+        return replicas[next(Riko._replica_turn) % len(replicas)]
+
+    @staticmethod
+    def mark_write(db_config=None):
+        """
+        Record that this thread wrote to a primary DB, to read from it for `read_your_writes` seconds.
+        Writes by model and query methods are recorded by themselves.
+        :param db_config: config of the primary DB, None to use default `Riko.db_config`
+        """
+        if not Riko._replicas or Riko.read_your_writes <= 0:
+            return
+        if db_config is None:
+            db_config = Riko.db_config
+        key = Riko._pool_key(db_config)
+        if key not in Riko._replicas:
+            return
+        written = getattr(Riko._local, "written", None)
+        if written is None:
+            written = Riko._local.written = dict()
+        written[key] = time.monotonic()
+
+    @staticmethod
+    def pool_stats():
+        """
+        Get statistics of all connection pools.
+        :return: a dict of `user@host:port/database` to pool statistics dict
+        """
+        with Riko._pools_lock:
+            pools = list(Riko._pools.values())
+        return {p.name: p.stats() for p in pools}
+
+    @staticmethod
+    def close_pools():
+        """
+        Close all connection pools and their idle connections.
+        """
+        with Riko._pools_lock:
+            pools = list(Riko._pools.values())
+            Riko._pools.clear()
+        for p in pools:
+            p.close()
+
+    @staticmethod
+    def add_hook(hook):
+        """
+        Register a statement hook.
+        :param hook: a QueryHook object
+        """
+        Riko.hooks = Riko.hooks + [hook]
+
+    @staticmethod
+    def remove_hook(hook):
+        """
+        Unregister a statement hook.
+        :param hook: a QueryHook object registered by `add_hook`
+        """
+        Riko.hooks = [h for h in Riko.hooks if h is not hook]
+
+    @staticmethod
+    def stats():
+        """
+        Get a snapshot of statement statistics, connection pools and caches, for dumping.
+        :return: a dict of statistics
+        """
+        return {
+            "queries": Riko.query_stats.snapshot(),
+            "pools": Riko.pool_stats(),
+            "sql_cache": SqlQuery.sql_cache.stats(),
+            "result_cache": SqlQuery.result_cache.stats(),
+        }
+
+    @staticmethod
+    def get_executor():
+        """
+        Get the shared executor running blocking DB calls of awaitable queries, create it if not exists.
+        Awaitable queries borrow pooled connections in the event loop before running here, see `DBIPool.adbi`,
+        so that threads of it never wait for a connection held by a suspended coroutine.
+        :return: a ThreadPoolExecutor object
+        """
+        with Riko._pools_lock:
+            if Riko._executor is None:
+                workers = Riko.executor_workers
+                if workers is None:
+                    workers = Riko.pool_config["max_size"]
+                Riko._executor = concurrent.futures.ThreadPoolExecutor(
+                    max_workers=workers, thread_name_prefix="riko"
+                )
+            return Riko._executor
+
+    @staticmethod
+    def shutdown_executor(wait=True):
+        """
+        Shut down the executor of awaitable queries, a new one is created when needed again.
+        :param wait: True to wait for running calls to finish
+        """
+        with Riko._pools_lock:
+            executor = Riko._executor
+            Riko._executor = None
+        if executor is not None:
+            executor.shutdown(wait=wait)
+
+    @staticmethod
+    async def run_async(func, *args, **kwargs):
+        """
+        Run a blocking call on the executor of `get_executor` and await its result.
+        :param func: callable to run
+        :param args: positional arguments of `func`
+        :param kwargs: keyword arguments of `func`
+        :return: return value of `func`
+        """
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            Riko.get_executor(), functools.partial(func, *args, **kwargs)
+        )
+
+    @staticmethod
+    @contextlib.contextmanager
+    def session(db_config=None):
+        """
+        Open a unit of work in a context scope, see `Session`.
+        Model writes in this thread are queued and flushed in one transaction when the scope exits,
+        or dropped if it exits by exception. A nested scope of the same db config joins the outer one.
+        :param db_config: DB connection config, None to use default `Riko.db_config`
+        """
+        outer = Session.current(db_config)
+        if outer is not None:
+            yield outer
+            return
+        session = Session(db_config)
+        Session._push(session)
+        try:
+            yield session
+        except BaseException:
+            session.discard()
+            raise
+        finally:
+            Session._pop(session)
+        try:
+            session.flush()
+        except BaseException:
+            session.discard()
+            raise
+
+    @staticmethod
+    @contextlib.contextmanager
+    def transaction(db_config=None):
+        """
+        Run queries given `t=dbi` as one transaction in a context scope, committed when the scope exits
+        or rolled back if it exits by exception.
+        Unlike `session`, statements are executed at once, so that locks of `for_update` are held until commit.
+        :param db_config: DB connection config, None to use default `Riko.db_config`
+        :return: a DBI object to build queries on
+        """
+        if db_config is None:
+            db_config = Riko.db_config
+        dbi = Riko.get_pool(db_config).dbi() if Riko.use_pool else DBI(db_config)
+        try:
+            with dbi.start_transaction():
+                yield dbi
+        finally:
+            dbi.close()
+
+    @staticmethod
+    @contextlib.contextmanager
+    def batch_load(db_config=None):
+        """
+        Batch primary key lookups in this thread in a context scope, see `BatchLoader`.
+        `Model.load` requests are collected and loaded by one `IN` query per model when a result is needed.
+        A nested scope of the same db config joins the outer one.
+        :param db_config: DB connection config, None to use default `Riko.db_config`
+        """
+        outer = BatchLoader.current(db_config)
+        if outer is not None:
+            yield outer
+            return
+        loader = BatchLoader(db_config)
+        BatchLoader._push(loader)
+        try:
+            yield loader
+        finally:
+            BatchLoader._pop(loader)
+
+    @staticmethod
+    @contextlib.contextmanager
+    def pipeline(db_config=None, max_bytes=None):
+        """
+        Borrow a connection and collect statements on it in a context scope, see `DBI.pipeline`.
+        MySQL connections are taken from a dedicated pool opened with `CLIENT.MULTI_STATEMENTS`,
+        so other queries never run on a connection accepting stacked statements.
+        :param db_config: DB connection config, None to use default `Riko.db_config`
+        :param max_bytes: max bytes sent by one round trip, None to follow server `max_allowed_packet`
+        """
+        if db_config is None:
+            db_config = Riko.db_config
+        if Driver.of(db_config).name == "mysql":
+            db_config = dict(db_config, client_flag=db_config.get("client_flag", 0) | CLIENT.MULTI_STATEMENTS)
+        dbi = Riko.get_pool(db_config).dbi() if Riko.use_pool else DBI(db_config)
+        try:
+            with dbi.pipeline(max_bytes) as pipe:
+                yield pipe
+        finally:
+            dbi.close()
+
+    @staticmethod
+    def _pool_key(db_config):
+        return tuple(sorted((k, repr(v)) for (k, v) in db_config.items()))
+
+
+class ModelMeta(ABCMeta):
+    """
+    Metaclass of ORM models, compile column metadata once per model class instead of per object:
+    `_columns` tuple, `_column_set`, `_column_index` map and `_field_names` tuple,
+    `_deferred_set` of deferred columns, and generate `__slots__` for models declaring their `fields`.
+    """
+
+    def __new__(mcs, name, bases, namespace, **kwargs):
+        pk = namespace.get("pk", ModelMeta._inherited(bases, "pk", ()))
+        fields = namespace.get("fields", ModelMeta._inherited(bases, "fields", None))
+        columns = None
+        if fields is not None:
+            # keep declaring order, drop duplicated names
+            columns = tuple(dict.fromkeys(tuple(pk) + tuple(fields)))
+        use_slots = namespace.get(
+            "use_slots", ModelMeta._inherited(bases, "use_slots", False)
+        )
+        if use_slots and columns is not None and "__slots__" not in namespace:
+            if any(issubclass(b, dict) for b in bases):
+                # values live in dict itself
+                namespace["__slots__"] = ()
+            else:
+                existing_slots = set()
+                for b in bases:
+                    for klass in b.__mro__:
+                        existing_slots.update(klass.__dict__.get("__slots__", ()))
+                column_defaults = dict(
+                    ModelMeta._inherited(bases, "_column_defaults", None) or {}
+                )
+                new_slots = list()
+                for k in columns:
+                    if k not in existing_slots:
+                        new_slots.append(k)
+                        # class variable conflicts with slot, keep it as default value
+                        if k in namespace:
+                            column_defaults[k] = namespace.pop(k)
+                namespace["__slots__"] = tuple(new_slots)
+                namespace["_column_defaults"] = column_defaults
+        clz = super().__new__(mcs, name, bases, namespace, **kwargs)
+        clz._columns = columns
+        if columns is not None:
+            clz._column_set = frozenset(columns)
+            clz._column_index = {k: i for (i, k) in enumerate(columns)}
+            clz._field_names = tuple(k for k in columns if k not in pk)
+            # primary keys are never deferred, they identify rows to load deferred columns
+            clz._deferred_set = frozenset(
+                k for k in getattr(clz, "deferred", ()) if k in clz._column_set and k not in pk
+            )
+        return clz
+
+    @staticmethod
+    def _inherited(bases, attr, default):
+        for b in bases:
+            if hasattr(b, attr):
+                return getattr(b, attr)
+        return default
 
-class AbstractModel(metaclass=ABCMeta):
-    __metaclass__ = ABCMeta
+
+class AbstractModel(metaclass=ModelMeta):
+    __metaclass__ = ModelMeta
 
     """
     Abstract ORM model.
     DO NOT inherit this, inherit `DictModel` or `ObjectModel` instead.
     """
+    __slots__ = ()
+
     _abstract_inner_var = {"db_config_", "dbi"}
 
+    # Generate `__slots__` for subclass declaring `fields`, set False to allow arbitrary attributes
+    use_slots = True
+
+    # Compiled by `ModelMeta`, None if `fields` is not declared
+    _columns = None
+    _column_set = None
+    _column_index = None
+    _field_names = None
+    _deferred_set = frozenset()
+
     # Config
     _DB_CONF = None
 
@@ -76,11 +708,28 @@ class AbstractModel(metaclass=ABCMeta):
     # Update ignore column
     auto_update_ignore = None
 
+    # Seconds to cache select result of this model, None to disable, see `SelectQuery.cache`
+    cache_ttl = None
+
+    # False to read this model from primary only even if replicas are set, see `Riko.set_replicas`
+    read_replica = True
+
+    # Columns left out when selecting objects and loaded on first access, like large text columns,
+    # see `DeferredColumns` and `SelectQuery.undefer`
+    deferred = ()
+
+    # Secondary indexes, list of column name tuples like `[("status",), ("username", "status")]`, see `SchemaSync`
+    indexes = ()
+
     def __init__(self, _db_config=None):
         """
         Create a Riko model object.
         :param _db_config: database to mapping
         """
+        # columns changed since loaded from or saved to DB
+        self._dirty = set()
+        # loader of deferred columns not loaded yet, see `DeferredColumns`
+        self._deferred_load = None
         if _db_config is None:
             _db_config = self._DB_CONF
         self.db_config_ = Riko.db_config if _db_config is None else _db_config
@@ -103,20 +752,65 @@ class AbstractModel(metaclass=ABCMeta):
         :param terms: dict for parsing to the model object
         :return: parsed object in `cls` type
         """
+        if _datetime_dump:
+            codec = RowCodec.from_values(terms)
+            if codec is not None:
+                codec.convert(terms)
+        return cls._from_row(db_conf, terms)
+
+    @classmethod
+    def _from_row(cls, db_conf, row):
+        # values of fetched rows are already converted by `RowCodec`
         try:
             des_obj = cls(_db_config=db_conf)
         except Exception as ce:
             des_obj = cls()
-        if terms is not None:
-            for (k, v) in terms.items():
-                if _datetime_dump:
-                    if isinstance(v, dt):
-                        v = v.strftime("%Y-%m-%d %H:%M:%S")
-                    elif isinstance(v, date):
-                        v = v.strftime("%Y-%m-%d")
+        if row is not None:
+            for (k, v) in row.items():
                 des_obj.set_value(k, v)
+        des_obj.mark_clean()
         return des_obj
 
+    @classmethod
+    def _check_columns(cls, row):
+        if not cls._column_set.issuperset(row):
+            for k in row:
+                if k not in cls._column_set:
+                    raise Exception("Miss match column in Model: " + k)
+
+    def dirty_columns(self):
+        """
+        Get columns changed since this object is loaded from or saved to DB.
+        :return: a set of column names
+        """
+        return set(self._dirty)
+
+    def mark_clean(self):
+        """
+        Forget changes of this object, as if it has just been loaded from DB.
+        """
+        self._dirty.clear()
+
+    def load_deferred(self):
+        """
+        Load deferred columns of this object now, with other objects selected together, see `DeferredColumns`.
+        """
+        loader = getattr(self, "_deferred_load", None)
+        if loader is not None:
+            loader.load(self)
+
+    def _forget_columns(self, columns):
+        """
+        Unset columns to be loaded later, for internal use.
+        """
+        pass
+
+    def _fill_columns(self, row, columns):
+        """
+        Set loaded values of columns not changed meanwhile, for internal use.
+        """
+        pass
+
     def columns(self):
         """
         Get a iterator for columns in this model.
@@ -139,6 +833,19 @@ class AbstractModel(metaclass=ABCMeta):
         """
         return cls.pk
 
+    @classmethod
+    def get_indexes(cls):
+        """
+        Get declared secondary indexes of this model.
+        :return: list of (index name, column name tuple)
+        """
+        declared = list()
+        for columns in cls.indexes:
+            columns = tuple(columns) if type(columns) in (list, tuple) else (str(columns),)
+            # MySQL limits identifier length to 64
+            declared.append((("idx_" + "_".join(columns))[:64], columns))
+        return declared
+
     @abstractmethod
     def get_ak(self):
         """
@@ -236,8 +943,14 @@ class AbstractModel(metaclass=ABCMeta):
         :param t transaction connection object
         :param on_duplicate_key_replace: operation when primary key duplicated
         :param duplicate_key_update_term: terms for `ON DUPLICATE KEY UPDATE`
-        :return: if `ak` is declared, return inserted auto increment id, otherwise return affected row count
+        :return: if `ak` is declared, return inserted auto increment id, otherwise return affected row count,
+                 None if queued by a session, see `Riko.session`
         """
+        if t is None:
+            session = Session.current(self.db_config_)
+            if session is not None:
+                session.add(self, on_duplicate_key_replace, **duplicate_key_update_term)
+                return None
         insert_dict = dict()
         if type(self) is dict:
             insert_dict = self
@@ -268,14 +981,20 @@ class AbstractModel(metaclass=ABCMeta):
         )
         if auto_key is not None and self.get_ak() is None:
             self.set_ak(re_affect_id)
+        self.mark_clean()
         return re_affect_id
 
     def delete(self, t=None):
         """
         Delete this object from DB.
         :param t transaction connection object
-        :return: affected row count
+        :return: affected row count, None if queued by a session
         """
+        if t is None:
+            session = Session.current(self.db_config_)
+            if session is not None:
+                session.delete(self)
+                return None
         return (
             DeleteQuery(self.__class__)
             .set_session(model_db_conf=self._DB_CONF, dbi=t)
@@ -283,22 +1002,31 @@ class AbstractModel(metaclass=ABCMeta):
             .go()
         )
 
-    def update(self, ignore_columns=None, t=None):
+    def update(self, ignore_columns=None, t=None, full=False):
         """
         Flush the change of this object to DB. Alias for `save`.
         :param ignore_columns: the columns to be ignore when update, such as `update_time`
         :param t transaction connection object
+        :param full: True to write all columns, False to write changed columns only
         :return: affected row count
         """
-        return self.save(ignore_columns=ignore_columns, t=t)
+        return self.save(ignore_columns=ignore_columns, t=t, full=full)
 
-    def save(self, ignore_columns=None, t=None):
+    def save(self, ignore_columns=None, t=None, full=False):
         """
         Flush the change of this object to DB.
+        Only columns changed since loaded or last saved are written unless `full` is set,
+        nothing is sent to DB if there is no change.
         :param ignore_columns: the columns to be ignore when update, such as `update_time`
         :param t transaction connection object
-        :return: affected row count
+        :param full: True to write all columns, False to write changed columns only
+        :return: affected row count, None if queued by a session
         """
+        if t is None:
+            session = Session.current(self.db_config_)
+            if session is not None:
+                session.save(self, ignore_columns=ignore_columns, full=full)
+                return None
         update_field_dict = dict()
         # TODO primary key may be update but cannot handle now
         if ignore_columns is None:
@@ -309,15 +1037,55 @@ class AbstractModel(metaclass=ABCMeta):
         if self.auto_update_ignore is not None:
             ignore_columns.update(set(self.auto_update_ignore))
         for k in self.columns():
-            if k not in ignore_columns:
+            if k not in ignore_columns and (full or k in self._dirty):
                 update_field_dict[k] = self.get_value(k)
-        return (
+        if len(update_field_dict) == 0:
+            return 0
+        affected = (
             UpdateQuery(self.__class__)
             .set_session(model_db_conf=self._DB_CONF, dbi=t)
             .set(**update_field_dict)
             .where(**self.get_pk())
             .go()
         )
+        self.mark_clean()
+        return affected
+
+    @classmethod
+    def patch(cls, pk, t=None, **changes):
+        """
+        Update fields of a record by primary key, without loading it first.
+        :param pk: primary key value, or a dict of primary key values for composite primary key
+        :param t: connection context, None to use default
+        :param changes: key-value pair of fields to update, like `status=1`
+        :return: affected row count, None if queued by a session
+        """
+        if not isinstance(pk, dict):
+            pk_names = cls.get_pk_name()
+            assert len(pk_names) == 1
+            pk = {pk_names[0]: pk}
+        if len(changes) == 0:
+            return 0
+        if t is None:
+            session = Session.current(cls._DB_CONF)
+            if session is not None:
+                session.patch(cls, pk, **changes)
+                return None
+        return cls.update_query(t=t).set(**changes).where(**pk).go()
+
+    @classmethod
+    def update_many(cls, key, rows, t=None, chunk_size=500):
+        """
+        Update multiple records with their own values by few statements, see `UpdateQuery.many`.
+        :param key: unique field to match records, like "tid"
+        :param rows: list of dict with `key` and fields to update, like [{"tid": 1, "status": 1}, ...]
+        :param t: connection context, None to use default
+        :param chunk_size: max record number updated by one statement
+        :return: total affected row count
+        """
+        if len(rows) == 0:
+            return 0
+        return cls.update_query(t=t).many(key, rows, chunk_size=chunk_size).go()
 
     @classmethod
     def count(cls, t=None, _where_raw=None, _args=None, **_where_terms):
@@ -512,6 +1280,28 @@ class AbstractModel(metaclass=ABCMeta):
             .get(args=_args, _datetime_dump=_datetime_dump, parse_model=_parse_model)
         )
 
+    @classmethod
+    def load(cls, pk):
+        """
+        Request an object by primary key, batched with other requests of the `Riko.batch_load` scope,
+        or loaded alone if no scope is open.
+        :param pk: primary key value, or a dict of primary key values for composite primary key
+        :return: a LoadResult object, its `value` is the ORM model object or None if not found
+        """
+        loader = BatchLoader.current(cls._DB_CONF)
+        if loader is None:
+            loader = BatchLoader(cls._DB_CONF, cache=False)
+        return loader.load(cls, pk)
+
+    @classmethod
+    async def aload(cls, pk):
+        """
+        Load an object by primary key, requests made in the same event loop tick are loaded by one `IN` query.
+        :param pk: primary key value, or a dict of primary key values for composite primary key
+        :return: a ORM model object, or None if not found
+        """
+        return await BatchLoader.for_loop(cls._DB_CONF).aload(cls, pk)
+
     @classmethod
     def get_one(
         cls,
@@ -547,49 +1337,243 @@ class AbstractModel(metaclass=ABCMeta):
         )
 
 
-class SqlQuery(metaclass=ABCMeta):
-    __metaclass__ = ABCMeta
+class SqlCache:
+    """
+    LRU cache of rendered SQL keyed on query shape, shared by all queries.
+    """
 
-    _KW_TABLE = "{{__RIKO_TABLE__}}"
-    _KW_INSERT_REPLACE = "{{__RIKO_INSERT_REPLACE__}}"
-    _KW_FIELDS = "{{__RIKO_FIELDS__}}"
-    _KW_VALUES = "{{__RIKO_VALUES__}}"
-    _KW_ON_DUPLICATE_KEY_UPDATE = "{{__RIKO_DUPLICATE_KEY__}}"
-    _KW_JOIN = "{{__RIKO_JOIN__}}"
-    _KW_WHERE = "{{__RIKO_WHERE__}}"
-    _KW_DISTINCT = "{{__RIKO_DISTINCT__}}"
-    _KW_GROUP_BY = "{{__RIKO_GROUP_BY__}}"
-    _KW_HAVING = "{{__RIKO_HAVING__}}"
-    _KW_ORDER_BY = "{{__RIKO_ORDER_BY__}}"
-    _KW_LIMIT = "{{__RIKO_LIMIT__}}"
-    _KW_OFFSET = "{{__RIKO_OFFSET__}}"
-    _KW_FORUPDATE = "{{__RIKO_FOR_UPDATE__}}"
+    def __init__(self, max_size=1024):
+        self._max_size = max_size
+        self._store = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
 
-    _Insert_Template = """
-{{__RIKO_INSERT_REPLACE__}} INTO {{__RIKO_TABLE__}}({{__RIKO_FIELDS__}})
-VALUES ({{__RIKO_VALUES__}})
-{{__RIKO_DUPLICATE_KEY__}}
-"""
-    _Delete_Template = """
-DELETE FROM {{__RIKO_TABLE__}}
-{{__RIKO_WHERE__}}
-"""
+    def get(self, shape):
+        """
+        Get cached SQL of a query shape.
+        :param shape: hashable query shape, see `SqlQuery._shape`
+        :return: SQL string, or None if not cached
+        """
+        if shape is None:
+            return None
+        try:
+            with self._lock:
+                sql = self._store.get(shape)
+                if sql is None:
+                    self._misses += 1
+                else:
+                    self._hits += 1
+                    self._store.move_to_end(shape)
+                return sql
+        except TypeError:
+            # unhashable argument in shape, like a list given to `limit`
+            return None
 
-    _Update_Template = """
-UPDATE {{__RIKO_TABLE__}}
-SET {{__RIKO_FIELDS__}}
-{{__RIKO_WHERE__}}
-"""
-    _Select_Template = """
-SELECT {{__RIKO_DISTINCT__}} {{__RIKO_FIELDS__}}
-FROM {{__RIKO_TABLE__}}
-{{__RIKO_JOIN__}}
-{{__RIKO_WHERE__}}
-{{__RIKO_GROUP_BY__}}
-{{__RIKO_HAVING__}}
-{{__RIKO_ORDER_BY__}}
-{{__RIKO_LIMIT__}}
-{{__RIKO_OFFSET__}}
+    def put(self, shape, sql):
+        """
+        Cache SQL of a query shape.
+        :param shape: hashable query shape, see `SqlQuery._shape`
+        :param sql: rendered SQL string
+        """
+        if shape is None or self._max_size <= 0:
+            return
+        try:
+            with self._lock:
+                self._store[shape] = sql
+                self._store.move_to_end(shape)
+                while len(self._store) > self._max_size:
+                    self._store.popitem(last=False)
+        except TypeError:
+            pass
+
+    def resize(self, max_size):
+        """
+        Set max number of cached SQL, 0 to disable caching.
+        :param max_size: max number of cached SQL
+        """
+        with self._lock:
+            self._max_size = max_size
+            while len(self._store) > max(max_size, 0):
+                self._store.popitem(last=False)
+
+    def clear(self):
+        """
+        Drop all cached SQL and reset counters.
+        """
+        with self._lock:
+            self._store.clear()
+            self._hits = 0
+            self._misses = 0
+
+    def stats(self):
+        """
+        Get statistics of this cache.
+        :return: a dict of cache statistics
+        """
+        with self._lock:
+            return {
+                "max_size": self._max_size,
+                "size": len(self._store),
+                "hits": self._hits,
+                "misses": self._misses,
+            }
+
+
+class ResultCache:
+    """
+    LRU cache of query results with TTL, shared by all queries.
+    Results are invalidated by table, any write through Riko bumps the generation of its table.
+    """
+
+    def __init__(self, max_size=256):
+        self._max_size = max_size
+        self._store = collections.OrderedDict()
+        self._generations = collections.Counter()
+        self._lock = threading.Lock()
+        self._stats = collections.Counter()
+
+    def generations(self, tables):
+        """
+        Get current generations of tables, take it before querying and give it to `put`.
+        :param tables: tuple of table names
+        :return: tuple of generation numbers
+        """
+        with self._lock:
+            return tuple(self._generations[t] for t in tables)
+
+    def get(self, key):
+        """
+        Get a copy of cached result.
+        :param key: hashable cache key
+        :return: list of dict rows, or None if not cached, expired or invalidated
+        """
+        with self._lock:
+            entry = self._store.get(key)
+            if entry is None:
+                self._stats["misses"] += 1
+                return None
+            (expire_at, tables, generations, rows) = entry
+            if time.monotonic() >= expire_at:
+                del self._store[key]
+                self._stats["expired"] += 1
+                self._stats["misses"] += 1
+                return None
+            if tuple(self._generations[t] for t in tables) != generations:
+                del self._store[key]
+                self._stats["misses"] += 1
+                return None
+            self._store.move_to_end(key)
+            self._stats["hits"] += 1
+        return [dict(r) for r in rows]
+
+    def put(self, key, rows, tables, generations, ttl):
+        """
+        Cache a copy of query result.
+        :param key: hashable cache key
+        :param rows: list of dict rows
+        :param tables: tuple of table names read by the query
+        :param generations: generations of `tables` taken before querying
+        :param ttl: seconds to keep the result
+        """
+        if self._max_size <= 0:
+            return
+        entry = (time.monotonic() + ttl, tables, generations, [dict(r) for r in rows])
+        with self._lock:
+            self._store[key] = entry
+            self._store.move_to_end(key)
+            while len(self._store) > self._max_size:
+                self._store.popitem(last=False)
+                self._stats["evictions"] += 1
+
+    def invalidate(self, table):
+        """
+        Invalidate all cached results reading a table.
+        :param table: table name
+        """
+        with self._lock:
+            self._generations[table] += 1
+            self._stats["invalidations"] += 1
+
+    def resize(self, max_size):
+        """
+        Set max number of cached results, 0 to disable caching.
+        :param max_size: max number of cached results
+        """
+        with self._lock:
+            self._max_size = max_size
+            while len(self._store) > max(max_size, 0):
+                self._store.popitem(last=False)
+
+    def clear(self):
+        """
+        Drop all cached results and reset counters.
+        """
+        with self._lock:
+            self._store.clear()
+            self._stats.clear()
+
+    def stats(self):
+        """
+        Get statistics of this cache.
+        :return: a dict of cache statistics
+        """
+        with self._lock:
+            snapshot = {"max_size": self._max_size, "size": len(self._store)}
+            for k in ("hits", "misses", "expired", "evictions", "invalidations"):
+                snapshot[k] = self._stats[k]
+            return snapshot
+
+
+class SqlQuery(metaclass=ABCMeta):
+    __metaclass__ = ABCMeta
+
+    _KW_TABLE = "{{__RIKO_TABLE__}}"
+    _KW_INSERT_REPLACE = "{{__RIKO_INSERT_REPLACE__}}"
+    _KW_FIELDS = "{{__RIKO_FIELDS__}}"
+    _KW_VALUES = "{{__RIKO_VALUES__}}"
+    _KW_ON_DUPLICATE_KEY_UPDATE = "{{__RIKO_DUPLICATE_KEY__}}"
+    _KW_JOIN = "{{__RIKO_JOIN__}}"
+    _KW_WHERE = "{{__RIKO_WHERE__}}"
+    _KW_DISTINCT = "{{__RIKO_DISTINCT__}}"
+    _KW_GROUP_BY = "{{__RIKO_GROUP_BY__}}"
+    _KW_HAVING = "{{__RIKO_HAVING__}}"
+    _KW_ORDER_BY = "{{__RIKO_ORDER_BY__}}"
+    _KW_LIMIT = "{{__RIKO_LIMIT__}}"
+    _KW_OFFSET = "{{__RIKO_OFFSET__}}"
+    _KW_FORUPDATE = "{{__RIKO_FOR_UPDATE__}}"
+
+    # Rendered SQL by query shape, shared by all queries
+    sql_cache = SqlCache()
+
+    # Opt-in select results, see `SelectQuery.cache`
+    result_cache = ResultCache()
+
+    _Insert_Template = """
+{{__RIKO_INSERT_REPLACE__}} INTO {{__RIKO_TABLE__}}({{__RIKO_FIELDS__}})
+VALUES ({{__RIKO_VALUES__}})
+{{__RIKO_DUPLICATE_KEY__}}
+"""
+    _Delete_Template = """
+DELETE FROM {{__RIKO_TABLE__}}
+{{__RIKO_WHERE__}}
+"""
+
+    _Update_Template = """
+UPDATE {{__RIKO_TABLE__}}
+SET {{__RIKO_FIELDS__}}
+{{__RIKO_WHERE__}}
+"""
+    _Select_Template = """
+SELECT {{__RIKO_DISTINCT__}} {{__RIKO_FIELDS__}}
+FROM {{__RIKO_TABLE__}}
+{{__RIKO_JOIN__}}
+{{__RIKO_WHERE__}}
+{{__RIKO_GROUP_BY__}}
+{{__RIKO_HAVING__}}
+{{__RIKO_ORDER_BY__}}
+{{__RIKO_LIMIT__}}
+{{__RIKO_OFFSET__}}
 {{__RIKO_FOR_UPDATE__}}
 """
 
@@ -597,10 +1581,13 @@ FROM {{__RIKO_TABLE__}}
         assert clazz is not None
         self._sql = None
         self._dbi = None
+        self._db_conf = None
         self._clz_meta = clazz
         self._temporary_dbi = False
         self._args = dict()
         self._is_batch = False
+        self._prepared = False
+        self._writes_table = True
 
     def __str__(self):
         return self._sql
@@ -612,14 +1599,71 @@ FROM {{__RIKO_TABLE__}}
         :param dbi: DBI object
         """
         if dbi is None:
-            if model_db_conf is None:
-                model_db_conf = Riko.db_config
-            self._dbi = DBI(model_db_conf)
+            # temporary connection is opened when executing, see `_open_dbi`
+            self._db_conf = model_db_conf
+            self._dbi = None
             self._temporary_dbi = True
         else:
             self._dbi = dbi
+            self._temporary_dbi = False
         return self
 
+    def _open_dbi(self):
+        if self._temporary_dbi and self._dbi is None:
+            db_conf = Riko.db_config if self._db_conf is None else self._db_conf
+            read_conf = self._read_config(db_conf)
+            if read_conf is not db_conf:
+                try:
+                    self._dbi = Riko.get_pool(read_conf).dbi() if Riko.use_pool else DBI(read_conf)
+                    return self._dbi
+                except Exception:
+                    logging.getLogger("ORM_QUERY").warning(
+                        "replica unavailable, read from primary", exc_info=True
+                    )
+            if Riko.use_pool:
+                self._dbi = Riko.get_pool(db_conf).dbi()
+            else:
+                self._dbi = DBI(db_conf)
+        return self._dbi
+
+    async def _aopen_dbi(self):
+        # awaitable `_open_dbi`, borrowing in the event loop, see `DBIPool.adbi`
+        if self._temporary_dbi and self._dbi is None:
+            db_conf = Riko.db_config if self._db_conf is None else self._db_conf
+            read_conf = self._read_config(db_conf)
+            if read_conf is not db_conf:
+                try:
+                    self._dbi = (await AsyncDBI.connect(read_conf)).dbi
+                    return self._dbi
+                except Exception:
+                    logging.getLogger("ORM_QUERY").warning(
+                        "replica unavailable, read from primary", exc_info=True
+                    )
+            self._dbi = (await AsyncDBI.connect(db_conf)).dbi
+        return self._dbi
+
+    async def _arun(self, func, *args, **kwargs):
+        """
+        Run a blocking call of this query on the executor of `Riko.get_executor`, with its connection borrowed
+        beforehand, a thread waiting for the pool could keep coroutines holding connections from running.
+        """
+        await self._aopen_dbi()
+        future = Riko.get_executor().submit(functools.partial(func, *args, **kwargs))
+        # given back when done or cancelled before started, no-op if `func` gave it back already
+        future.add_done_callback(lambda _: self._close_dbi())
+        return await asyncio.wrap_future(future)
+
+    def _read_config(self, db_conf):
+        """
+        Get the db config this query reads from, `db_conf` itself unless it can be sent to a replica.
+        """
+        return db_conf
+
+    def _close_dbi(self):
+        if self._temporary_dbi and self._dbi is not None:
+            self._dbi.close()
+            self._dbi = None
+
     def get(self, args=None, _datetime_dump=True, parse_model=False):
         """
         Execute and get result of query.
@@ -631,29 +1675,13 @@ FROM {{__RIKO_TABLE__}}
         self._prepare_sql()
         if args is not None:
             self._args.update(args)
-        try:
-            raw_result = self._dbi.query(self._sql, self._args)
-            if parse_model:
-                return [
-                    self._clz_meta.deserialize(
-                        db_conf=self._dbi.get_config(),
-                        _datetime_dump=_datetime_dump,
-                        **kvt
-                    )
-                    for kvt in raw_result
-                ]
-            else:
-                if _datetime_dump:
-                    for raw_item in raw_result:
-                        for (k, v) in raw_item.items():
-                            if isinstance(v, dt):
-                                raw_item[k] = v.strftime("%Y-%m-%d %H:%M:%S")
-                            elif isinstance(v, date):
-                                raw_item[k] = v.strftime("%Y-%m-%d")
-                return raw_result
-        finally:
-            if self._temporary_dbi:
-                self._dbi.close()
+        raw_result = self._query_rows(_datetime_dump)
+        if parse_model:
+            db_conf = self._session_config()
+            return [
+                self._clz_meta._from_row(db_conf, kvt) for kvt in raw_result
+            ]
+        return raw_result
 
     def only(self, parse_model=False, _datetime_dump=True, args=None):
         """
@@ -666,29 +1694,59 @@ FROM {{__RIKO_TABLE__}}
         self._prepare_sql()
         if args is not None:
             self._args.update(args)
+        ret = self._query_rows(_datetime_dump)
+        ret_raw = ret[0] if ret and len(ret) > 0 else None
+        if ret_raw is None:
+            return None
+        if parse_model:
+            return self._clz_meta._from_row(self._session_config(), ret_raw)
+        return ret_raw
+
+    def _query_rows(self, _datetime_dump):
+        cache_policy = self._result_cache_policy(_datetime_dump)
+        if cache_policy is not None:
+            (cache_key, cache_tables, cache_ttl) = cache_policy
+            cached = SqlQuery.result_cache.get(cache_key)
+            if cached is not None:
+                return cached
+            # taken before querying, so that a write finished meanwhile invalidates this result
+            generations = SqlQuery.result_cache.generations(cache_tables)
+        self._open_dbi()
         try:
-            ret = self._dbi.query(self._sql, self._args)
-            ret_raw = ret[0] if ret and len(ret) > 0 else None
-            if ret_raw is None:
-                return None
-            if parse_model is False:
-                if _datetime_dump:
-                    for (k, v) in ret_raw.items():
-                        if _datetime_dump:
-                            if isinstance(v, dt):
-                                ret_raw[k] = v.strftime("%Y-%m-%d %H:%M:%S")
-                            elif isinstance(v, date):
-                                ret_raw[k] = v.strftime("%Y-%m-%d")
-                return ret_raw
-            else:
-                return self._clz_meta.deserialize(
-                    db_conf=self._dbi.get_config(),
-                    _datetime_dump=_datetime_dump,
-                    **ret_raw
-                )
+            raw_result = self._dbi.query(self._sql, self._args)
+            codec = RowCodec.from_description(
+                self._dbi.last_description, _datetime_dump
+            )
+            if codec is not None:
+                for raw_item in raw_result:
+                    codec.convert(raw_item)
         finally:
-            if self._temporary_dbi:
-                self._dbi.close()
+            self._close_dbi()
+        if cache_policy is not None:
+            SqlQuery.result_cache.put(
+                cache_key, raw_result, cache_tables, generations, cache_ttl
+            )
+        return raw_result
+
+    def _result_cache_policy(self, _datetime_dump):
+        """
+        Get (cache key, read tables, ttl) if result of this query should be cached, otherwise None.
+        """
+        return None
+
+    def _session_config(self):
+        if self._dbi is not None:
+            return self._dbi.get_config()
+        return Riko.db_config if self._db_conf is None else self._db_conf
+
+    def _after_write(self):
+        if self._dbi is not None and self._dbi._in_transaction:
+            # invalidated when the transaction ends, see `DBI.start_transaction`
+            self._dbi._written_tables.add(self._clz_meta.__name__)
+        else:
+            SqlQuery.result_cache.invalidate(self._clz_meta.__name__)
+        BatchLoader.evict(self._clz_meta)
+        Riko.mark_write(self._session_config())
 
     def go(self, args=None, return_last_id=False):
         """
@@ -700,6 +1758,7 @@ FROM {{__RIKO_TABLE__}}
         self._prepare_sql()
         if args is not None:
             self._args.update(args)
+        self._open_dbi()
         try:
             if self._is_batch is False:
                 return self._dbi.query(
@@ -712,8 +1771,42 @@ FROM {{__RIKO_TABLE__}}
             else:
                 return self._dbi.insert_many(self._sql, self._args)
         finally:
-            if self._temporary_dbi:
-                self._dbi.close()
+            self._close_dbi()
+            if self._writes_table:
+                self._after_write()
+
+    async def aget(self, args=None, _datetime_dump=True, parse_model=False):
+        """
+        Awaitable `get`, executed on the executor of `Riko.get_executor`.
+        :param args: argument dict for SQL rendering
+        :param _datetime_dump: ensure datetime and date translated to string
+        :param parse_model: True to parse result to a list of ORM model objects, False to get list of dict objects
+        :return: see `parse_model` parameter description
+        """
+        return await self._arun(
+            self.get, args=args, _datetime_dump=_datetime_dump, parse_model=parse_model
+        )
+
+    async def aonly(self, parse_model=False, _datetime_dump=True, args=None):
+        """
+        Awaitable `only`, executed on the executor of `Riko.get_executor`.
+        :param args: argument dict for SQL rendering
+        :param _datetime_dump: ensure datetime and date translated to string
+        :param parse_model: True to parse result to a ORM model object, False to get a dict object
+        :return: a ORM model object, or None if not found
+        """
+        return await self._arun(
+            self.only, parse_model=parse_model, _datetime_dump=_datetime_dump, args=args
+        )
+
+    async def ago(self, args=None, return_last_id=False):
+        """
+        Awaitable `go`, executed on the executor of `Riko.get_executor`.
+        :param args: argument dict for SQL rendering
+        :param return_last_id: True to return last insert id, False to return affected row count
+        :return: see `return_last_id` parameter description
+        """
+        return await self._arun(self.go, args=args, return_last_id=return_last_id)
 
     def cursor(self, args=None):
         """
@@ -724,6 +1817,10 @@ FROM {{__RIKO_TABLE__}}
         self._prepare_sql()
         if args is not None:
             self._args.update(args)
+        self._open_dbi()
+        if self._temporary_dbi:
+            # caller owns the connection from now on, do not hold a pool slot for it
+            self._dbi.detach()
         return self._dbi.query(self._sql, self._args, return_pattern=DBI.RETURN_NONE)
 
     @contextlib.contextmanager
@@ -736,21 +1833,87 @@ FROM {{__RIKO_TABLE__}}
         self._prepare_sql()
         if args is not None:
             self._args.update(args)
+        self._open_dbi()
         try:
             ptr = self._dbi.query(self._sql, self._args, return_pattern=DBI.RETURN_NONE)
             yield ptr
         finally:
             if ptr:
                 ptr.close()
-            if self._temporary_dbi:
-                self._dbi.close()
+            self._close_dbi()
+
+    def explain(self, args=None):
+        """
+        Get EXPLAIN of this query, and warn by logger `ORM_QUERY` if any table is fully scanned.
+        `EXPLAIN QUERY PLAN` is used for SQLite.
+        :param args: argument dict for SQL rendering
+        :return: list of EXPLAIN rows in dict
+        """
+        self._prepare_sql()
+        if args is not None:
+            self._args.update(args)
+        self._open_dbi()
+        try:
+            rows = self._dbi.query("EXPLAIN " + self._sql, self._args)
+            names = [d[0] for d in self._dbi.last_description]
+        finally:
+            self._close_dbi()
+        plan = [row if isinstance(row, dict) else dict(zip(names, row)) for row in rows]
+        for row in plan:
+            # MySQL access type, or SQLite query plan detail
+            if row.get("type") == "ALL" or str(row.get("detail", "")).startswith("SCAN "):
+                logging.getLogger("ORM_QUERY").warning(
+                    "full scan of %s, about %s rows: %s",
+                    row.get("table"),
+                    row.get("rows"),
+                    QueryEvent.shape_of(self._sql),
+                )
+        return plan
+
+    def _parse_row(self, raw_item, parse_model, codec):
+        if codec is not None:
+            codec.convert(raw_item)
+        if parse_model:
+            # values are converted by codec already
+            return self._clz_meta._from_row(self._dbi.get_config(), raw_item)
+        return raw_item
+
+    def prepare(self):
+        """
+        Compile this query once for repeated execution with new arguments.
+        :return: a PreparedQuery object
+        """
+        return PreparedQuery(self)
 
-    @abstractmethod
     def _prepare_sql(self):
+        if self._prepared:
+            return
+        shape = self._shape()
+        sql = SqlQuery.sql_cache.get(shape)
+        if sql is None:
+            sql = self._build_sql()
+            SqlQuery.sql_cache.put(shape, sql)
+        self._sql = sql
+
+    @abstractmethod
+    def _shape(self):
+        """
+        Get a hashable key identifying the SQL this query renders to, None to skip SQL cache.
+        """
+        pass
+
+    @abstractmethod
+    def _build_sql(self):
+        """
+        Render the SQL of this query.
+        """
         pass
 
 
 class ConditionQuery(SqlQuery):
+    # Max candidate values in one `IN` list, see `where_in`
+    in_chunk_size = 1000
+
     def __init__(self, clazz, where=None):
         super().__init__(clazz)
         if where is not None:
@@ -784,60 +1947,173 @@ class ConditionQuery(SqlQuery):
     def where_in(self, term_name, candidate_values):
         """
         Set WHERE `term_name IN candidate_values` condition by given pattern, combined with `AND`.
+        Values are bound as arguments and de-duplicated. If more than `in_chunk_size` values are given,
+        `get`, `only` and `go` run the query once per chunk of values and merge the results,
+        unless the result cannot be merged (LIMIT, OFFSET, ORDER BY, GROUP BY, HAVING or aggregation).
         :param term_name: field name
         :param candidate_values: candidate value in list
         """
         if len(candidate_values) > 0:
-            if term_name not in self._where_in:
-                self._where_in[term_name] = list()
-            self._where_in[term_name].extend(candidate_values)
+            values = self._where_in.get(term_name, list()) + list(candidate_values)
+            self._where_in[term_name] = list(dict.fromkeys(values))
+            self._bind_in_args("__RIKO_IN_" + term_name + "_", self._where_in[term_name])
         return self
 
     def where_not_in(self, term_name, candidate_values):
         """
-        Set WHERE `term_name IN candidate_values` condition by given pattern, combined with `AND`.
+        Set WHERE `term_name NOT IN candidate_values` condition by given pattern, combined with `AND`.
+        Values are bound as arguments and de-duplicated.
         :param term_name: field name
         :param candidate_values: candidate value in list
         """
         if len(candidate_values) > 0:
-            if term_name not in self._where_not_in:
-                self._where_not_in[term_name] = list()
-            self._where_not_in[term_name].extend(candidate_values)
+            values = self._where_not_in.get(term_name, list()) + list(candidate_values)
+            self._where_not_in[term_name] = list(dict.fromkeys(values))
+            self._bind_in_args(
+                "__RIKO_NOT_IN_" + term_name + "_", self._where_not_in[term_name]
+            )
         return self
 
+    def _bind_in_args(self, arg_prefix, values):
+        # pad the list by repeating last value, so that lists of similar length share one SQL
+        for i in range(ConditionQuery._in_padded_len(len(values))):
+            self._args[arg_prefix + str(i)] = values[min(i, len(values) - 1)]
+
+    @staticmethod
+    def _in_padded_len(n):
+        padded = 1
+        while padded < n:
+            padded <<= 1
+        return padded
+
+    def _construct_in_term(self, term_name, values, negative):
+        arg_prefix = ("__RIKO_NOT_IN_" if negative else "__RIKO_IN_") + term_name + "_"
+        operator = " NOT IN (" if negative else " IN ("
+        placeholders = [
+            "%(" + arg_prefix + str(i) + ")s"
+            for i in range(ConditionQuery._in_padded_len(len(values)))
+        ]
+        # keep each list bounded, `a NOT IN (x) AND a NOT IN (y)` equals to `a NOT IN (x, y)`
+        terms = list()
+        for i in range(0, len(placeholders), self.in_chunk_size):
+            terms.append(
+                term_name + operator + ", ".join(placeholders[i : i + self.in_chunk_size]) + ")"
+            )
+        if len(terms) == 1:
+            return terms[0]
+        return "(" + (" AND " if negative else " OR ").join(terms) + ")"
+
     def _construct_where_clause(self):
-        in_term = ""
-        if len(self._where_in) > 0:
-            in_term_list = list()
-            for (in_key, in_val) in self._where_in.items():
-                current_term_list = list()
-                for val_item in in_val:
-                    current_term_list.append("'%s'" % val_item)
-                in_term_list.append(
-                    in_key + " IN (" + ",".join(current_term_list) + ")"
-                )
-            in_term += " AND ".join(in_term_list)
-        not_term = ""
-        if len(self._where_not_in) > 0:
-            not_term_list = list()
-            for (not_key, not_val) in self._where_not_in.items():
-                current_term_list = list()
-                for val_item in not_val:
-                    current_term_list.append("'%s'" % val_item)
-                not_term_list.append(
-                    not_key + " NOT IN (" + ",".join(current_term_list) + ")"
-                )
-            not_term += " AND ".join(not_term_list)
-        if in_term != "":
-            self._where.append(in_term)
-        if not_term != "":
-            self._where.append(not_term)
-        if len(self._where) == 0:
+        where_terms = list(self._where)
+        for (in_key, in_val) in self._where_in.items():
+            where_terms.append(self._construct_in_term(in_key, in_val, False))
+        for (not_key, not_val) in self._where_not_in.items():
+            where_terms.append(self._construct_in_term(not_key, not_val, True))
+        if len(where_terms) == 0:
             return ""
-        return "WHERE " + " AND ".join(self._where)
+        return "WHERE " + " AND ".join(where_terms)
+
+    def _where_shape(self):
+        return (
+            tuple(self._where),
+            tuple(
+                (k, ConditionQuery._in_padded_len(len(v)))
+                for (k, v) in self._where_in.items()
+            ),
+            tuple(
+                (k, ConditionQuery._in_padded_len(len(v)))
+                for (k, v) in self._where_not_in.items()
+            ),
+        )
+
+    def _in_oversized(self):
+        for values in itertools.chain(self._where_in.values(), self._where_not_in.values()):
+            if len(values) > self.in_chunk_size:
+                return True
+        return False
+
+    def _can_split_in(self):
+        """
+        Whether results of running this query per chunk of `where_in` values can be merged.
+        """
+        return True
+
+    def _split_in(self):
+        """
+        Split this query into copies each with at most `in_chunk_size` values of the longest `where_in` list.
+        :return: list of queries, or None if no need or the result cannot be merged
+        """
+        if len(self._where_in) == 0:
+            return None
+        (in_key, in_val) = max(self._where_in.items(), key=lambda kv: len(kv[1]))
+        if len(in_val) <= self.in_chunk_size or not self._can_split_in():
+            return None
+        arg_prefix = "__RIKO_IN_" + in_key + "_"
+        # drop args of the whole list, escaping them per chunk costs quadratic time
+        base_args = {
+            k: v
+            for (k, v) in self._args.items()
+            if not (k.startswith(arg_prefix) and k[len(arg_prefix):].isdigit())
+        }
+        parts = list()
+        for i in range(0, len(in_val), self.in_chunk_size):
+            part = copy.copy(self)
+            part._where_in = dict(self._where_in)
+            part._where_in[in_key] = in_val[i : i + self.in_chunk_size]
+            part._args = dict(base_args)
+            part._bind_in_args(arg_prefix, part._where_in[in_key])
+            part._prepared = False
+            part._sql = None
+            if self._dbi is not None:
+                # borrowed beforehand by `_aopen_dbi`, parts run on it and this query gives it back once
+                part._temporary_dbi = False
+            parts.append(part)
+        return parts
 
-    @abstractmethod
     def _prepare_sql(self):
+        if not self._prepared and self._in_oversized():
+            # one-off SQL of a long list, keep it out of SQL cache
+            self._sql = self._build_sql()
+            return
+        super()._prepare_sql()
+
+    def _query_rows(self, _datetime_dump):
+        parts = self._split_in()
+        if parts is None:
+            return super()._query_rows(_datetime_dump)
+        rows = list()
+        for part in parts:
+            part._prepare_sql()
+            rows.extend(SqlQuery._query_rows(part, _datetime_dump))
+        return self._merge_in_rows(rows)
+
+    def _merge_in_rows(self, rows):
+        """
+        Merge results of queries split by `_split_in`, values are de-duplicated so that chunks never overlap.
+        """
+        return rows
+
+    def go(self, args=None, return_last_id=False):
+        """
+        Execute the query, once per chunk if `where_in` values are more than `in_chunk_size`.
+        :param args: argument dict for SQL rendering
+        :param return_last_id: True to return last insert id, False to return affected row count
+        :return: see `return_last_id` parameter description, total affected row count if split
+        """
+        parts = self._split_in()
+        if parts is None:
+            return super().go(args=args, return_last_id=return_last_id)
+        affected = 0
+        for part in parts:
+            affected += part.go(args=args)
+        return affected
+
+    @abstractmethod
+    def _shape(self):
+        pass
+
+    @abstractmethod
+    def _build_sql(self):
         pass
 
 
@@ -870,7 +2146,11 @@ class OrderedQuery(ConditionQuery):
         return "ORDER BY " + ", ".join(self._order_by)
 
     @abstractmethod
-    def _prepare_sql(self):
+    def _shape(self):
+        pass
+
+    @abstractmethod
+    def _build_sql(self):
         pass
 
 
@@ -879,6 +2159,8 @@ class PaginationOrderQuery(OrderedQuery):
         super().__init__(clazz, where, order_by)
         self._limit = limit
         self._offset = offset
+        self._seek_keys = None
+        self._seek_term = None
 
     def pagination(self, page, per_page):
         """
@@ -890,6 +2172,60 @@ class PaginationOrderQuery(OrderedQuery):
         self._limit = per_page
         return self
 
+    def seek(self, after=None, per_page=20, keys=None, descending=False):
+        """
+        Paginate the query result by keyset, each page costs the same no matter how deep it is.
+        Result is ordered by `keys`, rows after `after` are fetched, instead of skipping `OFFSET` rows.
+        :param after: key values of the last row of previous page, like `(1024, )`, None to fetch first page
+        :param per_page: record number per page
+        :param keys: tuple/list of unique ordering fields, None to use primary keys
+        :param descending: True to page from larger keys to smaller ones
+        """
+        if keys is None:
+            keys = self._clz_meta.get_pk_name()
+        keys = tuple(keys) if type(keys) in (list, tuple) else (str(keys),)
+        assert len(keys) > 0
+        if self._seek_term is not None:
+            self._where.remove(self._seek_term)
+            self._seek_term = None
+        if after is not None:
+            if type(after) not in (list, tuple):
+                after = (after,)
+            assert len(after) == len(keys)
+            placeholders = list()
+            for (k, v) in zip(keys, after):
+                placeholders.append("%(__RIKO_SEEK_" + k + ")s")
+                self._args["__RIKO_SEEK_" + k] = v
+            operator = " < " if descending else " > "
+            if len(keys) == 1:
+                self._seek_term = keys[0] + operator + placeholders[0]
+            else:
+                self._seek_term = (
+                    "(" + ", ".join(keys) + ")"
+                    + operator
+                    + "(" + ", ".join(placeholders) + ")"
+                )
+            self._where.append(self._seek_term)
+        self._seek_keys = keys
+        self._order_by = [k + " DESC" if descending else k for k in keys]
+        self._limit = per_page
+        self._offset = None
+        return self
+
+    def next_after(self, page_result):
+        """
+        Get the continuation token of a page fetched by `seek`, give it to `seek` as `after` for next page.
+        :param page_result: list of dict or ORM model objects of current page
+        :return: tuple of key values of the last row, or None if there is no more page
+        """
+        assert self._seek_keys is not None
+        if len(page_result) == 0 or len(page_result) < self._limit:
+            return None
+        last = page_result[-1]
+        if isinstance(last, AbstractModel):
+            return tuple(last.get_value(k) for k in self._seek_keys)
+        return tuple(last[k] for k in self._seek_keys)
+
     def limit(self, limit):
         """
         Limit the max result row count of query result.
@@ -917,7 +2253,11 @@ class PaginationOrderQuery(OrderedQuery):
         return "OFFSET " + str(self._offset)
 
     @abstractmethod
-    def _prepare_sql(self):
+    def _shape(self):
+        pass
+
+    @abstractmethod
+    def _build_sql(self):
         pass
 
 
@@ -984,7 +2324,20 @@ class InsertQuery(SqlQuery):
             return ""
         return "ON DUPLICATE KEY UPDATE " + ", ".join(self._duplicate_update)
 
-    def _prepare_sql(self):
+    def _insert_shape(self):
+        return (
+            self._on_duplicate_key_replace,
+            self._on_duplicate_key_ignore,
+            tuple(self._insert_fields),
+            tuple(self._duplicate_update),
+        )
+
+    @abstractmethod
+    def _shape(self):
+        pass
+
+    @abstractmethod
+    def _build_sql(self):
         pass
 
 
@@ -1024,8 +2377,15 @@ class SingleInsertQuery(InsertQuery):
         assert len(self._insert_values) > 0
         return ", ".join(self._insert_values)
 
-    def _prepare_sql(self):
-        self._sql = SqlQuery._Insert_Template
+    def _shape(self):
+        return (
+            self._clz_meta,
+            "INSERT",
+            self._insert_shape(),
+            tuple(self._insert_values),
+        )
+
+    def _build_sql(self):
         r_dict = {
             SqlQuery._KW_INSERT_REPLACE: self._construct_insert_operator_clause(),
             SqlQuery._KW_TABLE: self._clz_meta.__name__,
@@ -1033,7 +2393,7 @@ class SingleInsertQuery(InsertQuery):
             SqlQuery._KW_VALUES: self._construct_insert_values_clause(),
             SqlQuery._KW_ON_DUPLICATE_KEY_UPDATE: self._construct_on_duplicate_key_update_clause(),
         }
-        self._sql = SqlRender.render(self._sql, r_dict)
+        return SqlRender.render(SqlQuery._Insert_Template, r_dict)
 
 
 class BatchInsertQuery(InsertQuery):
@@ -1041,6 +2401,29 @@ class BatchInsertQuery(InsertQuery):
         super().__init__(clazz)
         self._insert_value_tuples = list()
         self._is_batch = True
+        # `_args` is replaced by value tuples when preparing, keep terms of ON DUPLICATE KEY UPDATE here
+        self._upsert_args = self._args
+        self._upsert_value_columns = None
+        self._chunk_max_bytes = None
+        self._chunk_max_rows = None
+
+    def on_duplicate_key_update_values(self, *columns):
+        """
+        Set update clause for ON DUPLICATE KEY UPDATE using inserting values, like "age = VALUES(age)".
+        :param columns: fields to update, empty to update all inserting fields except primary keys
+        """
+        self._upsert_value_columns = tuple(columns)
+        return self
+
+    def chunk(self, max_bytes=None, max_rows=None):
+        """
+        Set how rows are split into multi-row statements.
+        :param max_bytes: max bytes of one statement, None to follow server `max_allowed_packet`
+        :param max_rows: max row number of one statement, None for no limit
+        """
+        self._chunk_max_bytes = max_bytes
+        self._chunk_max_rows = max_rows
+        return self
 
     def values(self, insert_field_terms, insert_value_terms_many):
         """
@@ -1068,7 +2451,11 @@ class BatchInsertQuery(InsertQuery):
             return self
         sampled = insert_objs[0]
         assert isinstance(sampled, self._clz_meta)
-        self._insert_fields.extend(sampled.get_fields())
+        ak = sampled.get_ak_name()
+        for k in sampled.get_columns():
+            # leave auto increment key to DB unless given
+            if k != ak or sampled.get_value(k) is not None:
+                self._insert_fields.append(k)
         for t in insert_objs:
             assert isinstance(t, self._clz_meta)
             t_terms = list()
@@ -1085,36 +2472,104 @@ class BatchInsertQuery(InsertQuery):
             placeholder.append("%s")
         return ", ".join(placeholder)
 
-    def _prepare_sql(self):
-        self._sql = SqlQuery._Insert_Template
-        r_dict = {
-            SqlQuery._KW_INSERT_REPLACE: self._construct_insert_operator_clause(),
-            SqlQuery._KW_TABLE: self._clz_meta.__name__,
-            SqlQuery._KW_FIELDS: self._construct_insert_fields_clause(),
-            SqlQuery._KW_VALUES: self._construct_insert_values_clause(),
-            SqlQuery._KW_ON_DUPLICATE_KEY_UPDATE: self._construct_on_duplicate_key_update_clause(),
-        }
-        self._args = self._insert_value_tuples
-        self._sql = SqlRender.render(self._sql, r_dict)
+    def _construct_on_duplicate_key_update_clause(self):
+        if self._on_duplicate_key_ignore is True or self._on_duplicate_key_replace is True:
+            return ""
+        update_terms = list(self._duplicate_update)
+        if self._upsert_value_columns is not None:
+            columns = self._upsert_value_columns
+            if len(columns) == 0:
+                pks = self._clz_meta.get_pk_name()
+                columns = [k for k in self._insert_fields if k not in pks]
+            for k in columns:
+                update_terms.append(k + " = VALUES(" + k + ")")
+        if len(update_terms) == 0:
+            return ""
+        return "ON DUPLICATE KEY UPDATE " + ", ".join(update_terms)
 
+    def go(self, args=None, return_last_id=False):
+        """
+        Execute the batch insert as multi-row statements, see `go_chunks`.
+        :param args: list of value tuples to insert instead of the given ones
+        :param return_last_id: not supported by batch insert, the affected row count is always returned
+        :return: total affected row count
+        """
+        return sum(self.go_chunks(args))
 
-class DeleteQuery(ConditionQuery):
+    def go_chunks(self, args=None):
+        """
+        Execute the batch insert as multi-row statements like `INSERT ... VALUES (...), (...)`,
+        split so that each statement stays under server `max_allowed_packet`.
+        :param args: list of value tuples to insert instead of the given ones
+        :return: list of affected row count of each statement
+        """
+        self._prepare_sql()
+        rows = self._args if args is None else args
+        values_clause = "VALUES (" + self._construct_insert_values_clause() + ")"
+        (sql_head, _, sql_tail) = self._sql.partition(values_clause)
+        self._open_dbi()
+        try:
+            return self._dbi.insert_values(
+                sql_head + "VALUES ",
+                values_clause[len("VALUES "):],
+                rows,
+                sql_tail=sql_tail,
+                tail_args=self._upsert_args,
+                max_bytes=self._chunk_max_bytes,
+                max_rows=self._chunk_max_rows,
+            )
+        finally:
+            self._close_dbi()
+            self._after_write()
+
+    def _prepare_sql(self):
+        if self._prepared:
+            return
+        super()._prepare_sql()
+        self._args = self._insert_value_tuples
+
+    def _shape(self):
+        return (
+            self._clz_meta,
+            "BATCH_INSERT",
+            self._insert_shape(),
+            self._upsert_value_columns,
+        )
+
+    def _build_sql(self):
+        assert len(self._insert_value_tuples) > 0
+        r_dict = {
+            SqlQuery._KW_INSERT_REPLACE: self._construct_insert_operator_clause(),
+            SqlQuery._KW_TABLE: self._clz_meta.__name__,
+            SqlQuery._KW_FIELDS: self._construct_insert_fields_clause(),
+            SqlQuery._KW_VALUES: self._construct_insert_values_clause(),
+            SqlQuery._KW_ON_DUPLICATE_KEY_UPDATE: self._construct_on_duplicate_key_update_clause(),
+        }
+        return SqlRender.render(SqlQuery._Insert_Template, r_dict)
+
+
+class DeleteQuery(ConditionQuery):
     def __init__(self, clazz, where=None):
         super().__init__(clazz, where)
 
-    def _prepare_sql(self):
-        self._sql = SqlQuery._Delete_Template
+    def _shape(self):
+        return self._clz_meta, "DELETE", self._where_shape()
+
+    def _build_sql(self):
         r_dict = {
             SqlQuery._KW_TABLE: self._clz_meta.__name__,
             SqlQuery._KW_WHERE: self._construct_where_clause(),
         }
-        self._sql = SqlRender.render(self._sql, r_dict)
+        return SqlRender.render(SqlQuery._Delete_Template, r_dict)
 
 
 class UpdateQuery(ConditionQuery):
     def __init__(self, clazz, where=None):
         super().__init__(clazz, where)
         self._update_set = list()
+        self._many_key = None
+        self._many_rows = None
+        self._many_chunk_size = None
 
     def set_raw(self, update_terms):
         """
@@ -1134,18 +2589,97 @@ class UpdateQuery(ConditionQuery):
             self._args["__RIKO_SET_" + k] = v
         return self
 
+    def many(self, key, rows, chunk_size=500):
+        """
+        Update multiple rows with their own values, one statement per chunk, like
+        `UPDATE t SET a = CASE id WHEN 1 THEN 'x' WHEN 2 THEN 'y' ELSE a END WHERE id IN (1, 2)`.
+        Execute it by `go`, which returns total affected row count.
+        :param key: unique field to match rows, like "tid"
+        :param rows: list of dict with `key` and fields to update, like [{"tid": 1, "status": 1}, ...]
+        :param chunk_size: max row number updated by one statement
+        """
+        assert chunk_size > 0
+        self._many_key = key
+        self._many_rows = list(rows)
+        self._many_chunk_size = chunk_size
+        return self
+
+    def go(self, args=None, return_last_id=False):
+        """
+        Execute the query.
+        :param args: argument dict for SQL rendering
+        :param return_last_id: True to return last insert id, False to return affected row count
+        :return: see `return_last_id` parameter description, total affected row count if `many` is set
+        """
+        if self._many_rows is None:
+            return super().go(args=args, return_last_id=return_last_id)
+        if args is not None:
+            self._args.update(args)
+        affected = 0
+        self._open_dbi()
+        try:
+            for i in range(0, len(self._many_rows), self._many_chunk_size):
+                (sql, chunk_args) = self._build_many_sql(
+                    self._many_rows[i : i + self._many_chunk_size]
+                )
+                affected += self._dbi.query(
+                    sql, chunk_args, return_pattern=DBI.RETURN_AFFECTED_ROW
+                )
+        finally:
+            self._close_dbi()
+            self._after_write()
+        return affected
+
+    def _build_many_sql(self, chunk):
+        key = self._many_key
+        chunk_args = dict(self._args)
+        key_terms = list()
+        columns = list()
+        for (i, row) in enumerate(chunk):
+            arg_name = "__RIKO_MANY_" + str(i) + "_" + key
+            chunk_args[arg_name] = row[key]
+            key_terms.append("%(" + arg_name + ")s")
+            for k in row:
+                if k != key and k not in columns:
+                    columns.append(k)
+        update_set = list(self._update_set)
+        for k in columns:
+            cases = list()
+            for (i, row) in enumerate(chunk):
+                if k in row:
+                    arg_name = "__RIKO_MANY_" + str(i) + "_" + k
+                    chunk_args[arg_name] = row[k]
+                    cases.append("WHEN " + key_terms[i] + " THEN %(" + arg_name + ")s")
+            update_set.append(
+                k + " = CASE " + key + " " + " ".join(cases) + " ELSE " + k + " END"
+            )
+        assert len(update_set) > 0
+        in_term = key + " IN (" + ", ".join(key_terms) + ")"
+        where_clause = self._construct_where_clause()
+        where_clause = (
+            where_clause + " AND " + in_term if where_clause else "WHERE " + in_term
+        )
+        r_dict = {
+            SqlQuery._KW_TABLE: self._clz_meta.__name__,
+            SqlQuery._KW_WHERE: where_clause,
+            SqlQuery._KW_FIELDS: ", ".join(update_set),
+        }
+        return SqlRender.render(SqlQuery._Update_Template, r_dict), chunk_args
+
     def _construct_update_set_clause(self):
         assert len(self._update_set) > 0
         return ", ".join(self._update_set)
 
-    def _prepare_sql(self):
-        self._sql = SqlQuery._Update_Template
+    def _shape(self):
+        return self._clz_meta, "UPDATE", tuple(self._update_set), self._where_shape()
+
+    def _build_sql(self):
         r_dict = {
             SqlQuery._KW_TABLE: self._clz_meta.__name__,
             SqlQuery._KW_WHERE: self._construct_where_clause(),
             SqlQuery._KW_FIELDS: self._construct_update_set_clause(),
         }
-        self._sql = SqlRender.render(self._sql, r_dict)
+        return SqlRender.render(SqlQuery._Update_Template, r_dict)
 
 
 class SelectQuery(PaginationOrderQuery):
@@ -1156,12 +2690,20 @@ class SelectQuery(PaginationOrderQuery):
         self._return_columns = list() if columns is None else list(columns)
         self._distinct = False
         self._for_update = False
+        self._skip_locked = False
         self._group_by = list()
         self._having = list()
         self._alias = None
         self._join = list()
         self._join_type = dict()
         self._join_on = dict()
+        self._join_clazz = list()
+        self._cache_ttl = None
+        self._from_primary = False
+        self._undeferred = set()
+        # deferred columns left out of the current SQL, see `_use_deferred`
+        self._deferring = ()
+        self._writes_table = False
 
     def alias(self, alias):
         """
@@ -1171,14 +2713,291 @@ class SelectQuery(PaginationOrderQuery):
         self._alias = alias
         return self
 
-    def for_update(self, is_for_update=True):
+    def for_update(self, is_for_update=True, skip_locked=False):
         """
         Set SELECT FOR UPDATE for query.
         :param is_for_update: is select for update mode, default True
+        :param skip_locked: True to skip rows locked by other transactions rather than wait, MySQL 8.0 or later
         """
         self._for_update = is_for_update
+        self._skip_locked = skip_locked
+        return self
+
+    def seek(self, after=None, per_page=20, keys=None, descending=False):
+        """
+        Paginate the query result by keyset, see `PaginationOrderQuery.seek`.
+        Keys are appended to return columns if missing, since the continuation token is made of them.
+        """
+        super().seek(after=after, per_page=per_page, keys=keys, descending=descending)
+        if len(self._return_columns) > 0:
+            for k in self._seek_keys:
+                if k not in self._return_columns:
+                    self._return_columns.append(k)
+        return self
+
+    def undefer(self, *columns):
+        """
+        Select deferred columns of the model with the rest, see `AbstractModel.deferred`.
+        :param columns: deferred columns to select, empty to select all
+        """
+        self._undeferred.update(columns if len(columns) > 0 else self._clz_meta._deferred_set)
+        return self
+
+    def get(self, args=None, _datetime_dump=True, parse_model=False):
+        """
+        Execute and get result of query.
+        Deferred columns of the model are left out when parsing to ORM model objects, see `DeferredColumns`.
+        :param args: argument dict for SQL rendering
+        :param _datetime_dump: ensure datetime and date translated to string
+        :param parse_model: True to parse result to a list of ORM model objects, False to get list of dict objects
+        :return: see `parse_model` parameter description
+        """
+        self._use_deferred(parse_model)
+        result = super().get(args=args, _datetime_dump=_datetime_dump, parse_model=parse_model)
+        if self._deferring and len(result) > 0:
+            loader = DeferredColumns(
+                self._clz_meta, self._session_config(), self._deferring, _datetime_dump
+            )
+            for obj in result:
+                loader.add(obj)
+        return result
+
+    def only(self, parse_model=False, _datetime_dump=True, args=None):
+        """
+        Execute and get result of query, but only one object will be returned.
+        Deferred columns of the model are left out when parsing to ORM model object, see `DeferredColumns`.
+        :param args: argument dict for SQL rendering
+        :param _datetime_dump: ensure datetime and date translated to string
+        :param parse_model: True to parse result to a list of ORM model objects, False to get list of dict objects
+        :return: a ORM model object, or None if not found
+        """
+        self._use_deferred(parse_model)
+        result = super().only(parse_model=parse_model, _datetime_dump=_datetime_dump, args=args)
+        if self._deferring and result is not None:
+            DeferredColumns(
+                self._clz_meta, self._session_config(), self._deferring, _datetime_dump
+            ).add(result)
+        return result
+
+    def _use_deferred(self, parse_model):
+        # decided per execution, prepared SQL is kept as it is
+        if self._prepared:
+            return
+        deferred = self._clz_meta._deferred_set
+        if (
+            not parse_model
+            or len(deferred) == 0
+            or self._return_columns
+            or self._join
+            or self._distinct
+            or self._group_by
+            or self._for_update
+            or not self._temporary_dbi
+        ):
+            self._deferring = ()
+            return
+        self._deferring = tuple(
+            k for k in self._clz_meta._columns if k in deferred and k not in self._undeferred
+        )
+
+    def from_primary(self, is_from_primary=True):
+        """
+        Read from primary DB even if replicas are set, see `Riko.set_replicas`.
+        :param is_from_primary: True to read from primary, default True
+        """
+        self._from_primary = is_from_primary
+        return self
+
+    def get_page(self, args=None, _datetime_dump=True, parse_model=False):
+        """
+        Execute a query paginated by `seek`, and get result with continuation token.
+        :param args: argument dict for SQL rendering
+        :param _datetime_dump: ensure datetime and date translated to string
+        :param parse_model: True to parse result to a list of ORM model objects, False to get list of dict objects
+        :return: tuple of (result list, token for `seek(after=token)` or None if there is no more page)
+        """
+        page_result = self.get(
+            args=args, _datetime_dump=_datetime_dump, parse_model=parse_model
+        )
+        return page_result, self.next_after(page_result)
+
+    def cache(self, ttl=60):
+        """
+        Cache result of `get` and `only` for a while, overriding `cache_ttl` of the model.
+        Cached result is dropped once any insert, update or delete by Riko touches a table it reads.
+        Queries with `for_update` or on a given connection context are never cached.
+        :param ttl: seconds to keep the result, 0 to disable caching
+        """
+        self._cache_ttl = ttl
         return self
 
+    def _result_cache_policy(self, _datetime_dump):
+        ttl = self._clz_meta.cache_ttl if self._cache_ttl is None else self._cache_ttl
+        if not ttl or self._for_update or not self._temporary_dbi:
+            return None
+        tables = (self._clz_meta.__name__,) + tuple(
+            j.__name__ for j in self._join_clazz
+        )
+        try:
+            cache_key = (
+                Riko._pool_key(self._session_config()),
+                self._sql,
+                tuple(sorted(self._args.items())),
+                _datetime_dump,
+            )
+            hash(cache_key)
+        except TypeError:
+            # unhashable argument, like a list
+            return None
+        return cache_key, tables, ttl
+
+    def _read_config(self, db_conf):
+        if self._for_update or self._from_primary or not self._clz_meta.read_replica:
+            return db_conf
+        if not all(j.read_replica for j in self._join_clazz):
+            return db_conf
+        return Riko.read_config(db_conf)
+
+    def _can_split_in(self):
+        return not (
+            self._limit is not None
+            or self._offset is not None
+            or self._order_by
+            or self._group_by
+            or self._having
+            or any("(" in str(c) for c in self._return_columns)
+        )
+
+    def _merge_in_rows(self, rows):
+        if not self._distinct:
+            return rows
+        # same row may come from different chunks when key field is not returned
+        merged = dict()
+        for row in rows:
+            merged.setdefault(tuple(row.items()) if isinstance(row, dict) else tuple(row), row)
+        return list(merged.values())
+
+    def iter(self, chunk_size=1000, args=None, parse_model=False, _datetime_dump=True):
+        """
+        Execute and lazily iterate query result by an unbuffered server side cursor,
+        memory usage keeps flat regardless of result size.
+        The connection is held until the generator is exhausted or closed, do not query on it meanwhile.
+        :param chunk_size: row number fetched from server per round
+        :param args: argument dict for SQL rendering
+        :param parse_model: True to yield ORM model objects, False to yield dict objects
+        :param _datetime_dump: ensure datetime and date translated to string
+        :return: a generator of query result
+        """
+        self._use_deferred(parse_model)
+        self._prepare_sql()
+        if args is not None:
+            self._args.update(args)
+        model_conf = self._session_config()
+        self._open_dbi()
+        try:
+            codec = None
+            first = True
+            loader = None
+            for raw_item in self._dbi.stream(
+                self._sql,
+                self._args,
+                chunk_size=chunk_size,
+                close_on_abort=self._temporary_dbi,
+            ):
+                if first:
+                    codec = RowCodec.from_description(
+                        self._dbi.last_description, _datetime_dump
+                    )
+                    first = False
+                item = self._parse_row(raw_item, parse_model, codec)
+                if self._deferring:
+                    # deferred columns are loaded per chunk
+                    if loader is None or len(loader) >= chunk_size:
+                        loader = DeferredColumns(
+                            self._clz_meta, model_conf, self._deferring, _datetime_dump
+                        )
+                    loader.add(item)
+                yield item
+        finally:
+            self._close_dbi()
+
+    def columns(self, args=None, chunk_size=1000, _datetime_dump=False):
+        """
+        Execute and get query result in columnar form, without building a dict per row.
+        Integer columns are packed in `array('q')`, floating columns in `array('d')`,
+        others (or any column with NULL or out of range values) are kept in list.
+        Rows are fetched by an unbuffered cursor chunk by chunk.
+        :param args: argument dict for SQL rendering
+        :param chunk_size: row number fetched from server per round
+        :param _datetime_dump: ensure datetime and date translated to string, default False to keep native types
+        :return: a dict of column name to array or list of values, in result order
+        """
+        self._prepare_sql()
+        if args is not None:
+            self._args.update(args)
+        self._open_dbi()
+        try:
+            return RowCodec.to_columns(
+                self._dbi,
+                self._dbi.stream(
+                    self._sql,
+                    self._args,
+                    chunk_size=chunk_size,
+                    close_on_abort=self._temporary_dbi,
+                    cursor_class=pymysql.cursors.SSCursor,
+                    chunked=True,
+                ),
+                _datetime_dump,
+            )
+        finally:
+            self._close_dbi()
+
+    def stream(self, args=None, parse_model=False, _datetime_dump=True):
+        """
+        Execute and lazily iterate query result by an unbuffered server side cursor. See `iter`.
+        :param args: argument dict for SQL rendering
+        :param parse_model: True to yield ORM model objects, False to yield dict objects
+        :param _datetime_dump: ensure datetime and date translated to string
+        :return: a generator of query result
+        """
+        return self.iter(
+            args=args, parse_model=parse_model, _datetime_dump=_datetime_dump
+        )
+
+    async def astream(
+        self, chunk_size=1000, args=None, parse_model=False, _datetime_dump=True
+    ):
+        """
+        Awaitable `iter`, use it by `async for`. Each chunk is fetched on the executor of `Riko.get_executor`,
+        the connection is held until the iteration ends.
+        :param chunk_size: row number fetched from server per round
+        :param args: argument dict for SQL rendering
+        :param parse_model: True to yield ORM model objects, False to yield dict objects
+        :param _datetime_dump: ensure datetime and date translated to string
+        :return: an async generator of query result
+        """
+        # borrowed in the event loop, see `_arun`
+        await self._aopen_dbi()
+        rows = self.iter(
+            chunk_size=chunk_size,
+            args=args,
+            parse_model=parse_model,
+            _datetime_dump=_datetime_dump,
+        )
+        try:
+            while True:
+                chunk = await Riko.run_async(
+                    lambda: list(itertools.islice(rows, chunk_size))
+                )
+                if len(chunk) == 0:
+                    break
+                for row in chunk:
+                    yield row
+        finally:
+            await Riko.run_async(rows.close)
+            # a generator closed before started does not give it back
+            self._close_dbi()
+
     def distinct(self, is_distinct=True):
         """
         Set DISTINCT for query.
@@ -1198,6 +3017,7 @@ class SelectQuery(PaginationOrderQuery):
         )
         self._join.append(actual_join_term)
         self._join_type[actual_join_term] = "NATURAL"
+        self._join_clazz.append(join_clazz)
         return self
 
     def join(
@@ -1286,6 +3106,7 @@ class SelectQuery(PaginationOrderQuery):
         )
         self._join.append(actual_join_term)
         self._join_on[actual_join_term] = list()
+        self._join_clazz.append(join_clazz)
         if on is not None:
             if type(on) in (list, tuple):
                 self._join_on[actual_join_term].extend(on)
@@ -1310,9 +3131,13 @@ class SelectQuery(PaginationOrderQuery):
         return "DISTINCT" if self._distinct else ""
 
     def _construct_for_update_clause(self):
-        return "FOR UPDATE" if self._for_update else ""
+        if not self._for_update:
+            return ""
+        return "FOR UPDATE SKIP LOCKED" if self._skip_locked else "FOR UPDATE"
 
     def _construct_select_fields_clause(self):
+        if self._deferring:
+            return ",".join(k for k in self._clz_meta._columns if k not in self._deferring)
         if len(self._return_columns) == 0:
             return "*"
         return ",".join(self._return_columns)
@@ -1355,8 +3180,29 @@ class SelectQuery(PaginationOrderQuery):
                 )
         return join_clause
 
-    def _prepare_sql(self):
-        self._sql = SqlQuery._Select_Template
+    def _shape(self):
+        return (
+            self._clz_meta,
+            "SELECT",
+            tuple(self._return_columns),
+            self._deferring,
+            self._distinct,
+            self._alias,
+            tuple(
+                (j, self._join_type[j], tuple(self._join_on.get(j, ())))
+                for j in self._join
+            ),
+            self._where_shape(),
+            tuple(self._group_by),
+            tuple(self._having),
+            tuple(self._order_by),
+            self._limit,
+            self._offset,
+            self._for_update,
+            self._skip_locked,
+        )
+
+    def _build_sql(self):
         r_dict = {
             SqlQuery._KW_DISTINCT: self._construct_distinct_clause(),
             SqlQuery._KW_FIELDS: self._construct_select_fields_clause(),
@@ -1370,22 +3216,283 @@ class SelectQuery(PaginationOrderQuery):
             SqlQuery._KW_OFFSET: self._construct_offset_clause(),
             SqlQuery._KW_FORUPDATE: self._construct_for_update_clause(),
         }
-        self._sql = SqlRender.render(self._sql, r_dict)
+        return SqlRender.render(SqlQuery._Select_Template, r_dict)
+
+
+class PreparedQuery:
+    """
+    A query compiled once and executed repeatedly with new arguments, create it by `SqlQuery.prepare`.
+    Arguments not given when executing fall back to the ones bound when building the query.
+    Thread safe as long as each execution uses a temporary connection.
+    """
+
+    _ARG_PREFIXES = (
+        "__RIKO_WHERE_",
+        "__RIKO_SET_",
+        "__RIKO_VALUES_",
+        "__RIKO_UPSERT_",
+        "__RIKO_HAVING_",
+        "__RIKO_SEEK_",
+    )
+
+    def __init__(self, query):
+        query._prepare_sql()
+        self._query = copy.copy(query)
+        self._query._prepared = True
+        self._default_args = query._args
+        self._term_args = dict()
+        if isinstance(self._default_args, dict):
+            for arg_name in self._default_args:
+                for prefix in PreparedQuery._ARG_PREFIXES:
+                    if arg_name.startswith(prefix):
+                        term = arg_name[len(prefix):]
+                        # same term in different clauses must be given by full arg name
+                        self._term_args[term] = (
+                            None if term in self._term_args else arg_name
+                        )
+        self.sql = query._sql
+
+    def __str__(self):
+        return self.sql
+
+    def get(self, args=None, _datetime_dump=True, parse_model=False, **terms):
+        """
+        Execute and get result of query.
+        :param args: argument dict for SQL rendering
+        :param _datetime_dump: ensure datetime and date translated to string
+        :param parse_model: True to parse result to a list of ORM model objects, False to get list of dict objects
+        :param terms: key-value pair to replace values bound by `where`, `set`, `values` and so on, like `tid=5`
+        :return: see `parse_model` parameter description
+        """
+        return self._bind(args, terms).get(
+            _datetime_dump=_datetime_dump, parse_model=parse_model
+        )
+
+    def only(self, parse_model=False, _datetime_dump=True, args=None, **terms):
+        """
+        Execute and get result of query, but only one object will be returned.
+        :param parse_model: True to parse result to a ORM model object, False to get a dict object
+        :param _datetime_dump: ensure datetime and date translated to string
+        :param args: argument dict for SQL rendering
+        :param terms: key-value pair to replace values bound by `where`, `set`, `values` and so on, like `tid=5`
+        :return: a ORM model object, or None if not found
+        """
+        return self._bind(args, terms).only(
+            parse_model=parse_model, _datetime_dump=_datetime_dump
+        )
+
+    def go(self, args=None, return_last_id=False, **terms):
+        """
+        Execute the query.
+        :param args: argument dict for SQL rendering, or list of value tuples for batch insert
+        :param return_last_id: True to return last insert id, False to return affected row count
+        :param terms: key-value pair to replace values bound by `where`, `set`, `values` and so on, like `tid=5`
+        :return: see `return_last_id` parameter description
+        """
+        return self._bind(args, terms).go(return_last_id=return_last_id)
+
+    def _bind(self, args, terms):
+        bound_query = copy.copy(self._query)
+        if bound_query._temporary_dbi:
+            bound_query._dbi = None
+        if not isinstance(self._default_args, dict):
+            bound_query._args = self._default_args if args is None else args
+            return bound_query
+        bound_args = dict(self._default_args)
+        if args is not None:
+            bound_args.update(args)
+        for (k, v) in terms.items():
+            arg_name = self._term_args.get(k)
+            if arg_name is None:
+                raise Exception("Miss match or ambiguous term in prepared query: " + k)
+            bound_args[arg_name] = v
+        bound_query._args = bound_args
+        return bound_query
+
+
+class RowCodec:
+    """
+    Convert values of fetched rows by column types in cursor description,
+    so that only temporal columns are touched instead of checking every value.
+    """
+
+    _DATETIME_TYPES = frozenset((FIELD_TYPE.DATETIME, FIELD_TYPE.TIMESTAMP))
+    _DATE_TYPES = frozenset((FIELD_TYPE.DATE, FIELD_TYPE.NEWDATE))
+    _INT_TYPES = frozenset(
+        (
+            FIELD_TYPE.TINY,
+            FIELD_TYPE.SHORT,
+            FIELD_TYPE.LONG,
+            FIELD_TYPE.LONGLONG,
+            FIELD_TYPE.INT24,
+            FIELD_TYPE.YEAR,
+        )
+    )
+    _FLOAT_TYPES = frozenset((FIELD_TYPE.FLOAT, FIELD_TYPE.DOUBLE))
+
+    def __init__(self, datetime_indexes, date_indexes):
+        self._datetime_indexes = datetime_indexes
+        self._date_indexes = date_indexes
+        self._datetime_keys = None
+        self._date_keys = None
+
+    @staticmethod
+    def from_description(description, _datetime_dump=True):
+        """
+        Build a codec for a result set.
+        :param description: cursor description of the result set
+        :param _datetime_dump: ensure datetime and date translated to string, False to keep native types
+        :return: a RowCodec object, or None if no value needs conversion
+        """
+        if not _datetime_dump or not description:
+            return None
+        datetime_indexes = list()
+        date_indexes = list()
+        for (i, column_desc) in enumerate(description):
+            if column_desc[1] in RowCodec._DATETIME_TYPES:
+                datetime_indexes.append(i)
+            elif column_desc[1] in RowCodec._DATE_TYPES:
+                date_indexes.append(i)
+        if len(datetime_indexes) == 0 and len(date_indexes) == 0:
+            return None
+        return RowCodec(datetime_indexes, date_indexes)
+
+    @staticmethod
+    def from_values(row):
+        """
+        Build a codec for a row without cursor description, like one passed to `AbstractModel.deserialize`,
+        temporal columns are found by value types.
+        :param row: a dict of row
+        :return: a RowCodec object, or None if no value needs conversion
+        """
+        datetime_keys = list()
+        date_keys = list()
+        for (k, v) in row.items():
+            if v.__class__ is dt:
+                datetime_keys.append(k)
+            elif v.__class__ is date:
+                date_keys.append(k)
+        if len(datetime_keys) == 0 and len(date_keys) == 0:
+            return None
+        codec = RowCodec(None, None)
+        codec._datetime_keys = tuple(datetime_keys)
+        codec._date_keys = tuple(date_keys)
+        return codec
+
+    def convert(self, row):
+        """
+        Translate datetime and date values of a row to string in place.
+        :param row: a dict of fetched row
+        :return: the row
+        """
+        if self._datetime_keys is None:
+            # dict cursor keeps columns in description order
+            keys = tuple(row)
+            self._datetime_keys = tuple(keys[i] for i in self._datetime_indexes)
+            self._date_keys = tuple(keys[i] for i in self._date_indexes)
+        for k in self._datetime_keys:
+            v = row[k]
+            # zero datetime is fetched as string
+            if v.__class__ is dt:
+                row[k] = v.isoformat(" ", "seconds")
+        for k in self._date_keys:
+            v = row[k]
+            if v.__class__ is date:
+                row[k] = v.isoformat()
+        return row
+
+    @staticmethod
+    def to_columns(dbi, chunks, _datetime_dump=False):
+        """
+        Collect chunks of tuple rows into columns.
+        :param dbi: DBI object the chunks are fetched by, for cursor description
+        :param chunks: iterator of lists of tuple rows
+        :param _datetime_dump: ensure datetime and date translated to string
+        :return: a dict of column name to array or list of values
+        """
+        names = None
+        columns = None
+        temporal = None
+        for rows in chunks:
+            if names is None:
+                names = list()
+                columns = list()
+                temporal = list()
+                for (i, column_desc) in enumerate(dbi.last_description):
+                    name = column_desc[0]
+                    if name in names:
+                        # duplicated names of joined tables
+                        name = name + "_" + str(i)
+                    names.append(name)
+                    if column_desc[1] in RowCodec._INT_TYPES:
+                        columns.append(array.array("q"))
+                    elif column_desc[1] in RowCodec._FLOAT_TYPES:
+                        columns.append(array.array("d"))
+                    else:
+                        columns.append(list())
+                    temporal.append(
+                        _datetime_dump
+                        and (
+                            column_desc[1] in RowCodec._DATETIME_TYPES
+                            or column_desc[1] in RowCodec._DATE_TYPES
+                        )
+                    )
+            for (i, values) in enumerate(zip(*rows)):
+                if temporal[i]:
+                    values = [
+                        v.isoformat(" ", "seconds")
+                        if v.__class__ is dt
+                        else (v.isoformat() if v.__class__ is date else v)
+                        for v in values
+                    ]
+                column = columns[i]
+                if column.__class__ is list:
+                    column.extend(values)
+                    continue
+                packed = len(column)
+                try:
+                    column.extend(values)
+                except (TypeError, OverflowError):
+                    # NULL or out of range value, fall back to list
+                    del column[packed:]
+                    columns[i] = column.tolist()
+                    columns[i].extend(values)
+        if names is None:
+            if dbi.last_description is None:
+                return dict()
+            return {column_desc[0]: list() for column_desc in dbi.last_description}
+        return dict(zip(names, columns))
 
 
 class SqlRender:
+    _KW_PATTERN = re.compile(r"(\{\{__RIKO_[A-Z_]+__\}\})")
+    _compiled = dict()
+
+    @staticmethod
+    def compile(template):
+        """
+        Split a template into static text and keyword slots, once per template.
+        :param template: string template in `SqlQuery`
+        :return: tuple of template parts, keywords at odd indexes
+        """
+        parts = SqlRender._compiled.get(template)
+        if parts is None:
+            parts = tuple(SqlRender._KW_PATTERN.split(template))
+            SqlRender._compiled[template] = parts
+        return parts
+
     @staticmethod
     def render(template, args):
         """
-        Render sql naively by replace.
+        Render sql in one pass over the compiled template.
         :param template: string template in `SqlQuery`
         :param args: a dict for render
         :return: rendered sql string
         """
-        _render = template
-        for (k, v) in args.items():
-            _render = _render.replace(k, v)
-        return _render
+        parts = SqlRender.compile(template)
+        return "".join(
+            args.get(part, part) if i % 2 else part for (i, part) in enumerate(parts)
+        )
 
 
 class DictModel(AbstractModel, dict):
@@ -1393,6 +3500,8 @@ class DictModel(AbstractModel, dict):
     Basic object model in dict structure, inherit this and set `pk` and `fields`.
     """
 
+    __slots__ = ("db_config_", "_dirty", "_deferred_load", "__weakref__")
+
     # Fields list
     fields = ()
 
@@ -1404,6 +3513,27 @@ class DictModel(AbstractModel, dict):
         dict.__init__(self)
         AbstractModel.__init__(self, _db_config)
 
+    def __setitem__(self, key, value):
+        dict.__setitem__(self, key, value)
+        try:
+            self._dirty.add(key)
+        except AttributeError:
+            # unpickling sets items before restoring attributes
+            pass
+
+    def __missing__(self, key):
+        # deferred column not loaded yet
+        if key in self._deferred_set and getattr(self, "_deferred_load", None) is not None:
+            self._deferred_load.load(self)
+            if dict.__contains__(self, key):
+                return dict.__getitem__(self, key)
+        raise KeyError(key)
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self[key] = default
+        return self[key]
+
     def get_ak(self):
         if self.ak in self:
             return self[self.ak]
@@ -1413,32 +3543,104 @@ class DictModel(AbstractModel, dict):
     def set_ak(self, value):
         self[self.ak] = value
 
+    @classmethod
+    def _from_row(cls, db_conf, row):
+        try:
+            des_obj = cls(_db_config=db_conf)
+        except Exception as ce:
+            des_obj = cls()
+        cls._check_columns(row)
+        # bypass `__setitem__`, loaded values are not changes
+        dict.update(des_obj, row)
+        return des_obj
+
     def get_fields(self):
-        return self.fields
+        return self._field_names
 
     def get_columns(self):
-        return tuple(self.pk) + tuple(self.fields)
+        return self._columns
 
     def get_value(self, column):
-        return self[column] if column in self else None
+        if column in self:
+            return dict.__getitem__(self, column)
+        if column in self._deferred_set and getattr(self, "_deferred_load", None) is not None:
+            return self[column]
+        return None
 
     def set_value(self, column, value):
-        cols = self.get_columns()
-        if column in cols:
+        if column in self._column_set:
             self[column] = value
         else:
             raise Exception("Miss match column in Model: " + column)
 
+    def _fill_columns(self, row, columns):
+        for k in columns:
+            if k not in self._dirty:
+                dict.__setitem__(self, k, None if row is None else row.get(k))
+
 
 class ObjectModel(AbstractModel):
     """
     Basic object model in object mapping structure, inherit this and set `pk` and `fields`.
+    Columns are read from attributes set in `__init__` if `fields` is not declared.
     """
 
+    __slots__ = (
+        "db_config_",
+        "_dirty",
+        "_deferred_load",
+        "_model_fields",
+        "_model_columns",
+        "__weakref__",
+    )
+
+    # Attributes of ORM object, not columns
+    _object_inner_var = {"_dirty", "_deferred_load", "_model_fields", "_model_columns"}
+
+    # Default values of declared columns, filled by `ModelMeta`
+    _column_defaults = None
+
     def __init__(self, _db_config=None):
         super().__init__(_db_config)
         self._model_fields = None
         self._model_columns = None
+        if self._columns is not None:
+            defaults = self._column_defaults or {}
+            for k in self._columns:
+                object.__setattr__(self, k, defaults.get(k))
+
+    def __setattr__(self, key, value):
+        object.__setattr__(self, key, value)
+        if key not in self._abstract_inner_var and key not in ObjectModel._object_inner_var:
+            try:
+                self._dirty.add(key)
+            except AttributeError:
+                pass
+
+    def __getattr__(self, key):
+        # only called for attributes not set, deferred columns are loaded on first access
+        if key in self._deferred_set:
+            loader = getattr(self, "_deferred_load", None)
+            if loader is not None:
+                loader.load(self)
+                return object.__getattribute__(self, key)
+        raise AttributeError(
+            "'%s' object has no attribute '%s'" % (type(self).__name__, key)
+        )
+
+    @classmethod
+    def _from_row(cls, db_conf, row):
+        if cls._columns is None:
+            return super()._from_row(db_conf, row)
+        try:
+            des_obj = cls(_db_config=db_conf)
+        except Exception as ce:
+            des_obj = cls()
+        cls._check_columns(row)
+        for (k, v) in row.items():
+            # bypass `__setattr__`, loaded values are not changes
+            object.__setattr__(des_obj, k, v)
+        return des_obj
 
     def get_ak(self):
         return getattr(self, self.ak)
@@ -1450,18 +3652,24 @@ class ObjectModel(AbstractModel):
             raise Exception("Miss match auto increment column in Model: " + self.ak)
 
     def get_fields(self):
+        if self._field_names is not None:
+            return self._field_names
         if self._model_fields is None:
-            self._model_fields = list(vars(self).keys())
-            for _ik in self._abstract_inner_var:
-                self._model_fields.remove(_ik)
-            self._model_fields.remove("_model_fields")
-            self._model_fields.remove("_model_columns")
-            for pkt in self.pk:
-                self._model_fields.remove(pkt)
+            self._model_fields = [
+                k
+                for k in vars(self).keys()
+                if k not in self._abstract_inner_var
+                and k not in ObjectModel._object_inner_var
+                and k not in self.pk
+            ]
         return self._model_fields
 
     def get_columns(self):
-        return tuple(self.get_fields()) + tuple(self.pk)
+        if self._columns is not None:
+            return self._columns
+        if self._model_columns is None:
+            self._model_columns = tuple(self.get_fields()) + tuple(self.pk)
+        return self._model_columns
 
     def get_value(self, column):
         if hasattr(self, column):
@@ -1470,11 +3678,112 @@ class ObjectModel(AbstractModel):
             return None
 
     def set_value(self, column, value):
-        if hasattr(self, column):
+        if self._column_set is not None:
+            if column not in self._column_set:
+                raise Exception("Miss match column in Model: " + column)
+            setattr(self, column, value)
+        elif hasattr(self, column):
             setattr(self, column, value)
         else:
             raise Exception("Miss match column in Model: " + column)
 
+    def _forget_columns(self, columns):
+        for k in columns:
+            if k not in self._dirty:
+                try:
+                    object.__delattr__(self, k)
+                except AttributeError:
+                    pass
+
+    def _fill_columns(self, row, columns):
+        for k in columns:
+            if k not in self._dirty:
+                object.__setattr__(self, k, None if row is None else row.get(k))
+
+
+class DeferredColumns:
+    """
+    Deferred columns of model objects selected together, see `AbstractModel.deferred`.
+    When any of these objects first accesses a deferred column, the deferred columns of all of them
+    still alive are loaded by one `WHERE pk IN (...)` query.
+    Values changed before loading are kept. Objects of rows deleted meanwhile get None.
+    Iterating a `DictModel` or dumping it shows loaded columns only, call `load_deferred` first if needed.
+    """
+
+    def __init__(self, clazz, db_conf, columns, _datetime_dump=True):
+        """
+        Create a loader of deferred columns.
+        :param clazz: model class
+        :param db_conf: DB connection config the objects are loaded from
+        :param columns: deferred column names
+        :param _datetime_dump: ensure datetime and date translated to string
+        """
+        self._clz_meta = clazz
+        self._db_conf = db_conf
+        self._columns = tuple(columns)
+        self._datetime_dump = _datetime_dump
+        # id of object -> object, objects dropped by caller are not loaded
+        self._objects = weakref.WeakValueDictionary()
+        self._count = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return self._count
+
+    def __reduce__(self):
+        # objects pickled or copied before loading join a new loader when accessing
+        return DeferredColumns, (self._clz_meta, self._db_conf, self._columns, self._datetime_dump)
+
+    def add(self, obj):
+        """
+        Make an object load its deferred columns with this loader.
+        :param obj: model object selected without deferred columns
+        """
+        self._objects[id(obj)] = obj
+        self._count += 1
+        obj._forget_columns(self._columns)
+        obj._deferred_load = self
+
+    def load(self, obj=None):
+        """
+        Load deferred columns of all objects of this loader.
+        :param obj: object accessing a deferred column, it is loaded even if not added, like a copied one
+        """
+        with self._lock:
+            if obj is not None:
+                self._objects[id(obj)] = obj
+            pk_names = list(self._clz_meta.get_pk_name())
+            objs = dict()
+            for o in self._objects.values():
+                objs.setdefault(tuple(o.get_value(k) for k in pk_names), list()).append(o)
+            if len(objs) == 0:
+                return
+            if len(pk_names) == 1:
+                rows = (
+                    self._select(pk_names)
+                    .where_in(pk_names[0], [key[0] for key in objs])
+                    .get(_datetime_dump=self._datetime_dump)
+                )
+            else:
+                rows = list()
+                for key in objs:
+                    rows.extend(
+                        self._select(pk_names)
+                        .where(**dict(zip(pk_names, key)))
+                        .get(_datetime_dump=self._datetime_dump)
+                    )
+            found = {tuple(row.get(k) for k in pk_names): row for row in rows}
+            for (key, same_key_objs) in objs.items():
+                for o in same_key_objs:
+                    o._fill_columns(found.get(key), self._columns)
+                    o._deferred_load = None
+            self._objects = weakref.WeakValueDictionary()
+
+    def _select(self, pk_names):
+        return SelectQuery(
+            self._clz_meta, columns=pk_names + list(self._columns)
+        ).set_session(model_db_conf=self._db_conf, dbi=None)
+
 
 class DBI:
     """
@@ -1496,10 +3805,25 @@ class DBI:
         """
         return DBI(Riko.db_config if db_config is None else db_config)
 
-    def __init__(self, db_config):
+    def __init__(self, db_config, _conn=None, _pool=None, _connect_time=0.0):
         assert db_config is not None
         self._db_conf = db_config
-        self._conn = pymysql.connect(**db_config)
+        self._pool = _pool
+        self.max_allowed_packet = None
+        # description of the latest result set
+        self.last_description = None
+        # statements are not committed one by one inside `start_transaction`
+        self._in_transaction = False
+        # tables written inside `start_transaction`, their cached results are invalidated after commit
+        self._written_tables = set()
+        # reported to hooks by the next statement, see `QueryEvent`
+        self._ping_time = 0.0
+        if _conn is None:
+            started = time.perf_counter()
+            _conn = Driver.of(db_config).connect(db_config)
+            _connect_time = time.perf_counter() - started
+        self._connect_time = _connect_time
+        self._conn = _conn
 
     def get_config(self):
         """
@@ -1510,9 +3834,22 @@ class DBI:
 
     def close(self):
         """
-        Close the connection.
+        Close the connection, or give it back to the pool it borrowed from.
         """
-        self._conn.close()
+        if self._pool is not None:
+            if self._conn is not None:
+                self._pool.release(self._conn)
+                self._conn = None
+        elif self._conn.open:
+            self._conn.close()
+
+    def detach(self):
+        """
+        Take the connection out of its pool, it will be closed by `close` instead of given back.
+        """
+        if self._pool is not None:
+            self._pool.forget(self._conn)
+            self._pool = None
 
     def query(self, sql, args, t=None, return_pattern=RETURN_RESULT):
         """
@@ -1530,12 +3867,12 @@ class DBI:
         _reconn = False if t else True
         ret_val = None
         try:
-            _conn.ping(reconnect=_reconn)
+            if t or self._pool is None:
+                # pooled connections are checked by the pool when lent
+                self._ping(_conn, _reconn)
             cursor = self._conn.cursor()
-            # logger = logging.getLogger("ORM_QUERY")
-            # logger.info(sql)
-            # logger.info(args)
-            affected = cursor.execute(sql, args)
+            affected = self._execute(cursor, sql, args)
+            self.last_description = cursor.description
             if return_pattern == DBI.RETURN_RESULT:
                 fetched = cursor.fetchall()
                 # names = [cd[0] for cd in cursor.description]
@@ -1548,37 +3885,246 @@ class DBI:
             elif return_pattern == DBI.RETURN_AFFECTED_ROW:
                 ret_val = affected
         except Exception as ex:
-            if not t:
+            if not t and not self._in_transaction:
                 _conn.rollback()
             raise ex
         else:
-            if not t:
+            if not t and not self._in_transaction:
                 _conn.commit()
             return ret_val
 
-    def insert_many(self, sql_tpl, args, t=None):
-        """
-        Perform multiple insert query.
-        :param sql_tpl: insert sql template
-        :param args: args for insert values in tuple in list
-        :param t: connection provider
-        :return: affected row count
+    def stream(
+        self,
+        sql,
+        args,
+        chunk_size=1000,
+        close_on_abort=False,
+        cursor_class=pymysql.cursors.SSDictCursor,
+        chunked=False,
+    ):
+        """
+        Perform a raw query and fetch result lazily by an unbuffered cursor.
+        :param sql: sql to perform
+        :param args: argument dict for sql rendering
+        :param chunk_size: row number fetched from server per round
+        :param close_on_abort: True to close the connection rather than read out rest rows if not exhausted
+        :param cursor_class: unbuffered cursor class, `SSCursor` to fetch tuple rows
+        :param chunked: True to yield list of rows per round, False to yield row one by one
+        :return: a generator of dict objects
+        """
+        if self._pool is None:
+            self._ping(self._conn, True)
+        cursor = self._conn.cursor(cursor_class)
+        exhausted = False
+        # the event covers the whole fetching, unbuffered rows are counted when read
+        event = self._begin_event(sql, args)
+        started = time.perf_counter()
+        rows = 0
+        error = None
+        try:
+            cursor.execute(sql, args)
+            self.last_description = cursor.description
+            while True:
+                fetched = cursor.fetchmany(chunk_size)
+                if not fetched:
+                    break
+                rows += len(fetched)
+                if chunked:
+                    yield fetched
+                    continue
+                for row in fetched:
+                    yield row
+            exhausted = True
+        except Exception as ex:
+            error = ex
+            raise
+        finally:
+            if event is not None:
+                self._end_event(event, started, rows, error)
+            if exhausted or not close_on_abort:
+                # unbuffered cursor reads out rest rows when closing
+                cursor.close()
+                if not self._in_transaction:
+                    self._conn.commit()
+            else:
+                self._conn.close()
+
+    def get_max_allowed_packet(self):
+        """
+        Get `max_allowed_packet` of the server, cached by connection pool if pooled.
+        :return: max packet size in bytes
+        """
+        holder = self if self._pool is None else self._pool
+        if holder.max_allowed_packet is None:
+            holder.max_allowed_packet = Driver.of(self._db_conf).max_allowed_packet(
+                self._conn
+            )
+        return holder.max_allowed_packet
+
+    def insert_values(
+        self,
+        sql_head,
+        row_tpl,
+        rows,
+        sql_tail="",
+        tail_args=None,
+        max_bytes=None,
+        max_rows=None,
+        t=None,
+    ):
+        """
+        Perform multiple insert as multi-row statements, like `INSERT INTO t(a, b) VALUES (1, 2), (3, 4)`.
+        :param sql_head: sql before values rows, like "INSERT INTO t(a, b) VALUES "
+        :param row_tpl: values row template, like "(%s, %s)"
+        :param rows: args for insert values in tuple in list
+        :param sql_tail: sql after values rows, like "ON DUPLICATE KEY UPDATE b = VALUES(b)"
+        :param tail_args: argument dict for rendering `sql_tail`
+        :param max_bytes: max bytes of one statement, None to follow server `max_allowed_packet`
+        :param max_rows: max row number of one statement, None for no limit
+        :param t: connection provider
+        :return: list of affected row count of each statement
         """
         _conn = t or self._conn
         _reconn = False if t else True
+        affected = list()
         try:
-            _conn.ping(reconnect=_reconn)
+            if t or self._pool is None:
+                self._ping(_conn, _reconn)
             cursor = self._conn.cursor()
-            ret_val = cursor.executemany(sql_tpl, args)
+            if max_bytes is None:
+                # leave room for packet header and the rest of protocol overhead
+                max_bytes = self.get_max_allowed_packet() - 1024
+            if tail_args:
+                sql_tail = cursor.mogrify(sql_tail, tail_args)
+            encoding = self._conn.encoding
+            # hooks fold the statement by its template, rendered rows are all different
+            template = sql_head + row_tpl + sql_tail
+            fixed_len = len(sql_head.encode(encoding)) + len(sql_tail.encode(encoding))
+            chunk = list()
+            chunk_len = fixed_len
+            for row in rows:
+                row_sql = cursor.mogrify(row_tpl, row)
+                row_len = len(row_sql.encode(encoding)) + 1
+                if len(chunk) > 0 and (
+                    chunk_len + row_len > max_bytes
+                    or (max_rows is not None and len(chunk) >= max_rows)
+                ):
+                    affected.append(
+                        self._execute(
+                            cursor, sql_head + ",".join(chunk) + sql_tail, template=template
+                        )
+                    )
+                    chunk = list()
+                    chunk_len = fixed_len
+                chunk.append(row_sql)
+                chunk_len += row_len
+            if len(chunk) > 0:
+                affected.append(
+                    self._execute(
+                        cursor, sql_head + ",".join(chunk) + sql_tail, template=template
+                    )
+                )
         except Exception as ex:
-            if not t:
+            if not t and not self._in_transaction:
                 _conn.rollback()
             raise ex
         else:
-            if not t:
+            if not t and not self._in_transaction:
+                _conn.commit()
+            return affected
+
+    def insert_many(self, sql_tpl, args, t=None):
+        """
+        Perform multiple insert query.
+        :param sql_tpl: insert sql template
+        :param args: args for insert values in tuple in list
+        :param t: connection provider
+        :return: affected row count
+        """
+        _conn = t or self._conn
+        _reconn = False if t else True
+        try:
+            if t or self._pool is None:
+                self._ping(_conn, _reconn)
+            cursor = self._conn.cursor()
+            ret_val = self._execute(cursor, sql_tpl, args, many=True)
+        except Exception as ex:
+            if not t and not self._in_transaction:
+                _conn.rollback()
+            raise ex
+        else:
+            if not t and not self._in_transaction:
                 _conn.commit()
             return ret_val
 
+    @contextlib.contextmanager
+    def pipeline(self, max_bytes=None):
+        """
+        Collect statements in a context scope, and send them in one round trip as MySQL multi-statements
+        when the scope exits. Result of each statement is available after that, see `Pipeline`.
+        Connection must be opened with `client_flag=CLIENT.MULTI_STATEMENTS` as `Riko.pipeline` does,
+        otherwise statements are sent one by one, with a warning on MySQL.
+        Nothing is sent if the scope exits by exception.
+        :param max_bytes: max bytes sent by one round trip, None to follow server `max_allowed_packet`
+        """
+        pipe = Pipeline(self, max_bytes)
+        yield pipe
+        pipe.send()
+
+    def _ping(self, conn, reconnect):
+        started = time.perf_counter()
+        conn.ping(reconnect=reconnect)
+        self._ping_time += time.perf_counter() - started
+
+    def _execute(self, cursor, sql, args=None, many=False, template=None):
+        event = self._begin_event(sql, args, template)
+        if event is None:
+            return cursor.executemany(sql, args) if many else cursor.execute(sql, args)
+        started = time.perf_counter()
+        affected = None
+        error = None
+        try:
+            if many:
+                affected = cursor.executemany(sql, args)
+            else:
+                affected = cursor.execute(sql, args)
+            return affected
+        except Exception as ex:
+            error = ex
+            raise
+        finally:
+            self._end_event(event, started, affected, error)
+
+    def _begin_event(self, sql, args, template=None):
+        hooks = Riko.hooks
+        if not hooks:
+            return None
+        event = QueryEvent(
+            sql,
+            0 if args is None else len(args),
+            self._connect_time,
+            self._ping_time,
+            template=template,
+        )
+        self._connect_time = 0.0
+        self._ping_time = 0.0
+        for hook in hooks:
+            try:
+                hook.before(event)
+            except Exception:
+                logging.getLogger("ORM_QUERY").exception("query hook failed")
+        return event
+
+    def _end_event(self, event, started, rows, error):
+        event.duration = time.perf_counter() - started
+        event.rows = rows
+        event.error = error
+        for hook in Riko.hooks:
+            try:
+                hook.after(event)
+            except Exception:
+                logging.getLogger("ORM_QUERY").exception("query hook failed")
+
     @contextlib.contextmanager
     def start_transaction(self):
         """
@@ -1587,6 +4133,7 @@ class DBI:
         _auto_commit = self._conn.get_autocommit()
         self._conn.autocommit(False)
         self._conn.begin()
+        self._in_transaction = True
         try:
             yield self
             self._conn.commit()
@@ -1594,4 +4141,2089 @@ class DBI:
             self._conn.rollback()
             raise ex
         finally:
+            self._in_transaction = False
             self._conn.autocommit(_auto_commit)
+            # after commit, a reader caching rows before it would keep them stale
+            tables = self._written_tables
+            self._written_tables = set()
+            for table in tables:
+                SqlQuery.result_cache.invalidate(table)
+
+
+class AsyncDBI:
+    """
+    Awaitable facade of a DB connection session, blocking calls run on the executor of `Riko.get_executor`.
+    Build queries on it by `t=async_dbi.dbi` and await them with `aget`, `aonly` and `ago`.
+    """
+
+    def __init__(self, dbi):
+        assert dbi is not None
+        self.dbi = dbi
+
+    @staticmethod
+    async def connect(db_config=None, timeout=None):
+        """
+        Get a AsyncDBI object by borrowing a pooled connection, or connecting if `Riko.use_pool` is False.
+        :param db_config: DB connection config, None to use default `Riko.db_config`
+        :param timeout: seconds to wait for a free connection, None to use pool default
+        :return: AsyncDBI object, close it by `close` or use it by `async with`
+        """
+        if db_config is None:
+            db_config = Riko.db_config
+        if Riko.use_pool:
+            dbi = await Riko.get_pool(db_config).adbi(timeout)
+        else:
+            dbi = await Riko.run_async(DBI, db_config)
+        return AsyncDBI(dbi)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.close()
+
+    def get_config(self):
+        """
+        Get current session connection config.
+        :return: a dict of connection config
+        """
+        return self.dbi.get_config()
+
+    async def close(self):
+        """
+        Close the connection, or give it back to the pool it borrowed from.
+        """
+        await Riko.run_async(self.dbi.close)
+
+    async def query(self, sql, args, return_pattern=DBI.RETURN_RESULT):
+        """
+        Perform a raw query, see `DBI.query`.
+        :param sql: sql to perform
+        :param args: argument dict for sql rendering
+        :param return_pattern: result return pattern, default `RETURN_RESULT`
+        :return: see `DBI.query`
+        """
+        return await Riko.run_async(
+            self.dbi.query, sql, args, return_pattern=return_pattern
+        )
+
+    async def insert_many(self, sql_tpl, args):
+        """
+        Perform multiple insert query, see `DBI.insert_many`.
+        :param sql_tpl: insert sql template
+        :param args: args for insert values in tuple in list
+        :return: affected row count
+        """
+        return await Riko.run_async(self.dbi.insert_many, sql_tpl, args)
+
+    @contextlib.asynccontextmanager
+    async def start_transaction(self):
+        """
+        Create a scoped context with all operations as one transaction, use it by `async with`.
+        """
+        scope = self.dbi.start_transaction()
+        await Riko.run_async(scope.__enter__)
+        try:
+            yield self
+        except BaseException:
+            if not await Riko.run_async(scope.__exit__, *sys.exc_info()):
+                raise
+        else:
+            await Riko.run_async(scope.__exit__, None, None, None)
+
+
+class PipelineResult:
+    """
+    Result of a statement in `Pipeline`, available after the pipeline is sent.
+    """
+
+    __slots__ = ("_value", "_done")
+
+    def __init__(self):
+        self._value = None
+        self._done = False
+
+    @property
+    def value(self):
+        """
+        Result in the form of the `return_pattern` given when adding the statement.
+        """
+        if not self._done:
+            raise Exception("Pipeline is not sent yet")
+        return self._value
+
+    def _set(self, value):
+        self._value = value
+        self._done = True
+
+
+class Pipeline:
+    """
+    Statements sent in one round trip, create it by `DBI.pipeline`.
+    """
+
+    def __init__(self, dbi, max_bytes=None):
+        self._dbi = dbi
+        self._max_bytes = max_bytes
+        # (sql, args, return pattern, result, query, datetime dump)
+        self._pending = list()
+
+    def __len__(self):
+        return len(self._pending)
+
+    def query(self, sql, args=None, return_pattern=DBI.RETURN_RESULT):
+        """
+        Add a raw statement.
+        :param sql: sql to perform
+        :param args: argument dict for sql rendering
+        :param return_pattern: result return pattern except `RETURN_CURSOR`, default `RETURN_RESULT`
+        :return: a PipelineResult object
+        """
+        assert return_pattern != DBI.RETURN_CURSOR
+        return self._add(sql, args, return_pattern, None, False)
+
+    def get(self, query, args=None, _datetime_dump=True):
+        """
+        Add a query built by Riko, its result is list of dict objects like `SqlQuery.get`.
+        :param query: a SqlQuery object
+        :param args: argument dict for SQL rendering
+        :param _datetime_dump: ensure datetime and date translated to string
+        :return: a PipelineResult object
+        """
+        return self._add_query(query, args, DBI.RETURN_RESULT, _datetime_dump)
+
+    def go(self, query, args=None, return_last_id=False):
+        """
+        Add a query built by Riko, its result is like `SqlQuery.go`.
+        :param query: a SqlQuery object, batch insert is not supported
+        :param args: argument dict for SQL rendering
+        :param return_last_id: True to return last insert id, False to return affected row count
+        :return: a PipelineResult object
+        """
+        return self._add_query(
+            query,
+            args,
+            DBI.RETURN_LAST_ROW_ID if return_last_id else DBI.RETURN_AFFECTED_ROW,
+            False,
+        )
+
+    def _add_query(self, query, args, return_pattern, _datetime_dump):
+        assert not query._is_batch
+        query._prepare_sql()
+        query_args = dict(query._args)
+        if args is not None:
+            query_args.update(args)
+        return self._add(query._sql, query_args, return_pattern, query, _datetime_dump)
+
+    def _add(self, sql, args, return_pattern, query, _datetime_dump):
+        result = PipelineResult()
+        self._pending.append((sql, args, return_pattern, result, query, _datetime_dump))
+        return result
+
+    def send(self):
+        """
+        Send all added statements, statements after a failed one are not executed.
+        """
+        pending = self._pending
+        self._pending = list()
+        if len(pending) == 0:
+            return
+        dbi = self._dbi
+        try:
+            if dbi._conn.client_flag & CLIENT.MULTI_STATEMENTS:
+                self._send_multi(pending)
+            else:
+                if len(pending) > 1 and Driver.of(dbi.get_config()).name == "mysql":
+                    logging.getLogger("ORM_QUERY").warning(
+                        "connection without CLIENT.MULTI_STATEMENTS, pipeline sends %d statements one by one",
+                        len(pending),
+                    )
+                for (sql, args, return_pattern, result, _, _datetime_dump) in pending:
+                    value = dbi.query(sql, args, return_pattern=return_pattern)
+                    result._set(Pipeline._convert(dbi, value, return_pattern, _datetime_dump))
+        finally:
+            for (_, _, _, _, query, _) in pending:
+                if query is not None and query._writes_table:
+                    query._after_write()
+
+    def _send_multi(self, pending):
+        dbi = self._dbi
+        _conn = dbi._conn
+        try:
+            if dbi._pool is None:
+                dbi._ping(_conn, True)
+            cursor = _conn.cursor()
+            max_bytes = self._max_bytes
+            if max_bytes is None:
+                max_bytes = dbi.get_max_allowed_packet() - 1024
+            encoding = _conn.encoding
+            batch = list()
+            batch_len = 0
+            for entry in pending:
+                sql = cursor.mogrify(entry[0], entry[1])
+                sql_len = len(sql.encode(encoding)) + 2
+                if len(batch) > 0 and batch_len + sql_len > max_bytes:
+                    self._execute_batch(cursor, batch)
+                    batch = list()
+                    batch_len = 0
+                batch.append((sql, entry))
+                batch_len += sql_len
+            if len(batch) > 0:
+                self._execute_batch(cursor, batch)
+        except Exception as ex:
+            if not dbi._in_transaction:
+                _conn.rollback()
+            raise ex
+        else:
+            if not dbi._in_transaction:
+                _conn.commit()
+
+    def _execute_batch(self, cursor, batch):
+        dbi = self._dbi
+        # escaped already, `%` in statements must not be formatted again
+        dbi._execute(
+            cursor,
+            ";\n".join(sql for (sql, _) in batch),
+            template=";\n".join(entry[0] for (_, entry) in batch),
+        )
+        for (i, (_, entry)) in enumerate(batch):
+            (_, _, return_pattern, result, _, _datetime_dump) = entry
+            if i > 0:
+                cursor.nextset()
+            dbi.last_description = cursor.description
+            if return_pattern == DBI.RETURN_RESULT:
+                value = cursor.fetchall()
+            elif return_pattern == DBI.RETURN_LAST_ROW_ID:
+                value = cursor.lastrowid
+            elif return_pattern == DBI.RETURN_AFFECTED_ROW:
+                value = cursor.rowcount
+            else:
+                value = None
+            result._set(Pipeline._convert(dbi, value, return_pattern, _datetime_dump))
+
+    @staticmethod
+    def _convert(dbi, value, return_pattern, _datetime_dump):
+        if return_pattern == DBI.RETURN_RESULT and _datetime_dump:
+            codec = RowCodec.from_description(dbi.last_description, True)
+            if codec is not None:
+                for row in value:
+                    codec.convert(row)
+        return value
+
+
+class DBIPool:
+    """
+    Bounded and thread safe pool of DB connections sharing one config.
+    At most `max_size` connections are open at the same time, borrowers wait when all are lent.
+    """
+
+    def __init__(
+        self, db_config, max_size=10, max_idle=None, ping_interval=30, timeout=None
+    ):
+        """
+        Create a connection pool, connections are opened lazily.
+        :param db_config: a dict for pymysql connection
+        :param max_size: max number of connections opened by this pool
+        :param max_idle: max number of idle connections kept, None to keep up to `max_size`
+        :param ping_interval: seconds of idle before a connection is pinged when lent, 0 to always ping
+        :param timeout: default seconds to wait for a free connection, None to wait forever
+        """
+        assert db_config is not None
+        assert max_size > 0
+        self._db_conf = db_config
+        self._max_size = max_size
+        self._max_idle = max_size if max_idle is None else max_idle
+        self._ping_interval = ping_interval
+        self._timeout = timeout
+        self.max_allowed_packet = None
+        self._idle = collections.deque()
+        self._cond = threading.Condition()
+        # (event loop, future) of coroutines waiting in `adbi`
+        self._async_waiters = list()
+        self._size = 0
+        self._closed = False
+        self._stats = collections.Counter()
+        if db_config.get("driver", "mysql") == "mysql":
+            self.name = "%s@%s:%s/%s" % (
+                db_config.get("user"),
+                db_config.get("host"),
+                db_config.get("port"),
+                db_config.get("database"),
+            )
+        else:
+            self.name = "%s:%s" % (db_config.get("driver"), db_config.get("database"))
+
+    def get_config(self):
+        """
+        Get connection config of this pool.
+        :return: a dict of connection config
+        """
+        return self._db_conf
+
+    def dbi(self, timeout=None):
+        """
+        Borrow a connection as a DBI object, `DBI.close` gives it back.
+        :param timeout: seconds to wait for a free connection, None to use pool default
+        :return: a DBI object
+        """
+        started = time.perf_counter()
+        conn = self.acquire(timeout)
+        return DBI(
+            self._db_conf,
+            _conn=conn,
+            _pool=self,
+            _connect_time=time.perf_counter() - started,
+        )
+
+    async def adbi(self, timeout=None):
+        """
+        Awaitable `dbi`, waiting for a free connection in the event loop rather than in a thread,
+        only opening and pinging connections run on the executor of `Riko.get_executor`.
+        :param timeout: seconds to wait for a free connection, None to use pool default
+        :return: a DBI object
+        """
+        if timeout is None:
+            timeout = self._timeout
+        loop = asyncio.get_running_loop()
+        deadline = None if timeout is None else loop.time() + timeout
+        started = time.perf_counter()
+        waited = False
+        while True:
+            with self._cond:
+                taken = self._take_now()
+                if taken is None:
+                    if not waited:
+                        self._stats["waited"] += 1
+                        waited = True
+                    waiter = loop.create_future()
+                    self._async_waiters.append((loop, waiter))
+            if taken is None:
+                remaining = None if deadline is None else deadline - loop.time()
+                try:
+                    if remaining is not None and remaining <= 0:
+                        raise asyncio.TimeoutError()
+                    await asyncio.wait_for(waiter, remaining)
+                except asyncio.TimeoutError:
+                    with self._cond:
+                        if (loop, waiter) in self._async_waiters:
+                            self._async_waiters.remove((loop, waiter))
+                        self._stats["timeouts"] += 1
+                    raise Exception("Timeout to get connection from pool: " + self.name)
+                continue
+            (conn, idle_since) = taken
+            if conn is None:
+                conn = await Riko.run_async(self._open)
+            elif time.monotonic() - idle_since >= self._ping_interval:
+                try:
+                    await Riko.run_async(conn.ping, reconnect=False)
+                except Exception:
+                    self._discard(conn, reason="ping_failed")
+                    continue
+                with self._cond:
+                    self._stats["reused"] += 1
+            else:
+                with self._cond:
+                    self._stats["reused"] += 1
+            return DBI(
+                self._db_conf,
+                _conn=conn,
+                _pool=self,
+                _connect_time=time.perf_counter() - started,
+            )
+
+    @contextlib.contextmanager
+    def connection(self, timeout=None):
+        """
+        Borrow a connection as a DBI object in a context scope.
+        :param timeout: seconds to wait for a free connection, None to use pool default
+        """
+        dbi = self.dbi(timeout)
+        try:
+            yield dbi
+        finally:
+            dbi.close()
+
+    def acquire(self, timeout=None):
+        """
+        Borrow a raw pymysql connection, it must be given back by `release`.
+        :param timeout: seconds to wait for a free connection, None to use pool default
+        :return: a pymysql connection
+        """
+        if timeout is None:
+            timeout = self._timeout
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            with self._cond:
+                conn, idle_since = self._take(deadline)
+            if conn is None:
+                return self._open()
+            if time.monotonic() - idle_since >= self._ping_interval:
+                try:
+                    conn.ping(reconnect=False)
+                except Exception:
+                    self._discard(conn, reason="ping_failed")
+                    continue
+            with self._cond:
+                self._stats["reused"] += 1
+            return conn
+
+    def release(self, conn):
+        """
+        Give a borrowed connection back.
+        :param conn: pymysql connection from `acquire`
+        """
+        if conn.open and not self._closed:
+            try:
+                if conn.server_status & SERVER_STATUS.SERVER_STATUS_IN_TRANS:
+                    conn.rollback()
+            except Exception:
+                self._discard(conn)
+                return
+            with self._cond:
+                if not self._closed and len(self._idle) < self._max_idle:
+                    self._idle.append((conn, time.monotonic()))
+                    self._cond.notify()
+                    self._wake_async()
+                    return
+        self._discard(conn)
+
+    def forget(self, conn):
+        """
+        Remove a borrowed connection from the pool without closing it.
+        :param conn: pymysql connection from `acquire`
+        """
+        with self._cond:
+            self._size -= 1
+            self._stats["detached"] += 1
+            self._cond.notify()
+            self._wake_async()
+
+    def stats(self):
+        """
+        Get statistics of this pool.
+        :return: a dict of pool statistics
+        """
+        with self._cond:
+            snapshot = {
+                "max_size": self._max_size,
+                "size": self._size,
+                "idle": len(self._idle),
+                "in_use": self._size - len(self._idle),
+            }
+            for k in (
+                "created",
+                "reused",
+                "waited",
+                "timeouts",
+                "ping_failed",
+                "discarded",
+                "detached",
+                "peak_in_use",
+            ):
+                snapshot[k] = self._stats[k]
+        return snapshot
+
+    def close(self):
+        """
+        Close all idle connections, lent connections are closed when given back.
+        """
+        with self._cond:
+            self._closed = True
+            idle = list(self._idle)
+            self._idle.clear()
+            self._size -= len(idle)
+            self._cond.notify_all()
+            self._wake_async()
+        for (conn, _) in idle:
+            try:
+                conn.close()
+            except Exception:
+                pass
+
+    def _take(self, deadline):
+        # must be called with lock held, return (None, None) when a new connection slot is reserved
+        waited = False
+        while True:
+            taken = self._take_now()
+            if taken is not None:
+                return taken
+            if not waited:
+                self._stats["waited"] += 1
+                waited = True
+            remaining = None if deadline is None else deadline - time.monotonic()
+            if remaining is not None and remaining <= 0:
+                self._stats["timeouts"] += 1
+                raise Exception("Timeout to get connection from pool: " + self.name)
+            self._cond.wait(remaining)
+
+    def _take_now(self):
+        # must be called with lock held, like `_take` but return None rather than wait if all are lent
+        if self._closed:
+            raise Exception("Connection pool is closed: " + self.name)
+        if len(self._idle) > 0:
+            conn, idle_since = self._idle.pop()
+            self._mark_lent()
+            return conn, idle_since
+        if self._size < self._max_size:
+            self._size += 1
+            self._mark_lent()
+            return None, None
+        return None
+
+    def _wake_async(self):
+        # must be called with lock held, waiters of `adbi` check the pool again
+        waiters = self._async_waiters
+        self._async_waiters = list()
+        for (loop, waiter) in waiters:
+            try:
+                loop.call_soon_threadsafe(DBIPool._set_waiter, waiter)
+            except RuntimeError:
+                # event loop closed
+                pass
+
+    @staticmethod
+    def _set_waiter(waiter):
+        if not waiter.done():
+            waiter.set_result(None)
+
+    def _mark_lent(self):
+        in_use = self._size - len(self._idle)
+        if in_use > self._stats["peak_in_use"]:
+            self._stats["peak_in_use"] = in_use
+
+    def _open(self):
+        try:
+            conn = Driver.of(self._db_conf).connect(self._db_conf)
+        except Exception:
+            with self._cond:
+                self._size -= 1
+                self._cond.notify()
+                self._wake_async()
+            raise
+        with self._cond:
+            self._stats["created"] += 1
+        return conn
+
+    def _discard(self, conn, reason="discarded"):
+        try:
+            conn.close()
+        except Exception:
+            pass
+        with self._cond:
+            self._size -= 1
+            self._stats[reason] += 1
+            self._cond.notify()
+            self._wake_async()
+
+
+class Driver:
+    """
+    DB driver of Riko, chosen by `driver` term of db config, default "mysql".
+    A driver opens connections behaving like pymysql ones: `cursor`, `commit`, `rollback`, `ping` and so on.
+    """
+
+    # Name used as `driver` term of db config
+    name = None
+
+    _drivers = dict()
+
+    @staticmethod
+    def register(driver):
+        """
+        Register a driver.
+        :param driver: a Driver object
+        """
+        Driver._drivers[driver.name] = driver
+
+    @staticmethod
+    def of(db_config):
+        """
+        Get the driver of a db config.
+        :param db_config: DB connection config
+        :return: a Driver object
+        """
+        name = db_config.get("driver", "mysql")
+        driver = Driver._drivers.get(name)
+        if driver is None:
+            raise Exception("Unknown DB driver: " + str(name))
+        return driver
+
+    @abstractmethod
+    def connect(self, db_config):
+        """
+        Open a connection.
+        :param db_config: DB connection config
+        :return: a pymysql like connection
+        """
+        pass
+
+    @abstractmethod
+    def max_allowed_packet(self, conn):
+        """
+        Get max bytes of one statement.
+        :param conn: connection opened by `connect`
+        :return: max packet size in bytes
+        """
+        pass
+
+
+class MySQLDriver(Driver):
+    """
+    MySQL by pymysql.
+    """
+
+    name = "mysql"
+
+    def connect(self, db_config):
+        if "driver" in db_config:
+            db_config = {k: v for (k, v) in db_config.items() if k != "driver"}
+        return pymysql.connect(**db_config)
+
+    def max_allowed_packet(self, conn):
+        cursor = conn.cursor()
+        cursor.execute("SELECT @@max_allowed_packet")
+        row = cursor.fetchone()
+        cursor.close()
+        return int(list(row.values())[0] if isinstance(row, dict) else row[0])
+
+
+class SqliteDriver(Driver):
+    """
+    Embedded SQLite by sqlite3, like `{"driver": "sqlite", "database": "atribot.db", "autocommit": True}`.
+    MySQL dialect of Riko is translated: `%(name)s` and `%s` parameters, `INSERT IGNORE`,
+    `ON DUPLICATE KEY UPDATE` with `VALUES(column)`, and `FOR UPDATE [SKIP LOCKED]` which is dropped
+    since SQLite locks the whole database when writing. Needs SQLite 3.35 or later for upsert.
+    Date and time values are stored and returned as strings like "2022-03-25 21:34:00".
+    `database` is required. A plain ":memory:" is refused since every pooled connection would get its own empty
+    database, use a shared in-memory URI like "file:atribot?mode=memory&cache=shared" instead.
+    """
+
+    name = "sqlite"
+
+    # SQLite has no packet limit, keep multi-row statements in a reasonable size
+    MAX_STATEMENT_BYTES = 16 * 1024 * 1024
+
+    _LITERAL = re.compile(r"('(?:[^']|'')*')")
+    _PLACEHOLDER = re.compile(r"%\(([^)]*)\)s|%s|%%")
+    _INSERT_IGNORE = re.compile(r"\bINSERT\s+IGNORE\b", re.IGNORECASE)
+    _UPSERT = re.compile(r"\bON\s+DUPLICATE\s+KEY\s+UPDATE\b", re.IGNORECASE)
+    _UPSERT_VALUES = re.compile(r"\bVALUES\s*\(\s*`?(\w+)`?\s*\)", re.IGNORECASE)
+    _FOR_UPDATE = re.compile(r"\bFOR\s+UPDATE(?:\s+SKIP\s+LOCKED)?\b", re.IGNORECASE)
+    _EXPLAIN = re.compile(r"^\s*EXPLAIN\s+", re.IGNORECASE)
+
+    _ERRORS = (
+        (sqlite3.IntegrityError, pymysql.err.IntegrityError),
+        (sqlite3.OperationalError, pymysql.err.OperationalError),
+        (sqlite3.ProgrammingError, pymysql.err.ProgrammingError),
+        (sqlite3.DataError, pymysql.err.DataError),
+        (sqlite3.NotSupportedError, pymysql.err.NotSupportedError),
+        (sqlite3.InterfaceError, pymysql.err.InterfaceError),
+        (sqlite3.DatabaseError, pymysql.err.DatabaseError),
+    )
+
+    def connect(self, db_config):
+        return SqliteConnection(db_config)
+
+    def max_allowed_packet(self, conn):
+        return SqliteDriver.MAX_STATEMENT_BYTES
+
+    @staticmethod
+    def translate(sql, args):
+        """
+        Translate a statement of MySQL dialect for SQLite.
+        :param sql: statement with `%(name)s` or `%s` parameters
+        :param args: argument dict or tuple, None if `sql` is not to be formatted
+        :return: (translated statement, list of parameter names or positions)
+        """
+        if args is None:
+            return SqliteDriver._translate(sql, False)
+        return SqliteDriver._translate_cached(sql)
+
+    @staticmethod
+    @functools.lru_cache(maxsize=1024)
+    def _translate_cached(sql):
+        return SqliteDriver._translate(sql, True)
+
+    @staticmethod
+    def _translate(sql, formatting):
+        sql = SqliteDriver._EXPLAIN.sub("EXPLAIN QUERY PLAN ", sql, count=1)
+        params = list()
+        translated = list()
+        in_upsert = False
+        for (i, part) in enumerate(SqliteDriver._LITERAL.split(sql)):
+            if i % 2 == 1:
+                # string literal
+                translated.append(part)
+                continue
+            part = SqliteDriver._INSERT_IGNORE.sub("INSERT OR IGNORE", part)
+            part = SqliteDriver._FOR_UPDATE.sub("", part)
+            pieces = SqliteDriver._UPSERT.split(part, 1)
+            if len(pieces) == 2:
+                part = pieces[0] + "ON CONFLICT DO UPDATE SET" + pieces[1]
+                upsert_from = len(pieces[0])
+                in_upsert = True
+            else:
+                upsert_from = 0
+            if in_upsert:
+                part = part[:upsert_from] + SqliteDriver._UPSERT_VALUES.sub(
+                    r"excluded.\1", part[upsert_from:]
+                )
+            if formatting:
+                part = SqliteDriver._PLACEHOLDER.sub(
+                    lambda m: SqliteDriver._placeholder(m, params), part
+                )
+            translated.append(part)
+        return "".join(translated), params
+
+    @staticmethod
+    def _placeholder(match, params):
+        if match.group(0) == "%%":
+            return "%"
+        params.append(match.group(1) if match.group(1) is not None else len(params))
+        return "?"
+
+    @staticmethod
+    def bind(params, args):
+        """
+        Get positional parameters of a translated statement.
+        :param params: parameter names or positions from `translate`
+        :param args: argument dict or tuple
+        :return: tuple of SQLite compatible values
+        """
+        if isinstance(args, dict):
+            return tuple(SqliteDriver.adapt(args[p]) for p in params)
+        return tuple(SqliteDriver.adapt(v) for v in args)
+
+    @staticmethod
+    def adapt(value):
+        """
+        Convert a value to a type SQLite stores.
+        """
+        if isinstance(value, dt):
+            return value.strftime("%Y-%m-%d %H:%M:%S")
+        if isinstance(value, date):
+            return value.strftime("%Y-%m-%d")
+        if isinstance(value, Decimal):
+            return str(value)
+        if isinstance(value, bool):
+            return int(value)
+        return value
+
+    @staticmethod
+    def literal(value):
+        """
+        Render a value as SQLite literal.
+        """
+        value = SqliteDriver.adapt(value)
+        if value is None:
+            return "NULL"
+        if isinstance(value, (int, float)):
+            return repr(value)
+        if isinstance(value, (bytes, bytearray)):
+            return "X'" + bytes(value).hex() + "'"
+        return "'" + str(value).replace("'", "''") + "'"
+
+    @staticmethod
+    def wrap_error(ex):
+        """
+        Get the pymysql exception of a sqlite3 exception, so that callers catch the same errors.
+        """
+        for (sqlite_error, mysql_error) in SqliteDriver._ERRORS:
+            if isinstance(ex, sqlite_error):
+                return mysql_error(*ex.args)
+        return ex
+
+
+class SqliteConnection:
+    """
+    sqlite3 connection behaving like a pymysql one, opened by `SqliteDriver`.
+    """
+
+    encoding = "utf8"
+    client_flag = 0
+
+    def __init__(self, db_config):
+        database = db_config.get("database")
+        if not database:
+            raise Exception("SQLite config needs a `database` file")
+        if database == ":memory:":
+            raise Exception(
+                "SQLite :memory: is not shared by pooled connections, "
+                "use a URI like file:name?mode=memory&cache=shared"
+            )
+        self._db = sqlite3.connect(
+            database,
+            timeout=db_config.get("timeout", 5.0),
+            isolation_level=None,
+            # pooled connections are used by one thread at a time
+            check_same_thread=False,
+            uri=database.startswith("file:"),
+        )
+        if "mode=memory" not in database:
+            self._db.execute("PRAGMA journal_mode = WAL")
+            self._db.execute("PRAGMA synchronous = NORMAL")
+        self._autocommit = bool(db_config.get("autocommit", False))
+        self._cursor_class = db_config.get("cursorclass", pymysql.cursors.Cursor)
+        self.open = True
+
+    @property
+    def server_status(self):
+        return SERVER_STATUS.SERVER_STATUS_IN_TRANS if self._db.in_transaction else 0
+
+    def cursor(self, cursor_class=None):
+        if cursor_class is None:
+            cursor_class = self._cursor_class
+        return SqliteCursor(
+            self,
+            as_dict=issubclass(cursor_class, pymysql.cursors.DictCursorMixin),
+            unbuffered=issubclass(cursor_class, pymysql.cursors.SSCursor),
+        )
+
+    def ping(self, reconnect=True):
+        if not self.open:
+            raise pymysql.err.InterfaceError(0, "Connection is closed")
+
+    def get_autocommit(self):
+        return self._autocommit
+
+    def autocommit(self, value):
+        self._autocommit = bool(value)
+
+    def begin(self):
+        # take the write lock at once as `FOR UPDATE` would, a deferred transaction reading first
+        # fails rather than waits when another connection writes before it
+        if not self._db.in_transaction:
+            self._db.execute("BEGIN IMMEDIATE")
+
+    def commit(self):
+        if self._db.in_transaction:
+            self._db.execute("COMMIT")
+
+    def rollback(self):
+        if self._db.in_transaction:
+            self._db.execute("ROLLBACK")
+
+    def close(self):
+        if self.open:
+            self._db.close()
+            self.open = False
+
+    def _before_execute(self):
+        # MySQL opens a transaction implicitly when autocommit is off
+        if not self._autocommit and not self._db.in_transaction:
+            self._db.execute("BEGIN")
+
+
+class SqliteCursor:
+    """
+    sqlite3 cursor behaving like a pymysql one, rows are fetched into memory unless unbuffered.
+    """
+
+    def __init__(self, conn, as_dict=False, unbuffered=False):
+        self._conn = conn
+        self._cursor = conn._db.cursor()
+        self._as_dict = as_dict
+        self._unbuffered = unbuffered
+        self._rows = list()
+        self._names = None
+        self.description = None
+        self.rowcount = -1
+        self.lastrowid = None
+
+    def execute(self, sql, args=None):
+        (sql, params) = SqliteDriver.translate(sql, args)
+        try:
+            self._conn._before_execute()
+            self._cursor.execute(sql, () if args is None else SqliteDriver.bind(params, args))
+        except sqlite3.Error as ex:
+            raise SqliteDriver.wrap_error(ex) from ex
+        return self._after_execute()
+
+    def executemany(self, sql, args):
+        args = list(args)
+        if len(args) == 0:
+            return 0
+        (sql, params) = SqliteDriver.translate(sql, args[0])
+        try:
+            self._conn._before_execute()
+            self._cursor.executemany(sql, [SqliteDriver.bind(params, a) for a in args])
+        except sqlite3.Error as ex:
+            raise SqliteDriver.wrap_error(ex) from ex
+        return self._after_execute()
+
+    def _after_execute(self):
+        self.description = self._cursor.description
+        self.lastrowid = self._cursor.lastrowid
+        self._rows = list()
+        if self.description is None:
+            self.rowcount = self._cursor.rowcount
+            return self.rowcount
+        self._names = [d[0] for d in self.description]
+        if self._unbuffered:
+            self.rowcount = -1
+            return 0
+        self._rows = self._convert(self._cursor.fetchall())
+        self.rowcount = len(self._rows)
+        return self.rowcount
+
+    def _convert(self, rows):
+        if not self._as_dict:
+            return rows
+        names = self._names
+        return [dict(zip(names, row)) for row in rows]
+
+    def mogrify(self, sql, args=None):
+        if args is None:
+            return sql
+        if isinstance(args, dict):
+            return sql % {k: SqliteDriver.literal(v) for (k, v) in args.items()}
+        return sql % tuple(SqliteDriver.literal(v) for v in args)
+
+    def fetchone(self):
+        rows = self.fetchmany(1)
+        return rows[0] if len(rows) > 0 else None
+
+    def fetchmany(self, size=1):
+        if self._unbuffered:
+            return self._convert(self._cursor.fetchmany(size))
+        fetched = self._rows[:size]
+        self._rows = self._rows[size:]
+        return fetched
+
+    def fetchall(self):
+        if self._unbuffered:
+            return self._convert(self._cursor.fetchall())
+        fetched = self._rows
+        self._rows = list()
+        return fetched
+
+    def nextset(self):
+        return None
+
+    def close(self):
+        self._cursor.close()
+
+
+Driver.register(MySQLDriver())
+Driver.register(SqliteDriver())
+
+
+class Session:
+    """
+    Unit of work bound to one db config, open it by `Riko.session`.
+    While open, `insert`, `save`, `patch` and `delete` of models in this thread are queued instead of executed,
+    and flushed grouped by model and operation as batched statements in one transaction.
+    Tracked objects are kept in an identity map by primary key.
+    """
+
+    _local = threading.local()
+
+    def __init__(self, db_config=None):
+        self._db_conf = Riko.db_config if db_config is None else db_config
+        self._pool_key = Riko._pool_key(self._db_conf)
+        # (model class, primary key values) -> object
+        self._identity = dict()
+        # id of object -> (object, on duplicate key operation, ON DUPLICATE KEY UPDATE terms)
+        self._inserts = dict()
+        # (model class, primary key values) -> primary key dict, changed terms
+        self._updates = dict()
+        # (object, columns) saved, their changes are given back if discarded
+        self._saved = list()
+        # (model class, primary key values) -> primary key dict
+        self._deletes = dict()
+
+    @staticmethod
+    def current(db_config=None):
+        """
+        Get the session opened in this thread for a db config.
+        :param db_config: DB connection config, None to use default `Riko.db_config`
+        :return: a Session object, or None if no session is open for the config
+        """
+        stack = getattr(Session._local, "stack", None)
+        if not stack:
+            return None
+        if db_config is None:
+            db_config = Riko.db_config
+        for session in reversed(stack):
+            if db_config is session._db_conf or Riko._pool_key(db_config) == session._pool_key:
+                return session
+        return None
+
+    @staticmethod
+    def _push(session):
+        stack = getattr(Session._local, "stack", None)
+        if stack is None:
+            stack = Session._local.stack = list()
+        stack.append(session)
+
+    @staticmethod
+    def _pop(session):
+        Session._local.stack.remove(session)
+
+    @staticmethod
+    def _identity_key(clazz, pk_dict):
+        return clazz, tuple(pk_dict.get(k) for k in clazz.get_pk_name())
+
+    def pending(self):
+        """
+        Get number of queued writes.
+        """
+        return len(self._inserts) + len(self._updates) + len(self._deletes)
+
+    def get(self, clazz, pk):
+        """
+        Get an object by primary key, the tracked one is returned if it is in this session.
+        :param clazz: model class
+        :param pk: primary key value, or a dict of primary key values for composite primary key
+        :return: a ORM model object, or None if not found or deleted in this session
+        """
+        if not isinstance(pk, dict):
+            pk_names = clazz.get_pk_name()
+            assert len(pk_names) == 1
+            pk = {pk_names[0]: pk}
+        key = Session._identity_key(clazz, pk)
+        if key in self._deletes:
+            return None
+        obj = self._identity.get(key)
+        if obj is None:
+            obj = clazz.get_one(**pk)
+            if obj is not None:
+                self._identity[key] = obj
+        return obj
+
+    def add(
+        self,
+        obj,
+        on_duplicate_key_replace=INSERT.DUPLICATE_KEY_EXCEPTION,
+        **duplicate_key_update_term
+    ):
+        """
+        Queue inserting an object, see `AbstractModel.insert`.
+        :param obj: ORM model object
+        :param on_duplicate_key_replace: operation when primary key duplicated
+        :param duplicate_key_update_term: terms for `ON DUPLICATE KEY UPDATE`
+        """
+        pk = obj.get_pk()
+        if len(pk) > 0:
+            key = Session._identity_key(type(obj), pk)
+            if key in self._deletes:
+                # the delete must reach DB first
+                self.flush()
+            self._identity[key] = obj
+        self._inserts[id(obj)] = (obj, on_duplicate_key_replace, duplicate_key_update_term)
+
+    def save(self, obj, ignore_columns=None, full=False):
+        """
+        Queue flushing changes of an object, see `AbstractModel.save`.
+        :param obj: ORM model object
+        :param ignore_columns: the columns to be ignore when update, such as `update_time`
+        :param full: True to write all columns, False to write changed columns only
+        """
+        if id(obj) in self._inserts:
+            # values are read when inserting
+            return
+        ignore_columns = set() if ignore_columns is None else set(ignore_columns)
+        if obj.auto_update_ignore is not None:
+            ignore_columns.update(obj.auto_update_ignore)
+        changes = dict()
+        for k in obj.columns():
+            if k not in ignore_columns and (full or k in obj._dirty):
+                changes[k] = obj.get_value(k)
+        if len(changes) == 0:
+            return
+        pk = obj.get_pk()
+        self._queue_update(type(obj), pk, changes)
+        self._identity[Session._identity_key(type(obj), pk)] = obj
+        obj._dirty.difference_update(changes)
+        self._saved.append((obj, tuple(changes)))
+
+    def patch(self, clazz, pk, **changes):
+        """
+        Queue updating fields of a record by primary key, see `AbstractModel.patch`.
+        :param clazz: model class
+        :param pk: a dict of primary key values
+        :param changes: key-value pair of fields to update, like `status=1`
+        """
+        if len(changes) > 0:
+            self._queue_update(clazz, pk, changes)
+
+    def delete(self, obj):
+        """
+        Queue deleting an object, see `AbstractModel.delete`.
+        :param obj: ORM model object
+        """
+        if self._inserts.pop(id(obj), None) is not None:
+            # never reached DB
+            return
+        pk = obj.get_pk()
+        key = Session._identity_key(type(obj), pk)
+        self._updates.pop(key, None)
+        self._identity.pop(key, None)
+        self._deletes[key] = pk
+
+    def _queue_update(self, clazz, pk, changes):
+        key = Session._identity_key(clazz, pk)
+        if key in self._deletes:
+            raise Exception("Update a deleted record in session: " + clazz.__name__)
+        queued = self._updates.get(key)
+        if queued is None:
+            self._updates[key] = (dict(pk), dict(changes))
+        else:
+            queued[1].update(changes)
+
+    def flush(self):
+        """
+        Write all queued inserts, updates and deletes in one transaction.
+        They are kept queued if failed, call `discard` to drop them.
+        :return: total affected row count
+        """
+        if self.pending() == 0:
+            return 0
+        if Riko.use_pool:
+            dbi = Riko.get_pool(self._db_conf).dbi()
+        else:
+            dbi = DBI(self._db_conf)
+        tables = set()
+        try:
+            with dbi.start_transaction():
+                affected = self._flush_inserts(dbi, tables)
+                affected += self._flush_updates(dbi, tables)
+                affected += self._flush_deletes(dbi, tables)
+        finally:
+            dbi.close()
+            # statements invalidate by themselves before commit, do it again after
+            for table in tables:
+                SqlQuery.result_cache.invalidate(table)
+        for (obj, _, _) in self._inserts.values():
+            obj.mark_clean()
+            pk = obj.get_pk()
+            if len(pk) > 0:
+                self._identity[Session._identity_key(type(obj), pk)] = obj
+        self._inserts.clear()
+        self._updates.clear()
+        self._deletes.clear()
+        self._saved = list()
+        return affected
+
+    def discard(self):
+        """
+        Drop all queued writes, changes of saved objects are marked as changed again.
+        """
+        for (obj, columns) in self._saved:
+            obj._dirty.update(columns)
+        self._inserts.clear()
+        self._updates.clear()
+        self._deletes.clear()
+        self._saved = list()
+
+    def _flush_inserts(self, dbi, tables):
+        affected = 0
+        groups = collections.OrderedDict()
+        for (obj, operation, update_terms) in self._inserts.values():
+            clazz = type(obj)
+            tables.add(clazz.__name__)
+            ak = obj.get_ak_name()
+            if ak is not None and obj.get_ak() is None:
+                # auto increment id of each row is needed, insert one by one in the transaction
+                obj.insert(dbi, operation, **update_terms)
+                affected += 1
+                continue
+            if operation != INSERT.DUPLICATE_KEY_UPDATE:
+                update_terms = {}
+            columns = tuple(k for k in obj.columns() if obj.get_value(k) is not None)
+            group_key = (
+                clazz,
+                operation,
+                tuple(sorted((k, repr(v)) for (k, v) in update_terms.items())),
+                columns,
+            )
+            group = groups.get(group_key)
+            if group is None:
+                group = groups[group_key] = (update_terms, list())
+            group[1].append(tuple(obj.get_value(k) for k in columns))
+        for ((clazz, operation, _, columns), (update_terms, rows)) in groups.items():
+            affected += (
+                BatchInsertQuery(clazz)
+                .set_session(model_db_conf=None, dbi=dbi)
+                .ignore(operation == INSERT.DUPLICATE_KEY_IGNORE)
+                .replace(operation == INSERT.DUPLICATE_KEY_REPLACE)
+                .on_duplicate_key_update(**update_terms)
+                .values(columns, rows)
+                .go()
+            )
+        return affected
+
+    def _flush_updates(self, dbi, tables):
+        affected = 0
+        groups = collections.OrderedDict()
+        for ((clazz, _), queued) in self._updates.items():
+            groups.setdefault(clazz, list()).append(queued)
+        for (clazz, queued) in groups.items():
+            tables.add(clazz.__name__)
+            pk_names = clazz.get_pk_name()
+            if len(pk_names) == 1:
+                rows = [dict(changes, **pk) for (pk, changes) in queued]
+                affected += clazz.update_many(pk_names[0], rows, t=dbi)
+                continue
+            for (pk, changes) in queued:
+                affected += clazz.update_query(t=dbi).set(**changes).where(**pk).go()
+        return affected
+
+    def _flush_deletes(self, dbi, tables):
+        affected = 0
+        groups = collections.OrderedDict()
+        for ((clazz, _), pk) in self._deletes.items():
+            groups.setdefault(clazz, list()).append(pk)
+        for (clazz, pks) in groups.items():
+            tables.add(clazz.__name__)
+            pk_names = clazz.get_pk_name()
+            if len(pk_names) == 1:
+                values = [pk[pk_names[0]] for pk in pks]
+                affected += clazz.delete_query(t=dbi).where_in(pk_names[0], values).go()
+                continue
+            for pk in pks:
+                affected += clazz.delete_query(t=dbi).where(**pk).go()
+        return affected
+
+
+class LoadResult:
+    """
+    Result of a primary key lookup in `BatchLoader`, loaded with the rest of its batch when `value` is read.
+    """
+
+    __slots__ = ("_loader", "_value", "_error", "_done")
+
+    def __init__(self, loader):
+        self._loader = loader
+        self._value = None
+        self._error = None
+        self._done = False
+
+    @property
+    def value(self):
+        """
+        The ORM model object, or None if not found.
+        """
+        if not self._done:
+            self._loader.dispatch()
+        if self._error is not None:
+            raise self._error
+        return self._value
+
+    def _set(self, value, error=None):
+        self._value = value
+        self._error = error
+        self._done = True
+
+
+class BatchLoader:
+    """
+    Primary key loader in the way of DataLoader, open it by `Riko.batch_load`, or use `Model.aload`.
+    Requested keys are collected and loaded by one `WHERE pk IN (...)` query per model when any result is needed,
+    long key lists are split by `ConditionQuery.in_chunk_size`. Loaded objects are kept by primary key
+    until the loader is closed or the model is written in this thread, so each key is queried once.
+    Composite primary keys are loaded one by one.
+    """
+
+    _local = threading.local()
+    _loop_loaders = weakref.WeakKeyDictionary()
+
+    def __init__(self, db_config=None, cache=True):
+        """
+        Create a loader.
+        :param db_config: DB connection config, None to use default `Riko.db_config`
+        :param cache: True to keep loaded objects, False to query again for keys requested after loading
+        """
+        self._db_conf = Riko.db_config if db_config is None else db_config
+        self._pool_key = Riko._pool_key(self._db_conf)
+        self._cache = cache
+        # model class -> primary key values -> LoadResult
+        self._pending = dict()
+        # (model class, primary key values) -> LoadResult
+        self._loaded = dict()
+        self._tick = None
+
+    @staticmethod
+    def current(db_config=None):
+        """
+        Get the loader opened in this thread for a db config.
+        :param db_config: DB connection config, None to use default `Riko.db_config`
+        :return: a BatchLoader object, or None if no loader is open for the config
+        """
+        stack = getattr(BatchLoader._local, "stack", None)
+        if not stack:
+            return None
+        if db_config is None:
+            db_config = Riko.db_config
+        for loader in reversed(stack):
+            if db_config is loader._db_conf or Riko._pool_key(db_config) == loader._pool_key:
+                return loader
+        return None
+
+    @staticmethod
+    def for_loop(db_config=None):
+        """
+        Get the loader batching requests in each tick of the running event loop for a db config.
+        :param db_config: DB connection config, None to use default `Riko.db_config`
+        :return: a BatchLoader object
+        """
+        loaders = BatchLoader._loop_loaders.setdefault(asyncio.get_running_loop(), dict())
+        key = Riko._pool_key(Riko.db_config if db_config is None else db_config)
+        loader = loaders.get(key)
+        if loader is None:
+            loader = loaders[key] = BatchLoader(db_config, cache=False)
+        return loader
+
+    @staticmethod
+    def evict(clazz):
+        """
+        Forget objects of a model loaded by loaders open in this thread, called after writing the model.
+        :param clazz: model class
+        """
+        for loader in getattr(BatchLoader._local, "stack", None) or ():
+            for key in [key for key in loader._loaded if key[0] is clazz]:
+                del loader._loaded[key]
+
+    @staticmethod
+    def _push(loader):
+        stack = getattr(BatchLoader._local, "stack", None)
+        if stack is None:
+            stack = BatchLoader._local.stack = list()
+        stack.append(loader)
+
+    @staticmethod
+    def _pop(loader):
+        BatchLoader._local.stack.remove(loader)
+
+    def load(self, clazz, pk):
+        """
+        Request an object by primary key.
+        :param clazz: model class
+        :param pk: primary key value, or a dict of primary key values for composite primary key
+        :return: a LoadResult object
+        """
+        pk_names = clazz.get_pk_name()
+        if isinstance(pk, dict):
+            key = tuple(pk.get(k) for k in pk_names)
+        else:
+            assert len(pk_names) == 1
+            key = (pk,)
+        result = self._loaded.get((clazz, key))
+        if result is not None:
+            return result
+        pending = self._pending.setdefault(clazz, dict())
+        result = pending.get(key)
+        if result is None:
+            result = pending[key] = LoadResult(self)
+        return result
+
+    def load_many(self, clazz, pks):
+        """
+        Request objects by primary keys.
+        :param clazz: model class
+        :param pks: list of primary key values
+        :return: list of LoadResult objects
+        """
+        return [self.load(clazz, pk) for pk in pks]
+
+    async def aload(self, clazz, pk):
+        """
+        Request an object by primary key, and load it with other requests made in the same event loop tick.
+        :param clazz: model class
+        :param pk: primary key value, or a dict of primary key values for composite primary key
+        :return: a ORM model object, or None if not found
+        """
+        result = self.load(clazz, pk)
+        if not result._done:
+            if self._tick is None:
+                self._tick = asyncio.ensure_future(self._dispatch_tick())
+            await asyncio.shield(self._tick)
+        return result.value
+
+    def dispatch(self):
+        """
+        Load all requested keys, one query per model.
+        :return: number of requested keys loaded
+        """
+        return self._fetch(self._take_pending())
+
+    def clear(self):
+        """
+        Forget loaded objects, so that they are queried again when requested.
+        """
+        self._loaded.clear()
+
+    async def _dispatch_tick(self):
+        # let the rest of callers in this tick request their keys
+        await asyncio.sleep(0)
+        self._tick = None
+        batch = self._take_pending()
+        for (clazz, results) in batch.items():
+            queries = self._queries(clazz, list(results))
+            try:
+                # connections are borrowed in the event loop, see `SqlQuery._arun`
+                rows = [await query._arun(query.get, parse_model=True) for query in queries]
+            except Exception as ex:
+                self._fail(clazz, results, ex)
+                continue
+            self._resolve(clazz, results, rows)
+
+    def _take_pending(self):
+        batch = self._pending
+        self._pending = dict()
+        if self._cache:
+            for (clazz, results) in batch.items():
+                for (key, result) in results.items():
+                    self._loaded[(clazz, key)] = result
+        return batch
+
+    def _fetch(self, batch):
+        loaded = 0
+        for (clazz, results) in batch.items():
+            try:
+                rows = [
+                    query.get(parse_model=True) for query in self._queries(clazz, list(results))
+                ]
+            except Exception as ex:
+                self._fail(clazz, results, ex)
+                continue
+            loaded += self._resolve(clazz, results, rows)
+        return loaded
+
+    def _queries(self, clazz, keys):
+        # one IN query, or one query per key for composite primary key
+        pk_names = clazz.get_pk_name()
+        if len(pk_names) != 1:
+            return [
+                SelectQuery(clazz)
+                .set_session(model_db_conf=self._db_conf, dbi=None)
+                .where(**dict(zip(pk_names, key)))
+                .limit(1)
+                for key in keys
+            ]
+        return [
+            SelectQuery(clazz)
+            .set_session(model_db_conf=self._db_conf, dbi=None)
+            .where_in(pk_names[0], [key[0] for key in keys])
+        ]
+
+    def _resolve(self, clazz, results, rows):
+        # set results by objects each query of `_queries` got
+        pk_names = clazz.get_pk_name()
+        found = dict()
+        for objs in rows:
+            for obj in objs:
+                key = tuple(obj.get_value(k) for k in pk_names)
+                found[key] = obj
+                found.setdefault(tuple(str(k) for k in key), obj)
+        for (key, result) in results.items():
+            obj = found.get(key)
+            if obj is None:
+                # value of other type, like "1" for 1
+                obj = found.get(tuple(str(k) for k in key))
+            result._set(obj)
+        return len(results)
+
+    def _fail(self, clazz, results, ex):
+        for (key, result) in results.items():
+            result._set(None, ex)
+            # failed keys are queried again when requested
+            self._loaded.pop((clazz, key), None)
+
+
+class BufferedWriter:
+    """
+    Write-behind buffer of inserts or upserts of one model.
+    Rows added are kept in memory and written by a background thread as multi-row statements,
+    when `max_rows` rows are buffered, the oldest one is buffered for `max_age` seconds, or `flush` is called.
+    Adding blocks when `max_pending` rows are waiting, so that a slow DB slows the producer down instead of
+    growing memory. Auto increment ids are not set back to added objects.
+    Failed rows are reported to `on_error`, or logged by logger `ORM_QUERY`, and raised by the next `flush`.
+    Call `close` when done, rows still buffered are lost if the process exits without it.
+    """
+
+    def __init__(
+        self,
+        clazz,
+        on_duplicate_key_replace=INSERT.DUPLICATE_KEY_EXCEPTION,
+        update_columns=(),
+        max_rows=500,
+        max_age=1.0,
+        max_pending=10000,
+        db_config=None,
+        on_error=None,
+    ):
+        """
+        Create a writer, its thread is started by the first row added.
+        :param clazz: model class
+        :param on_duplicate_key_replace: operation when primary key duplicated
+        :param update_columns: fields updated by `INSERT.DUPLICATE_KEY_UPDATE`, empty to update all but primary keys
+        :param max_rows: row number buffered to start writing
+        :param max_age: seconds a row is buffered at most
+        :param max_pending: max row number buffered and being written, `add` waits when reached
+        :param db_config: DB connection config, None to follow the model
+        :param on_error: callable as `on_error(rows, ex)` with list of (columns, values) failed to write
+        """
+        assert max_rows > 0 and max_pending >= max_rows
+        self._clz_meta = clazz
+        self._db_conf = clazz._DB_CONF if db_config is None else db_config
+        self._operation = on_duplicate_key_replace
+        self._update_columns = tuple(update_columns)
+        self._max_rows = max_rows
+        self._max_age = max_age
+        self._max_pending = max_pending
+        self._on_error = on_error
+        self._cond = threading.Condition()
+        self._buffer = list()
+        self._first_at = None
+        self._in_flight = 0
+        # sequence numbers of rows added, written (or failed), and requested to flush
+        self._added = 0
+        self._done = 0
+        self._flush_to = 0
+        self._error = None
+        self._thread = None
+        self._closed = False
+        self._stats = collections.Counter()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def add(self, obj=None, timeout=None, **terms):
+        """
+        Buffer a row to write.
+        :param obj: model object to insert, None to create one by `terms`
+        :param timeout: seconds to wait when the buffer is full, None to wait forever
+        :param terms: field values of the row if `obj` is not given
+        """
+        if obj is None:
+            obj = self._clz_meta.new(self._db_conf, **terms)
+        columns = tuple(k for k in obj.columns() if obj.get_value(k) is not None)
+        row = (columns, tuple(obj.get_value(k) for k in columns))
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._cond:
+            waited = False
+            while not self._closed and len(self._buffer) + self._in_flight >= self._max_pending:
+                if not waited:
+                    self._stats["waited"] += 1
+                    waited = True
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    raise Exception("Timeout to add into full BufferedWriter of " + self._clz_meta.__name__)
+                self._cond.wait(remaining)
+            if self._closed:
+                raise Exception("BufferedWriter is closed")
+            if len(self._buffer) == 0:
+                self._first_at = time.monotonic()
+            self._buffer.append(row)
+            self._added += 1
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._run, name="riko-writer-" + self._clz_meta.__name__, daemon=True
+                )
+                self._thread.start()
+            elif len(self._buffer) == 1 or len(self._buffer) >= self._max_rows:
+                # wake the writer to start timing the age, or to write
+                self._cond.notify_all()
+
+    def flush(self, timeout=None):
+        """
+        Write all rows added before this call and wait for them,
+        the first error of rows failed since last flush is raised if any.
+        :param timeout: seconds to wait, None to wait forever
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._cond:
+            target = self._added
+            self._flush_to = max(self._flush_to, target)
+            self._cond.notify_all()
+            while self._done < target:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    raise Exception("Timeout to flush BufferedWriter of " + self._clz_meta.__name__)
+                self._cond.wait(remaining)
+            (error, self._error) = (self._error, None)
+        Riko.mark_write(self._db_conf)
+        if error is not None:
+            raise error
+
+    def close(self, timeout=None):
+        """
+        Flush and stop the background thread, rows can not be added after this.
+        :param timeout: seconds to wait, None to wait forever
+        """
+        try:
+            self.flush(timeout)
+        finally:
+            with self._cond:
+                self._closed = True
+                self._cond.notify_all()
+            if self._thread is not None:
+                self._thread.join(timeout)
+
+    def stats(self):
+        """
+        Get statistics of this writer.
+        :return: a dict of writer statistics
+        """
+        with self._cond:
+            snapshot = {"buffered": len(self._buffer), "in_flight": self._in_flight}
+            for k in ("written", "failed", "batches", "waited"):
+                snapshot[k] = self._stats[k]
+        return snapshot
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while True:
+                    if len(self._buffer) > 0:
+                        age = time.monotonic() - self._first_at
+                        if (
+                            self._closed
+                            or len(self._buffer) >= self._max_rows
+                            or self._flush_to > self._done
+                            or age >= self._max_age
+                        ):
+                            break
+                        self._cond.wait(self._max_age - age)
+                    elif self._closed:
+                        return
+                    else:
+                        self._cond.wait()
+                batch = self._buffer
+                self._buffer = list()
+                self._first_at = None
+                self._in_flight = len(batch)
+            failed = self._write(batch)
+            with self._cond:
+                self._in_flight = 0
+                self._done += len(batch)
+                self._stats["written"] += len(batch) - failed
+                self._stats["failed"] += failed
+                self._cond.notify_all()
+
+    def _write(self, batch):
+        groups = collections.OrderedDict()
+        for (columns, values) in batch:
+            groups.setdefault(columns, list()).append(values)
+        failed = 0
+        for (columns, rows) in groups.items():
+            query = (
+                BatchInsertQuery(self._clz_meta)
+                .set_session(model_db_conf=self._db_conf, dbi=None)
+                .ignore(self._operation == INSERT.DUPLICATE_KEY_IGNORE)
+                .replace(self._operation == INSERT.DUPLICATE_KEY_REPLACE)
+                .values(columns, rows)
+            )
+            if self._operation == INSERT.DUPLICATE_KEY_UPDATE:
+                query.on_duplicate_key_update_values(*self._update_columns)
+            try:
+                query.go()
+                with self._cond:
+                    self._stats["batches"] += 1
+            except Exception as ex:
+                failed += len(rows)
+                with self._cond:
+                    if self._error is None:
+                        self._error = ex
+                try:
+                    if self._on_error is not None:
+                        self._on_error([(columns, values) for values in rows], ex)
+                    else:
+                        logging.getLogger("ORM_QUERY").error(
+                            "BufferedWriter of %s failed to write %d rows",
+                            self._clz_meta.__name__,
+                            len(rows),
+                            exc_info=True,
+                        )
+                except Exception:
+                    logging.getLogger("ORM_QUERY").exception("BufferedWriter on_error failed")
+        return failed
+
+
+class Bulk:
+    """
+    Bulk export and import of a model as streaming CSV or JSON lines.
+    Export reads by an unbuffered server side cursor in primary key order. Import writes multi-row statements,
+    or `LOAD DATA LOCAL INFILE` on MySQL connected with `local_infile=True`.
+    Both save a checkpoint file every batch, so an interrupted run continues from it by `resume`.
+    CSV has a header row of column names, `\\N` for NULL and backslashes doubled in values as MySQL dumps do.
+    """
+
+    FORMATS = ("csv", "jsonl")
+
+    # NULL in CSV
+    NULL = "\\N"
+
+    _TSV_ESCAPE = str.maketrans(
+        {"\\": "\\\\", "\t": "\\t", "\n": "\\n", "\r": "\\r", "\0": "\\0"}
+    )
+
+    def __init__(self, clazz, db_config=None, batch_size=1000, progress=None):
+        """
+        Create a bulk loader of a model.
+        :param clazz: model class declaring `fields`
+        :param db_config: DB connection config, None to follow the model
+        :param batch_size: row number fetched per round when exporting, or written per statement when importing
+        :param progress: callable as `progress(rows, done, total)` called every batch,
+                         `done` and `total` are bytes of file when importing, rows when exporting
+        """
+        assert clazz._columns is not None
+        self._clz_meta = clazz
+        self._db_conf = clazz._DB_CONF if db_config is None else db_config
+        self._batch_size = batch_size
+        self._progress = progress
+
+    @staticmethod
+    def format_of(path, fmt=None):
+        """
+        Get file format by name extension if not given.
+        :param path: file path
+        :param fmt: "csv" or "jsonl", None to guess
+        :return: "csv" or "jsonl"
+        """
+        if fmt is None:
+            fmt = "csv" if path.lower().endswith(".csv") else "jsonl"
+        if fmt not in Bulk.FORMATS:
+            raise Exception("Unknown bulk file format: " + str(fmt))
+        return fmt
+
+    @staticmethod
+    def checkpoint_path(path):
+        """
+        Get path of the checkpoint file of a data file.
+        """
+        return path + ".checkpoint"
+
+    def export(self, path, fmt=None, resume=False):
+        """
+        Export all rows of the model to a file.
+        :param path: file path to write
+        :param fmt: "csv" or "jsonl", None to guess by extension
+        :param resume: True to continue from the checkpoint of an interrupted export
+        :return: total row number in the file
+        """
+        fmt = Bulk.format_of(path, fmt)
+        columns = list(self._clz_meta._columns)
+        pk_names = list(self._clz_meta.get_pk_name())
+        state = self._load_checkpoint(path, fmt) if resume else None
+        if state is not None and len(pk_names) != 1:
+            raise Exception("Resuming needs a single primary key: " + self._clz_meta.__name__)
+        total = self._clz_meta.count() if self._progress is not None else None
+        query = (
+            SelectQuery(self._clz_meta, columns=columns)
+            .set_session(model_db_conf=self._db_conf, dbi=None)
+            .order_by(pk_names)
+        )
+        args = None
+        rows = 0
+        with open(path, "r+b" if state is not None else "wb") as file:
+            if state is not None:
+                file.seek(state["offset"])
+                file.truncate()
+                rows = state["rows"]
+                query.where_raw(pk_names[0] + " > %(__RIKO_BULK_AFTER)s")
+                args = {"__RIKO_BULK_AFTER": state["after"]}
+            encode = self._csv_encoder() if fmt == "csv" else Bulk._jsonl_encode
+            if state is None and fmt == "csv":
+                file.write(encode(columns))
+            last = None
+            for row in query.iter(chunk_size=self._batch_size, args=args):
+                file.write(encode(row if fmt == "jsonl" else [row[k] for k in columns]))
+                rows += 1
+                last = row
+                if rows % self._batch_size == 0:
+                    file.flush()
+                    self._save_checkpoint(path, fmt, file.tell(), rows, last, pk_names)
+                    self._report(rows, rows, total)
+        self._remove_checkpoint(path)
+        self._report(rows, rows, total)
+        return rows
+
+    def import_file(
+        self,
+        path,
+        fmt=None,
+        on_duplicate_key_replace=INSERT.DUPLICATE_KEY_IGNORE,
+        method="auto",
+        resume=False,
+    ):
+        """
+        Import rows of a file into the model table.
+        :param path: file path to read
+        :param fmt: "csv" or "jsonl", None to guess by extension
+        :param on_duplicate_key_replace: operation when primary key duplicated, see `INSERT`,
+                                         `LOAD DATA LOCAL` always ignores duplicated rows unless replacing
+        :param method: "insert" for multi-row statements, "load_data" for `LOAD DATA LOCAL INFILE`,
+                       "auto" to use `LOAD DATA` on MySQL with `local_infile` in config
+        :param resume: True to continue from the checkpoint of an interrupted import
+        :return: total row number imported from the file
+        """
+        fmt = Bulk.format_of(path, fmt)
+        method = self._import_method(method, on_duplicate_key_replace)
+        state = self._load_checkpoint(path, fmt) if resume else None
+        total = os.path.getsize(path)
+        rows = 0 if state is None else state["rows"]
+        with open(path, "rb") as file:
+            batch = list()
+            offset = 0
+            for (row, offset) in self._read(file, fmt, None if state is None else state["offset"]):
+                batch.append(row)
+                if len(batch) >= self._batch_size:
+                    rows += self._write(batch, method, on_duplicate_key_replace)
+                    batch = list()
+                    self._save_checkpoint(path, fmt, offset, rows)
+                    self._report(rows, offset, total)
+            if len(batch) > 0:
+                rows += self._write(batch, method, on_duplicate_key_replace)
+        self._remove_checkpoint(path)
+        self._report(rows, total, total)
+        return rows
+
+    def _import_method(self, method, operation):
+        if method == "auto":
+            if (
+                self._config().get("driver", "mysql") == "mysql"
+                and self._config().get("local_infile")
+                and operation != INSERT.DUPLICATE_KEY_UPDATE
+            ):
+                return "load_data"
+            return "insert"
+        if method not in ("insert", "load_data"):
+            raise Exception("Unknown bulk import method: " + str(method))
+        if method == "load_data" and operation == INSERT.DUPLICATE_KEY_UPDATE:
+            raise Exception("LOAD DATA can not update duplicated rows, use insert method")
+        return method
+
+    def _config(self):
+        return Riko.db_config if self._db_conf is None else self._db_conf
+
+    def _read(self, file, fmt, offset):
+        # yield (row dict, file offset after the row), starting from `offset`
+        position = [0]
+
+        def lines():
+            for line in file:
+                position[0] += len(line)
+                yield line.decode("utf8")
+
+        if fmt == "csv":
+            reader = csv.reader(lines())
+            header = next(reader, None)
+            if header is None:
+                return
+            self._clz_meta._check_columns(header)
+            if offset is not None:
+                file.seek(offset)
+                position[0] = offset
+                reader = csv.reader(lines())
+            for record in reader:
+                if len(record) == 0:
+                    continue
+                yield {
+                    k: (None if v == Bulk.NULL else v.replace("\\\\", "\\"))
+                    for (k, v) in zip(header, record)
+                }, position[0]
+            return
+        if offset is not None:
+            file.seek(offset)
+            position[0] = offset
+        for line in lines():
+            if line.strip() == "":
+                continue
+            row = json.loads(line)
+            self._clz_meta._check_columns(row)
+            yield row, position[0]
+
+    def _write(self, batch, method, operation):
+        groups = collections.OrderedDict()
+        for row in batch:
+            groups.setdefault(tuple(row), list()).append(tuple(row.values()))
+        for (columns, values) in groups.items():
+            if method == "load_data":
+                self._load_data(columns, values, operation)
+                continue
+            query = (
+                BatchInsertQuery(self._clz_meta)
+                .set_session(model_db_conf=self._db_conf, dbi=None)
+                .ignore(operation == INSERT.DUPLICATE_KEY_IGNORE)
+                .replace(operation == INSERT.DUPLICATE_KEY_REPLACE)
+                .values(columns, values)
+            )
+            if operation == INSERT.DUPLICATE_KEY_UPDATE:
+                query.on_duplicate_key_update_values()
+            query.go()
+        return len(batch)
+
+    def _load_data(self, columns, values, operation):
+        with tempfile.NamedTemporaryFile("wb", suffix=".tsv", delete=False) as tmp:
+            for row in values:
+                tmp.write(
+                    (
+                        "\t".join(
+                            "\\N" if v is None else str(v).translate(Bulk._TSV_ESCAPE)
+                            for v in row
+                        )
+                        + "\n"
+                    ).encode("utf8")
+                )
+        sql = (
+            "LOAD DATA LOCAL INFILE %(file)s "
+            + ("REPLACE " if operation == INSERT.DUPLICATE_KEY_REPLACE else "IGNORE ")
+            + "INTO TABLE "
+            + self._clz_meta.__name__
+            + " CHARACTER SET utf8mb4 ("
+            + ", ".join(columns)
+            + ")"
+        )
+        db_conf = self._config()
+        dbi = Riko.get_pool(db_conf).dbi() if Riko.use_pool else DBI(db_conf)
+        try:
+            dbi.query(sql, {"file": tmp.name}, return_pattern=DBI.RETURN_AFFECTED_ROW)
+        finally:
+            dbi.close()
+            os.remove(tmp.name)
+            SqlQuery.result_cache.invalidate(self._clz_meta.__name__)
+            Riko.mark_write(db_conf)
+
+    def _csv_encoder(self):
+        buffer = io.StringIO()
+        writer = csv.writer(buffer, lineterminator="\n")
+
+        def encode(values):
+            buffer.seek(0)
+            buffer.truncate()
+            writer.writerow([Bulk._csv_value(v) for v in values])
+            return buffer.getvalue().encode("utf8")
+
+        return encode
+
+    @staticmethod
+    def _csv_value(value):
+        if value is None:
+            return Bulk.NULL
+        if isinstance(value, str):
+            # backslashes doubled, so that a value "\\N" is not read back as NULL
+            return value.replace("\\", "\\\\")
+        return value
+
+    @staticmethod
+    def _jsonl_encode(row):
+        return (json.dumps(row, ensure_ascii=False, default=str) + "\n").encode("utf8")
+
+    def _load_checkpoint(self, path, fmt):
+        try:
+            with open(Bulk.checkpoint_path(path), "r") as file:
+                state = json.loads(file.read())
+        except FileNotFoundError:
+            return None
+        if state.get("model") != self._clz_meta.__name__ or state.get("format") != fmt:
+            raise Exception("Checkpoint does not match: " + Bulk.checkpoint_path(path))
+        return state
+
+    def _save_checkpoint(self, path, fmt, offset, rows, last=None, pk_names=None):
+        state = {"model": self._clz_meta.__name__, "format": fmt, "offset": offset, "rows": rows}
+        if last is not None:
+            state["after"] = last[pk_names[0]]
+        tmp_path = Bulk.checkpoint_path(path) + ".tmp"
+        with open(tmp_path, "w") as file:
+            file.write(json.dumps(state, default=str))
+        # replaced at once, never left half written
+        os.replace(tmp_path, Bulk.checkpoint_path(path))
+
+    def _remove_checkpoint(self, path):
+        try:
+            os.remove(Bulk.checkpoint_path(path))
+        except FileNotFoundError:
+            pass
+
+    def _report(self, rows, done, total):
+        if self._progress is not None:
+            self._progress(rows, done, total)
+
+
+class SchemaSync:
+    """
+    Compare secondary indexes declared by models with `information_schema`, and create the missing ones.
+    """
+
+    def __init__(self, models, db_config=None):
+        """
+        :param models: list of model classes
+        :param db_config: DB connection config, None to use default `Riko.db_config`
+        """
+        self._models = list(models)
+        self._db_conf = Riko.db_config if db_config is None else db_config
+
+    def existing(self):
+        """
+        Get indexes existing in DB of each model table.
+        :return: a dict of table name to list of column name tuples
+        """
+        tables = [m.__name__ for m in self._models]
+        placeholders = ", ".join("%(t" + str(i) + ")s" for i in range(len(tables)))
+        dbi = DBI(self._db_conf)
+        try:
+            rows = dbi.query(
+                "SELECT TABLE_NAME, INDEX_NAME, SEQ_IN_INDEX, COLUMN_NAME "
+                "FROM information_schema.STATISTICS "
+                "WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME IN (" + placeholders + ") "
+                "ORDER BY TABLE_NAME, INDEX_NAME, SEQ_IN_INDEX",
+                {"t" + str(i): t for (i, t) in enumerate(tables)},
+            )
+        finally:
+            dbi.close()
+        indexes = collections.OrderedDict((t, collections.OrderedDict()) for t in tables)
+        for row in rows:
+            (table, index, _, column) = tuple(row.values()) if isinstance(row, dict) else row
+            indexes[table].setdefault(index, list()).append(column)
+        return {t: [tuple(c) for c in idx.values()] for (t, idx) in indexes.items()}
+
+    def missing(self):
+        """
+        Get declared indexes not covered by any existing index, an index covers the ones of its leftmost columns.
+        :return: list of (model class, index name, column name tuple)
+        """
+        existing = self.existing()
+        missing = list()
+        for model in self._models:
+            current = existing.get(model.__name__, [])
+            for (name, columns) in model.get_indexes():
+                if not any(c[: len(columns)] == columns for c in current):
+                    missing.append((model, name, columns))
+        return missing
+
+    def statements(self):
+        """
+        Get `ALTER TABLE` statements creating missing indexes, one per table.
+        :return: list of SQL strings
+        """
+        adds = collections.OrderedDict()
+        for (model, name, columns) in self.missing():
+            adds.setdefault(model.__name__, list()).append(
+                "ADD INDEX `" + name + "` (" + ", ".join("`" + c + "`" for c in columns) + ")"
+            )
+        return [
+            "ALTER TABLE `" + table + "` " + ", ".join(terms)
+            for (table, terms) in adds.items()
+        ]
+
+    def sync(self, dry_run=False):
+        """
+        Create missing indexes.
+        :param dry_run: True to only get the statements
+        :return: list of executed, or to be executed if `dry_run`, SQL strings
+        """
+        statements = self.statements()
+        if dry_run or len(statements) == 0:
+            return statements
+        dbi = DBI(self._db_conf)
+        try:
+            for sql in statements:
+                dbi.query(sql, None, return_pattern=DBI.RETURN_NONE)
+        finally:
+            dbi.close()
+        return statements
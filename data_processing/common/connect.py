@@ -7,7 +7,9 @@
 @contact : minami.rinne.me@gmail.com
 @time    : 2022/3/25 9:34 下午
 """
-from data_processing.common.Riko import DictModel
+import datetime
+
+from data_processing.common.Riko import BufferedWriter, DictModel, INSERT, Riko
 
 
 class message(DictModel):
@@ -28,12 +30,22 @@ class message(DictModel):
         "send_time",
         "enter_time",
         "error_message",
+        "worker_id",
+        "lease_until",
     ]
+    # loaded on first access when selecting objects, dict results of Connect still have them
+    deferred = ["text", "tag", "media_url", "media_key", "media_type", "media_path", "error_message"]
+    # get_message_info_by_status, *_by_username_and_status
+    indexes = [("status",), ("username", "status")]
 
 
 class spider_user(DictModel):
     pk = ["uid"]
     fields = ["username", "add_time", "add_time", "last_check_time"]
+    # invalidated by writes through Riko, which come every LAST_CHECK_INTERVAL of processing_core
+    cache_ttl = 600
+    # update_spider_user_info
+    indexes = [("username",)]
 
 
 class user(DictModel):
@@ -48,20 +60,37 @@ class user(DictModel):
         "update_time",
         "last_check_time",
     ]
+    # invalidated by writes through Riko, which come every LAST_CHECK_INTERVAL of processing_core
+    cache_ttl = 600
 
 
 class Connect(object):
+    # message status: waiting, sent, failed, and claimed by a sender worker until `lease_until`
+    MESSAGE_WAITING = 0
+    MESSAGE_SENT = 1
+    MESSAGE_FAILED = -1
+    MESSAGE_SENDING = 2
+
     def __init__(self):
         pass
 
     @staticmethod
     def insert_message_info(**kwargs):
-        message.new(**kwargs).insert()
+        message.new(**kwargs).insert(on_duplicate_key_replace=INSERT.DUPLICATE_KEY_IGNORE)
+
+    @staticmethod
+    def message_info_writer():
+        # inserts of new tweets are written behind by a background thread, flush before reading them
+        return BufferedWriter(
+            message, on_duplicate_key_replace=INSERT.DUPLICATE_KEY_IGNORE, max_rows=100
+        )
 
     @staticmethod
     def get_message_info_by_status(status: int):
         get_info = (
             message.select()
+            # status decides what is sent next, never read it from a lagging replica
+            .from_primary()
             .where_raw("status = %(input_status)s")
             .get({"input_status": status})
         )
@@ -76,34 +105,129 @@ class Connect(object):
     def get_message_info_by_username_and_status(username: str, status: int):
         get_info = (
             message.select()
+            .from_primary()
             .where_raw("username = %(input_username)s AND status = %(input_status)s")
             .get({"input_username": username, "input_status": status})
         )
         return get_info
 
+    @staticmethod
+    def claim_pending(limit: int, worker_id: str, lease: int):
+        """
+        Claim waiting messages to send, and messages whose claim lease expired.
+        Claimed messages are skipped by other workers until sent or `lease` seconds later,
+        so that several workers drain the queue with no message sent twice.
+        :param limit: max number of messages to claim
+        :param worker_id: unique name of the claiming worker
+        :param lease: seconds a claim lasts, longer than sending a message takes
+        :return: a list of claimed message dict objects
+        """
+        now = datetime.datetime.now()
+        args = {
+            "input_now": now.strftime("%Y-%m-%d %H:%M:%S"),
+            "input_waiting": Connect.MESSAGE_WAITING,
+            "input_sending": Connect.MESSAGE_SENDING,
+        }
+        claimable = (
+            "(status = %(input_waiting)s"
+            " OR (status = %(input_sending)s AND lease_until < %(input_now)s))"
+        )
+        lease_until = (now + datetime.timedelta(seconds=lease)).strftime("%Y-%m-%d %H:%M:%S")
+        with Riko.transaction() as dbi:
+            # rows locked by another claiming worker are skipped rather than waited for
+            rows = (
+                message.select(t=dbi, return_columns=("tid",))
+                .where_raw(claimable)
+                .order_by(["tid"])
+                .limit(limit)
+                .for_update(skip_locked=True)
+                .get(args)
+            )
+            tids = [row["tid"] for row in rows]
+            if len(tids) == 0:
+                return []
+            # still claimable, SQLite has no row lock to keep others off between the two statements
+            (
+                message.update_query(t=dbi)
+                .set(status=Connect.MESSAGE_SENDING, worker_id=worker_id, lease_until=lease_until)
+                .where_in("tid", tids)
+                .where_raw(claimable)
+                .go(args)
+            )
+        return (
+            message.select()
+            .from_primary()
+            .where_in("tid", tids)
+            .where(status=Connect.MESSAGE_SENDING, worker_id=worker_id, lease_until=lease_until)
+            .order_by(["tid"])
+            .get()
+        )
+
+    @staticmethod
+    def renew_claim(tid: int, worker_id: str, lease_until: str, lease: int):
+        """
+        Extend a claim right before sending the message.
+        The claim is identified by its `lease_until`, so that a stale claim expired and claimed again,
+        even by the same worker, is not renewed.
+        :param tid: message tid
+        :param worker_id: name of the worker given to `claim_pending`
+        :param lease_until: `lease_until` of the claimed message dict, or of the last renewal
+        :param lease: seconds the claim lasts from now
+        :return: new `lease_until` of the claim, or None if it is not held any more
+        """
+        old = datetime.datetime.strptime(str(lease_until), "%Y-%m-%d %H:%M:%S")
+        # always changed, MySQL reports no affected row if nothing changed
+        new = max(
+            datetime.datetime.now() + datetime.timedelta(seconds=lease),
+            old + datetime.timedelta(seconds=1),
+        ).strftime("%Y-%m-%d %H:%M:%S")
+        affected = (
+            message.update_query()
+            .set(lease_until=new)
+            .where(
+                tid=tid,
+                status=Connect.MESSAGE_SENDING,
+                worker_id=worker_id,
+                lease_until=str(lease_until),
+            )
+            .go()
+        )
+        return new if affected > 0 else None
+
+    @staticmethod
+    def complete_claimed(tid: int, worker_id: str, info_dict: dict, lease_until: str = None) -> bool:
+        """
+        Update a claimed message after sending, unless its claim has been taken by another worker.
+        :param tid: message tid
+        :param worker_id: name of the worker given to `claim_pending`
+        :param info_dict: terms to update, like status and send_time
+        :param lease_until: `lease_until` of the claim to complete, None for any claim of the worker
+        :return: True if the message was still claimed by the worker
+        """
+        terms = {"tid": tid, "status": Connect.MESSAGE_SENDING, "worker_id": worker_id}
+        if lease_until is not None:
+            terms["lease_until"] = str(lease_until)
+        affected = message.update_query().set(lease_until=None, **info_dict).where(**terms).go()
+        return affected > 0
+
     @staticmethod
     def update_message_info_by_tid(tid: str, info_dict: dict):
-        new_info = message.get_one(tid=tid)
-        for k, v in info_dict.items():
-            new_info[k] = v
-        new_info.update()
+        message.patch(tid, **info_dict)
 
     @staticmethod
     def update_message_info_by_username_and_status(
         username: str, status: int, info_dict: dict
     ):
-        new_info = (
-            message.select()
+        (
+            message.update_query()
+            .set(**info_dict)
             .where_raw("username = %(input_username)s AND status = %(input_status)s")
-            .get({"input_username": username, "input_status": status})
+            .go({"input_username": username, "input_status": status})
         )
-        for k, v in info_dict.items():
-            new_info[k] = v
-        new_info.update()
 
     @staticmethod
     def insert_spider_user_info(**kwargs):
-        spider_user.new(**kwargs).insert()
+        spider_user.new(**kwargs).insert(on_duplicate_key_replace=INSERT.DUPLICATE_KEY_IGNORE)
 
     @staticmethod
     def get_spider_user_info():
@@ -112,14 +236,15 @@ class Connect(object):
 
     @staticmethod
     def update_spider_user_info(username: str, info_dict: dict):
-        new_info = spider_user.get_one(username=username)
-        for k, v in info_dict.items():
-            new_info[k] = v
-        new_info.update()
+        spider_user.update_query().set(**info_dict).where(username=username).go()
+
+    @staticmethod
+    def update_spider_user_info_by_uid(uid: int, info_dict: dict):
+        spider_user.patch(uid, **info_dict)
 
     @staticmethod
     def insert_user_info(**kwargs):
-        user.new(**kwargs).insert()
+        user.new(**kwargs).insert(on_duplicate_key_replace=INSERT.DUPLICATE_KEY_IGNORE)
 
     @staticmethod
     def get_user_info():
@@ -128,7 +253,4 @@ class Connect(object):
 
     @staticmethod
     def update_user_info(uid: int, info_dict: dict):
-        new_info = user.get_one(uid=uid)
-        for k, v in info_dict.items():
-            new_info[k] = v
-        new_info.update()
+        user.patch(uid, **info_dict)
@@ -11,6 +11,7 @@ import copy
 import json
 import os
 import random
+import socket
 import time
 import concurrent.futures
 
@@ -33,6 +34,13 @@ from data_processing.common.setting import (
     WEIBO_COOKIES,
 )
 
+# messages claimed and not sent yet at most, and seconds a claim lasts before another worker may take it over
+SEND_CLAIM_LIMIT = 20
+SEND_CLAIM_LEASE = 30 * 60
+
+# seconds between writes of `last_check_time`, each write invalidates cached spider_user and user rows
+LAST_CHECK_INTERVAL = 10 * 60
+
 WEIBO_TEMPLATE = """{name}
 (a){username}
 {created_at}
@@ -46,14 +54,23 @@ class ProcessingCore(object):
     def __init__(self):
         with open("data_processing/atri_bot_db.json", "r") as file:
             config = json.loads(file.read())
+        replicas = config.pop("replicas", [])
+        read_your_writes = config.pop("read_your_writes", None)
         config["cursorclass"] = pymysql.cursors.DictCursor
         Riko.db_config = config
+        Riko.set_replicas(replicas, read_your_writes=read_your_writes)
 
         self.connect = Connect()
+        self.message_writer = self.connect.message_info_writer()
+        self.worker_id = f"{socket.gethostname()}-{os.getpid()}"
+        # sends submitted to the executor and not finished yet
+        self.send_futures = set()
         self._create_folder()
         self.spider_user_list = list()
         self.need_update_spider_user_list = list()
         self.error_user_list = list()
+        # monotonic time `last_check_time` was written, None before the first write
+        self.last_check_written = None
         self._init_start_user_list()
 
         WeiboAPI.load_from_cookies_str(WEIBO_COOKIES).save_cookies_object(
@@ -63,10 +80,14 @@ class ProcessingCore(object):
         self.executor = concurrent.futures.ThreadPoolExecutor(1) # WeiboAPI 不是线程安全的，不要调整worker数量
 
     def bot_star(self):
-        start_observe_tweets(
-            usernames=self.spider_user_list,
-            callback=lambda twitters: self._bot_controller(twitters),
-        )
+        try:
+            start_observe_tweets(
+                usernames=self.spider_user_list,
+                callback=lambda twitters: self._bot_controller(twitters),
+            )
+        finally:
+            # rows still buffered are lost if the writer thread is not closed
+            self.message_writer.close()
 
     def _init_start_user_list(self) -> None:
         need_update_list = self._get_need_update_spider()
@@ -122,30 +143,34 @@ class ProcessingCore(object):
 
     def _get_need_update_spider(self) -> list:
         need_update_spider_user_list = []
-        spider_user_info_in_db = [
-            db_info["username"] for db_info in self.connect.get_spider_user_info()
-        ]
+        spider_user_in_db = self.connect.get_spider_user_info()
+        spider_user_info_in_db = [db_info["username"] for db_info in spider_user_in_db]
         user_info_in_db = [db_info["uid"] for db_info in self.connect.get_user_info()]
 
-        if len(spider_user_info_in_db) != 0:
-            for username in spider_user_info_in_db:
-                update_dict = {
-                    "last_check_time": time.strftime(
-                        "%Y-%m-%d %H:%M:%S", time.localtime(time.time())
-                    )
-                }
-                self.connect.update_spider_user_info(
-                    username=username, info_dict=update_dict
-                )
+        # written once in a while rather than every cycle, so that the reads above hit the result cache
+        now = time.monotonic()
+        if self.last_check_written is None or now - self.last_check_written >= LAST_CHECK_INTERVAL:
+            self.last_check_written = now
+            with Riko.session():
+                if len(spider_user_info_in_db) != 0:
+                    for db_info in spider_user_in_db:
+                        update_dict = {
+                            "last_check_time": time.strftime(
+                                "%Y-%m-%d %H:%M:%S", time.localtime(time.time())
+                            )
+                        }
+                        self.connect.update_spider_user_info_by_uid(
+                            uid=db_info["uid"], info_dict=update_dict
+                        )
 
-        if len(user_info_in_db) != 0:
-            for uid in user_info_in_db:
-                update_dict = {
-                    "last_check_time": time.strftime(
-                        "%Y-%m-%d %H:%M:%S", time.localtime(time.time())
-                    )
-                }
-                self.connect.update_user_info(uid=uid, info_dict=update_dict)
+                if len(user_info_in_db) != 0:
+                    for uid in user_info_in_db:
+                        update_dict = {
+                            "last_check_time": time.strftime(
+                                "%Y-%m-%d %H:%M:%S", time.localtime(time.time())
+                            )
+                        }
+                        self.connect.update_user_info(uid=uid, info_dict=update_dict)
 
         for spider_user_info in self._read_user_list_in_txt():
             if spider_user_info not in spider_user_info_in_db:
@@ -216,69 +241,64 @@ class ProcessingCore(object):
 
     def update_new_spider_user_info(self, users_list: list) -> None:
         users_info_list = get_users(users_list)
-        for user in users_info_list:
-            try:
-                self.connect.insert_spider_user_info(
-                    uid=user.get("id"),
-                    username=user.get("username"),
-                    add_time=time.strftime(
-                        "%Y-%m-%d %H:%M:%S", time.localtime(time.time())
-                    ),
-                )
-            except pymysql.err.IntegrityError:
-                pass
+        with Riko.session():
+            self._insert_spider_users(users_info_list)
 
-            try:
-                self.connect.insert_user_info(
-                    uid=user.get("id"),
-                    name=user.get("name"),
-                    username=user.get("username"),
-                    description=user.get("description"),
-                    profile_image_url=user.get("profile_image_url"),
-                    profile_image_path=self._save_profile_image(
-                        user.get("profile_image_url")
-                    ),
-                    add_time=time.strftime(
-                        "%Y-%m-%d %H:%M:%S", time.localtime(time.time())
-                    ),
-                )
+    def _insert_spider_users(self, users_info_list: list) -> None:
+        # both inserts ignore duplicated keys, queued by the session of the caller
+        for user in users_info_list:
+            self.connect.insert_spider_user_info(
+                uid=user.get("id"),
+                username=user.get("username"),
+                add_time=time.strftime(
+                    "%Y-%m-%d %H:%M:%S", time.localtime(time.time())
+                ),
+            )
 
-            except pymysql.err.IntegrityError:
-                pass
+            self.connect.insert_user_info(
+                uid=user.get("id"),
+                name=user.get("name"),
+                username=user.get("username"),
+                description=user.get("description"),
+                profile_image_url=user.get("profile_image_url"),
+                profile_image_path=self._save_profile_image(
+                    user.get("profile_image_url")
+                ),
+                add_time=time.strftime(
+                    "%Y-%m-%d %H:%M:%S", time.localtime(time.time())
+                ),
+            )
 
     def update_new_text_info(self, need_update_info: List[dict]) -> None:
         for text_info in need_update_info:
             twitter_url = f"{TWITTER_URL}/{text_info.get('user').get('username')}/status/{text_info.get('tid')}"
 
-            try:
-                self.connect.insert_message_info(
-                    tid=text_info.get("tid"),
-                    uid=text_info.get("uid"),
-                    name=text_info.get("user").get("name"),
-                    username=text_info.get("user").get("username"),
-                    text=text_info.get("text"),
-                    time=text_info.get("created_at"),
-                    twi_url=twitter_url,
-                    tag=self._check_hashtag(text_info.get("hashtags")),
-                    media_url=",".join(
-                        self._get_media_url_info(text_info.get("media"), "url")
-                    ),
-                    media_key=",".join(
-                        self._get_media_url_info(text_info.get("media"), "type")
-                    ),
-                    media_path=",".join(
-                        self._save_media_file(
-                            self._get_media_url_info(text_info.get("media"), "url"),
-                            self._get_media_url_info(text_info.get("media"), "type"),
-                        )
-                    ),
-                    status=0,
-                    enter_time=time.strftime(
-                        "%Y-%m-%d %H:%M:%S", time.localtime(time.time())
-                    ),
-                )
-            except pymysql.err.IntegrityError:
-                continue
+            self.message_writer.add(
+                tid=text_info.get("tid"),
+                uid=text_info.get("uid"),
+                name=text_info.get("user").get("name"),
+                username=text_info.get("user").get("username"),
+                text=text_info.get("text"),
+                time=text_info.get("created_at"),
+                twi_url=twitter_url,
+                tag=self._check_hashtag(text_info.get("hashtags")),
+                media_url=",".join(
+                    self._get_media_url_info(text_info.get("media"), "url")
+                ),
+                media_key=",".join(
+                    self._get_media_url_info(text_info.get("media"), "type")
+                ),
+                media_path=",".join(
+                    self._save_media_file(
+                        self._get_media_url_info(text_info.get("media"), "url"),
+                        self._get_media_url_info(text_info.get("media"), "type"),
+                    )
+                ),
+                status=0,
+                enter_time=time.strftime(
+                    "%Y-%m-%d %H:%M:%S", time.localtime(time.time())
+                ),
+            )
 
     def _update_send_message_status(self, message_status: dict) -> None:
 
@@ -290,18 +310,46 @@ class ProcessingCore(object):
             ),
         }
 
-        if message_status.get("status") == -1:
+        if message_status.get("status") == Connect.MESSAGE_FAILED:
             info_dict["error_message"] = message_status.get("error_message")
 
-        self.connect.update_message_info_by_tid(
-            tid=message_status.get("tid"), info_dict=info_dict
+        self.connect.complete_claimed(
+            tid=message_status.get("tid"),
+            worker_id=self.worker_id,
+            info_dict=info_dict,
+            lease_until=message_status.get("lease_until"),
         )
 
     def send_message(self):
-        message_list = self.connect.get_message_info_by_status(status=0)
+        self.send_futures = {f for f in self.send_futures if not f.done()}
+        # claim only what the executor can take, claims waiting in its queue would expire
+        limit = SEND_CLAIM_LIMIT - len(self.send_futures)
+        if limit <= 0:
+            return
+        # claimed messages are not selected again by the next cycle or another process
+        message_list = self.connect.claim_pending(
+            limit=limit, worker_id=self.worker_id, lease=SEND_CLAIM_LEASE
+        )
+        # new messages are written behind, wait for them only when there is nothing else to send
+        if len(message_list) == 0 and len(self.send_futures) == 0:
+            writer_stats = self.message_writer.stats()
+            if writer_stats["buffered"] + writer_stats["in_flight"] > 0:
+                self.message_writer.flush()
+                message_list = self.connect.claim_pending(
+                    limit=limit, worker_id=self.worker_id, lease=SEND_CLAIM_LEASE
+                )
 
         for m in message_list:
-            def run():
+            def run(m=m):
+                # skip if the claim expired and was taken again, by another worker or by this one
+                lease_until = self.connect.renew_claim(
+                    tid=m["tid"],
+                    worker_id=self.worker_id,
+                    lease_until=m["lease_until"],
+                    lease=SEND_CLAIM_LEASE,
+                )
+                if lease_until is None:
+                    return
                 try:
                     self.weibo_api.send_weibo(
                         WEIBO_TEMPLATE.format_map(
@@ -315,13 +363,20 @@ class ProcessingCore(object):
                         ),
                         m.get('media_path').split(',') if m.get('media_path') else None,  # TODO: 不支持视频，需要额外检查
                     )
-                    self._update_send_message_status({"tid": m["tid"], "status": 1})
+                    self._update_send_message_status(
+                        {"tid": m["tid"], "status": Connect.MESSAGE_SENT, "lease_until": lease_until}
+                    )
                 except Exception as err:
                     self._update_send_message_status(
-                        {"tid": m["tid"], "status": -1, "error_message": err}
+                        {
+                            "tid": m["tid"],
+                            "status": Connect.MESSAGE_FAILED,
+                            "error_message": err,
+                            "lease_until": lease_until,
+                        }
                     )
             
-            self.executor.submit(run)
+            self.send_futures.add(self.executor.submit(run))
 
     def _bot_controller(self, twitters: List[dict]):
 
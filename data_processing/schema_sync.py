@@ -0,0 +1,82 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+"""
+@module  : schema_sync.py
+@time    : 2026/10/17
+
+Create secondary indexes declared by models in connect.py but missing in DB,
+and EXPLAIN hot queries of Connect to find full scans.
+
+    python -m data_processing.schema_sync [--dry-run] [--explain]
+"""
+import argparse
+import json
+import logging
+
+import pymysql
+
+from data_processing.common.Riko import Riko, SchemaSync
+from data_processing.common.connect import message, spider_user, user
+
+MODELS = [message, spider_user, user]
+
+
+def hot_queries():
+    """
+    Queries issued by `Connect` every cycle, with sample arguments.
+    """
+    return [
+        (
+            "get_message_info_by_status",
+            message.select().where_raw("status = %(input_status)s"),
+            {"input_status": 0},
+        ),
+        (
+            "get_message_info_by_username_and_status",
+            message.select().where_raw(
+                "username = %(input_username)s AND status = %(input_status)s"
+            ),
+            {"input_username": "", "input_status": 0},
+        ),
+        (
+            "update_spider_user_info",
+            spider_user.update_query().set(last_check_time=None).where(username=""),
+            None,
+        ),
+    ]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Sync indexes declared by Riko models")
+    parser.add_argument("--config", default="data_processing/atri_bot_db.json")
+    parser.add_argument("--dry-run", action="store_true", help="print statements only")
+    parser.add_argument("--explain", action="store_true", help="EXPLAIN hot queries")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(levelname)s %(message)s")
+
+    with open(args.config, "r") as file:
+        config = json.loads(file.read())
+    # indexes are created on primary, replicas follow it
+    config.pop("replicas", None)
+    config.pop("read_your_writes", None)
+    config["cursorclass"] = pymysql.cursors.DictCursor
+    Riko.db_config = config
+
+    statements = SchemaSync(MODELS).sync(dry_run=args.dry_run)
+    for sql in statements:
+        print(sql + ";")
+    if len(statements) == 0:
+        print("-- indexes are up to date")
+
+    if args.explain:
+        for (name, query, query_args) in hot_queries():
+            for row in query.explain(query_args):
+                print(
+                    "%s: table=%s type=%s key=%s rows=%s"
+                    % (name, row.get("table"), row.get("type"), row.get("key"), row.get("rows"))
+                )
+
+
+if __name__ == "__main__":
+    main()